@@ -0,0 +1,174 @@
+"""Measure how much memory each endpoint allocates, to find what grows workers.
+
+A diagnostic mode: with MEMORY_TRACE set, tracemalloc traces every
+allocation, which makes requests several times slower. For each request it
+records the peak memory allocated while serving it, and where the memory
+still held when the response is ready was allocated: the innermost line of
+Warbler's own code (a view, a model, or a template line such as
+templates/users/show.html:40) on the allocating stack.
+
+Requests peaking above MEMORY_ALARM_KB are logged with their route, URL
+parameters and query string, and their top allocation sites.
+
+/metrics/memory reports, per endpoint, the requests traced, their average and
+largest peak, and the sites that allocated the most, in the worker that
+answers. Traces are cleared at the start of each request, so run the
+diagnosis with single-threaded workers (gunicorn's default) and, to see every
+request in one report, WEB_CONCURRENCY=1.
+"""
+
+import logging
+import os
+import resource
+import threading
+import tracemalloc
+from collections import Counter
+
+from flask import current_app, request
+
+from capture import sanitized_query
+
+MEMORY_TRACE = False
+MEMORY_TRACE_FRAMES = 30
+MEMORY_ALARM_KB = 20 * 1024
+MEMORY_TOP_SITES = 10
+
+_TRACED = 'warbler.memory_traced'
+
+logger = logging.getLogger(__name__)
+
+
+class EndpointMemory:
+    """What one endpoint's traced requests allocated."""
+
+    def __init__(self):
+        self.requests = 0
+        self.peak_total = 0
+        self.peak_max = 0
+        # Site -> bytes still held at the end of requests, summed
+        self.sites = Counter()
+
+    def add(self, peak, sites):
+        self.requests += 1
+        self.peak_total += peak
+        self.peak_max = max(self.peak_max, peak)
+        self.sites.update(sites)
+
+    def report(self, limit):
+        return {
+            'requests': self.requests,
+            'peak_avg_kb': round(self.peak_total / self.requests / 1024, 1),
+            'peak_max_kb': round(self.peak_max / 1024, 1),
+            'top_sites': [
+                {'site': site, 'avg_kb': round(size / self.requests / 1024, 1)}
+                for site, size in self.sites.most_common(limit)
+            ],
+        }
+
+
+class Allocations:
+    """This worker's allocation figures per endpoint."""
+
+    def __init__(self, root):
+        self.root = os.path.join(os.path.abspath(root), '')
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def add(self, endpoint, peak, sites):
+        with self.lock:
+            self.endpoints.setdefault(endpoint, EndpointMemory()).add(peak, sites)
+
+    def report(self, limit=MEMORY_TOP_SITES):
+        """Figures per endpoint, plus this worker's pid and peak RSS."""
+
+        with self.lock:
+            endpoints = {
+                endpoint: memory.report(limit)
+                for endpoint, memory in sorted(self.endpoints.items())
+            }
+
+        return {
+            'pid': os.getpid(),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'endpoints': endpoints,
+        }
+
+    def sites(self, snapshot):
+        """Bytes in `snapshot` by the innermost line of our code allocating
+        them; library code allocating outside of it is lumped together."""
+
+        sites = Counter()
+
+        for statistic in snapshot.statistics('traceback'):
+            sites[self.site(statistic.traceback)] += statistic.size
+
+        return sites
+
+    def site(self, traceback):
+        # Tracebacks run from the oldest frame to the most recent.
+        for frame in reversed(traceback):
+            if (frame.filename.startswith(self.root)
+                    and 'site-packages' not in frame.filename):
+                path = os.path.relpath(frame.filename, self.root)
+                return f"{path}:{frame.lineno}"
+
+        return '<libraries>'
+
+
+def init_allocations(app):
+    """Trace the memory `app`'s requests allocate while MEMORY_TRACE is set."""
+
+    app.config.setdefault('MEMORY_TRACE', MEMORY_TRACE)
+    app.config.setdefault('MEMORY_TRACE_FRAMES', MEMORY_TRACE_FRAMES)
+    app.config.setdefault('MEMORY_ALARM_KB', MEMORY_ALARM_KB)
+
+    app.extensions['allocations'] = Allocations(app.root_path)
+
+    app.before_request(_start_trace)
+    app.after_request(_record_trace)
+
+
+def get_allocations():
+    """The current app's Allocations."""
+
+    return current_app.extensions['allocations']
+
+
+def _start_trace():
+    config = current_app.config
+
+    if not config['MEMORY_TRACE']:
+        return
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(config['MEMORY_TRACE_FRAMES'])
+
+    # Also resets the peak, so both cover this request alone.
+    tracemalloc.clear_traces()
+    request.environ[_TRACED] = True
+
+
+def _record_trace(response):
+    if not request.environ.pop(_TRACED, False) or not tracemalloc.is_tracing():
+        return response
+
+    peak = tracemalloc.get_traced_memory()[1]
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    allocations = get_allocations()
+    sites = allocations.sites(snapshot)
+    endpoint = request.endpoint or 'unmatched'
+    allocations.add(endpoint, peak, sites)
+
+    if peak > current_app.config['MEMORY_ALARM_KB'] * 1024:
+        route = request.url_rule.rule if request.url_rule else request.path
+        top = ", ".join(f"{site} {size / 1024:.0f} KiB"
+                        for site, size in sites.most_common(3))
+
+        logger.warning(
+            "%s %s (%s %s, query %s) peaked at %.0f KiB; top sites: %s",
+            request.method, route, endpoint, request.view_args or {},
+            sanitized_query(request.args), peak / 1024, top)
+
+    return response
@@ -1,52 +1,179 @@
+import hmac
 import os
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g, request, url_for
-from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy import and_
+from flask import Blueprint, Flask, current_app, render_template, request, flash, redirect, session, g, request, url_for, jsonify
+from sqlalchemy import and_, select
 from sqlalchemy.exc import IntegrityError
 from functools import wraps
 
 from forms import UserAddForm, LoginForm, MessageForm, CsrfProtectForm, UpdateUserForm, LikeButtonForm
-from models import db, connect_db, User, Message, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL
-
-load_dotenv()
+from models import (
+    db, connect_db, User, Message, ArchivedMessage, Follow, Block, Like,
+    DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
+from loading import (
+    init_strict_loading, FEED, MESSAGE_DETAIL, ARCHIVED_MESSAGE_DETAIL, LIKED_MESSAGES,
+    USER_PROFILE, USER_FOLLOWING, USER_FOLLOWERS)
+from replicas import init_replicas, read_from_replica, wrote_recently, REPLICA_BIND
+from pooling import dispose_engines_after_fork, engine_options, pool_stats
+from shards import init_shards, get_shards
+from capture import init_capture
+from metrics import init_metrics, render_metrics
+from profiler import init_profiler, get_profiles, read_stacks, top_functions
+from allocations import init_allocations, get_allocations
+from ratelimit import init_rate_limits, parse_rate_limits, rate_limited
+from fragments import init_fragment_cache, get_fragment_cache
+from cache import init_cache, get_cache
+from outbox import record_event
+from jobs import job_stats
+from compression import init_compression
+from assets import init_assets
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+views = Blueprint('warbler', __name__)
+
+
+def create_app(config=None):
+    """Build a Warbler app.
+
+    Settings are read from the environment (and .env); `config` overrides
+    them, so tests and scripts can point an app at another database without
+    touching os.environ. Building the app doesn't connect to any database,
+    so gunicorn can build it once in its master process with --preload and
+    fork workers that share it (see gunicorn.conf.py).
+    """
+
+    load_dotenv()
+
+    app = Flask(__name__)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    if os.environ.get('DATABASE_REPLICA_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {
+            REPLICA_BIND: {
+                'url': os.environ['DATABASE_REPLICA_URL'],
+                **engine_options(os.environ['DATABASE_REPLICA_URL'], os.environ),
+            },
+        }
+    app.config['REPLICA_STICKY_SECONDS'] = float(
+        os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    app.config['STRICT_LOADING'] = os.environ.get('STRICT_LOADING') == '1'
+    app.config['DEBUG_TOOLBAR'] = os.environ.get('DEBUG_TOOLBAR') == '1'
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['SHARD_URLS'] = [
+        url for url in os.environ.get('SHARD_URLS', '').split(',') if url]
+    app.config['FEED_MAX_AGE_DAYS'] = (
+        int(os.environ['FEED_MAX_AGE_DAYS'])
+        if os.environ.get('FEED_MAX_AGE_DAYS') else None)
+    app.config['FEED_EVENTS_POLL_SECONDS'] = float(
+        os.environ.get('FEED_EVENTS_POLL_SECONDS', 2))
+    app.config['REQUEST_CAPTURE_PATH'] = os.environ.get('REQUEST_CAPTURE_PATH')
+    app.config['REQUEST_CAPTURE_SAMPLE'] = float(
+        os.environ.get('REQUEST_CAPTURE_SAMPLE', 1.0))
+    app.config['FRAGMENT_CACHE_SIZE'] = int(
+        os.environ.get('FRAGMENT_CACHE_SIZE', 10_000))
+    app.config['PUBLIC_PAGE_MAX_AGE'] = int(
+        os.environ.get('PUBLIC_PAGE_MAX_AGE', 60))
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+    app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+    app.config['COMPRESS_BROTLI_QUALITY'] = int(
+        os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+    app.config['CACHE_URL'] = os.environ.get('CACHE_URL', 'memory://')
+    app.config['CACHE_SIZE'] = int(os.environ.get('CACHE_SIZE', 10_000))
+    app.config['PROFILE_SAMPLE'] = float(os.environ.get('PROFILE_SAMPLE', 0))
+    app.config['PROFILE_INTERVAL_MS'] = float(
+        os.environ.get('PROFILE_INTERVAL_MS', 5))
+    if os.environ.get('PROFILE_DIR'):
+        app.config['PROFILE_DIR'] = os.environ['PROFILE_DIR']
+    app.config['MEMORY_TRACE'] = os.environ.get('MEMORY_TRACE') == '1'
+    app.config['MEMORY_ALARM_KB'] = int(os.environ.get('MEMORY_ALARM_KB', 20480))
+    app.config['RATE_LIMITS'] = parse_rate_limits(os.environ.get('RATE_LIMITS', ''))
+    app.config['RATE_LIMIT_PATH'] = os.environ.get('RATE_LIMIT_PATH')
+
+    app.config.update(config or {})
+
+    for name, env_name in [('SQLALCHEMY_DATABASE_URI', 'DATABASE_URL'),
+                           ('SECRET_KEY', 'SECRET_KEY')]:
+        if not app.config[name]:
+            raise RuntimeError(f"Set {env_name} in the environment or .env.")
+
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'], os.environ))
+
+    if app.config['DEBUG_TOOLBAR']:
+        # Imported only when wanted: it pulls in Pygments and friends, which
+        # every worker and test run would otherwise load for nothing.
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    init_metrics(app)
+    init_profiler(app)
+    init_allocations(app)
+    init_capture(app)
+    init_strict_loading(app)
+    init_replicas(app)
+    init_shards(app)
+    init_fragment_cache(app)
+    init_cache(app)
+    init_rate_limits(app)
+    init_compression(app)
+    init_assets(app)
+    app.register_blueprint(views)
+    dispose_engines_after_fork(app)
+
+    return app
+
+
+_default_app = None
+
+
+def __getattr__(name):
+    """Build `app`, the app configured from the environment, on first use.
+
+    This is what `flask run`, `gunicorn app:app` and the scripts in this
+    directory import; building it lazily means importing this module (for
+    create_app, say) needs no configuration.
+    """
+
+    global _default_app
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-# toolbar = DebugToolbarExtension(app)
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-connect_db(app)
+    if _default_app is None:
+        _default_app = create_app()
+
+    return _default_app
 
 ##############################################################################
 # User signup/login/logout
 
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
-@app.before_request
+@views.before_app_request
 def add_csrfform_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     g.csrf_form = CsrfProtectForm()
 
 
-@app.errorhandler(404)
+@views.app_errorhandler(404)
 def not_found(e):
     return render_template("404.html")
 
@@ -62,6 +189,118 @@ def login_required(f):
 
 
 
+def metrics_token_required(f):
+    """Only serve this view to requests bearing METRICS_TOKEN.
+
+    Without a configured token the view doesn't exist.
+    """
+
+    @wraps(f)
+    def metrics_decorator(*args, **kwargs):
+        token = current_app.config['METRICS_TOKEN']
+        if not token or not hmac.compare_digest(
+                request.headers.get('Authorization', '').encode(),
+                f"Bearer {token}".encode()):
+            return (render_template('404.html'), 404)
+        return f(*args, **kwargs)
+    return metrics_decorator
+
+
+def wants_json():
+    """Did the client ask for JSON rather than a page?
+
+    Like, follow and block forms submitted from JavaScript ask for JSON and
+    update their button in place; plain form posts get a redirect.
+    """
+
+    return request.accept_mimetypes.best_match(
+        ['text/html', 'application/json']) == 'application/json'
+
+
+def public_when_anonymous(f):
+    """Let shared caches keep this view's page for logged-out visitors."""
+
+    f.public_when_anonymous = True
+    return f
+
+
+def copy_to_shard(obj):
+    """Copy a row just committed to the primary onto its owner's shard.
+
+    Only users are copied here; messages, likes, follows and blocks reach
+    the shards through the outbox.
+    """
+
+    shards = get_shards()
+    if shards:
+        shards.copy(obj)
+
+
+def load_user(user_id):
+    """The user with `user_id`, or None, without a query when it's cached.
+
+    Users are cached only in a shared cache, which every worker's edits
+    invalidate. Routes changing the user reload it first (load_user_for_update).
+    """
+
+    cache = get_cache()
+
+    if not cache.backend.shared:
+        return db.session.get(User, user_id)
+
+    def user_values():
+        user = db.session.get(User, user_id)
+        return user.cached_values() if user else None
+
+    values = cache['users'].get_or_set(user_id, user_values)
+
+    if values is None:
+        return None
+
+    return db.session.merge(User.from_cached_values(values), load=False)
+
+
+def load_user_for_update():
+    """g.user with its row freshly loaded, before a route changes it.
+
+    A user rebuilt from the cache may be out of date: written back, it would
+    undo another request's changes.
+    """
+
+    db.session.refresh(g.user)
+    return g.user
+
+
+def forget(namespace, *keys):
+    """Drop `keys` from a cache namespace once a commit has changed them."""
+
+    for key in keys:
+        get_cache()[namespace].delete(key)
+
+
+@views.app_template_global()
+def profile_counts(user):
+    """Message, following, follower and like counts for a profile."""
+
+    return shared_cache('profile-counts', user.id,
+                        lambda: User.profile_counts(user.id))
+
+
+def shared_cache(namespace, key, compute):
+    """compute(), cached in `namespace` if every worker shares the cache.
+
+    Commits drop these entries, which a worker's own cache would keep
+    serving after other workers' commits.
+    """
+
+    cache = get_cache()
+
+    if not cache.backend.shared:
+        return compute()
+
+    return cache[namespace].get_or_set(key, compute)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -75,7 +314,8 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@views.route('/signup', methods=["GET", "POST"])
+@rate_limited
 def signup():
     """Handle user signup.
 
@@ -100,6 +340,8 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            copy_to_shard(user)
+            get_cache()['user-search'].invalidate()
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -113,7 +355,8 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
+@rate_limited
 def login():
     """Handle user login and redirect to homepage on success."""
 
@@ -134,14 +377,14 @@ def login():
 
     return render_template('users/login.html', form=form)
 
-@app.post('/logout')
+@views.post('/logout')
 def logout():
     """Handle logout of user and redirect to homepage."""
 
     if g.csrf_form.validate_on_submit():
         do_logout()
         flash('Successfully logged out.', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
 
     flash("Access unauthorized.", "danger")
     return redirect("/")
@@ -150,7 +393,8 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@views.get('/users')
+@read_from_replica
 @login_required
 def list_users():
     """Page with listing of users.
@@ -159,7 +403,7 @@ def list_users():
     """
 
     search = request.args.get('q')
-    blocked_by_ids = [user.id for user in g.user.blockers]
+    blocked_by_ids = g.user.blocker_ids()
 
     if not search:
         users = (User
@@ -167,63 +411,84 @@ def list_users():
                     .filter(User.id.not_in(blocked_by_ids))
                     .all())
     else:
+        # A substring match can't use an index, so remember what it found.
+        user_ids = get_cache()['user-search'].get_or_set(search, lambda: list(
+            db.session.scalars(
+                select(User.id).filter(User.username.like(f"%{search}%")))))
+
         users = (User
                     .query
                     .filter(and_(
-                        User.username.like(f"%{search}%"),
+                        User.id.in_(user_ids),
                         User.id.not_in(blocked_by_ids)),)
                     .all()
                 )
 
-    return render_template('users/index.html', users=users)
+    following_ids = g.user.following_ids()
 
+    return render_template('users/index.html', users=users,
+                           following_ids=following_ids)
 
-@app.get('/users/<int:user_id>')
+
+@views.get('/users/<int:user_id>')
+@read_from_replica
 @login_required
 def show_user(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.query.options(*USER_PROFILE).get_or_404(user_id)
 
-    blocked_by_ids = [user.id for user in g.user.blockers]
+    blocked_by_ids = g.user.blocker_ids()
 
     if user.id in blocked_by_ids:
         return (render_template('404.html'), 404)
 
-    return render_template('users/show.html', user=user)
+    liked_message_ids = g.user.liked_message_ids()
+
+    return render_template('users/show.html', user=user,
+                           liked_message_ids=liked_message_ids)
 
 
-@app.get('/users/<int:user_id>/following')
+@views.get('/users/<int:user_id>/following')
+@read_from_replica
 @login_required
 def show_following(user_id):
     """Show list of people this user is following."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.query.options(*USER_FOLLOWING).get_or_404(user_id)
 
-    blocked_by_ids = [user.id for user in g.user.blockers]
+    blocked_by_ids = g.user.blocker_ids()
 
     if user.id in blocked_by_ids:
         return (render_template('404.html'), 404)
 
-    return render_template('users/following.html', user=user)
+    following_ids = g.user.following_ids()
+
+    return render_template('users/following.html', user=user,
+                           following_ids=following_ids)
 
 
-@app.get('/users/<int:user_id>/followers')
+@views.get('/users/<int:user_id>/followers')
+@read_from_replica
 @login_required
 def show_followers(user_id):
     """Show list of followers of this user."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.query.options(*USER_FOLLOWERS).get_or_404(user_id)
 
-    blocked_by_ids = [user.id for user in g.user.blockers]
+    blocked_by_ids = g.user.blocker_ids()
 
     if user.id in blocked_by_ids:
         return (render_template('404.html'), 404)
 
-    return render_template('users/followers.html', user=user)
+    following_ids = g.user.following_ids()
 
+    return render_template('users/followers.html', user=user,
+                           following_ids=following_ids)
 
-@app.post('/users/follow/<int:follow_id>')
+
+@views.post('/users/follow/<int:follow_id>')
+@rate_limited
 @login_required
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
@@ -235,13 +500,22 @@ def start_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    follow = Follow(user_being_followed_id=followed_user.id,
+                    user_following_id=g.user.id)
+    db.session.merge(follow)
+    record_event('created', follow)
     db.session.commit()
+    forget('profile-counts', g.user.id, followed_user.id)
+    forget('feed', g.user.id)
+
+    if wants_json():
+        return jsonify(user_id=followed_user.id, following=True)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@views.post('/users/stop-following/<int:follow_id>')
+@rate_limited
 @login_required
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
@@ -253,14 +527,27 @@ def stop_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
+    follow = Follow(user_being_followed_id=followed_user.id,
+                    user_following_id=g.user.id)
+    (Follow
+        .query
+        .filter_by(user_being_followed_id=follow.user_being_followed_id,
+                   user_following_id=follow.user_following_id)
+        .delete())
+    record_event('deleted', follow)
     db.session.commit()
+    forget('profile-counts', g.user.id, followed_user.id)
+    forget('feed', g.user.id)
 
-    return redirect(url_for('show_following', user_id=g.user.id))
+    if wants_json():
+        return jsonify(user_id=followed_user.id, following=False)
+
+    return redirect(url_for('.show_following', user_id=g.user.id))
     # return redirect(f"/users/{g.user.id}/following")
 
 
-@app.post('/users/block/<int:block_id>')
+@views.post('/users/block/<int:block_id>')
+@rate_limited
 @login_required
 def start_block(block_id):
     """Add a blocked user for the currently-logged-in user.
@@ -273,18 +560,33 @@ def start_block(block_id):
         return redirect("/")
 
     blocked_user = User.query.get_or_404(block_id)
-    g.user.blocking.append(blocked_user)
-    db.session.commit()
-
-    if g.user in  blocked_user.following:
-        blocked_user.following.remove(g.user)
+    block = Block(user_being_blocked_id=blocked_user.id,
+                  user_blocking_id=g.user.id)
+    db.session.merge(block)
+    record_event('created', block)
+
+    # They can no longer follow us.
+    follow = Follow(user_being_followed_id=g.user.id,
+                    user_following_id=blocked_user.id)
+    if (Follow
+            .query
+            .filter_by(user_being_followed_id=follow.user_being_followed_id,
+                       user_following_id=follow.user_following_id)
+            .delete()):
+        record_event('deleted', follow)
 
     db.session.commit()
+    forget('profile-counts', g.user.id, blocked_user.id)
+    forget('feed', blocked_user.id)
+
+    if wants_json():
+        return jsonify(user_id=blocked_user.id, blocking=True)
 
     return redirect(f"/users/{blocked_user.id}")
 
 
-@app.post('/users/stop-blocking/<int:block_id>')
+@views.post('/users/stop-blocking/<int:block_id>')
+@rate_limited
 @login_required
 def stop_blocking(block_id):
     """Have currently-logged-in-user stop blocking this user.
@@ -296,13 +598,23 @@ def stop_blocking(block_id):
         return redirect("/")
 
     blocked_user = User.query.get_or_404(block_id)
-    g.user.blocking.remove(blocked_user)
+    block = Block(user_being_blocked_id=blocked_user.id,
+                  user_blocking_id=g.user.id)
+    (Block
+        .query
+        .filter_by(user_being_blocked_id=block.user_being_blocked_id,
+                   user_blocking_id=block.user_blocking_id)
+        .delete())
+    record_event('deleted', block)
     db.session.commit()
 
+    if wants_json():
+        return jsonify(user_id=blocked_user.id, blocking=False)
+
     return redirect(f"/users/{blocked_user.id}")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@views.route('/users/profile', methods=["GET", "POST"])
 @login_required
 def profile():
     """Update profile for current user."""
@@ -310,6 +622,8 @@ def profile():
     form = UpdateUserForm(obj=g.user)
 
     if form.validate_on_submit():
+        load_user_for_update()
+
         if User.authenticate(g.user.username, form.password.data):
             try:
                 g.user.username = form.username.data
@@ -318,8 +632,12 @@ def profile():
                 g.user.header_image_url = form.header_image_url.data or DEFAULT_HEADER_IMAGE_URL
                 g.user.bio = form.bio.data
                 g.user.location = form.location.data
+                g.user.bump_version()
 
                 db.session.commit()
+                copy_to_shard(g.user)
+                forget('users', g.user.id)
+                get_cache()['user-search'].invalidate()
 
             except IntegrityError:
                 db.session.rollback()
@@ -335,11 +653,12 @@ def profile():
     return render_template("users/edit.html", form=form)
 
 
-@app.post('/users/delete')
+@views.post('/users/delete')
 @login_required
 def delete_user():
     """Delete user.
 
+    The account disappears immediately; purge.py removes its rows later.
     Redirect to signup page.
     """
 
@@ -349,34 +668,43 @@ def delete_user():
 
     do_logout()
 
-    Message.query.filter(Message.user_id == g.user.id).delete()
-    db.session.commit()
-
-    db.session.delete(g.user)
+    load_user_for_update().tombstone()
     db.session.commit()
+    copy_to_shard(g.user)
+    forget('users', g.user.id)
+    get_cache()['user-search'].invalidate()
 
     return redirect("/signup")
 
 
-@app.get('/users/<int:user_id>/likes')
+@views.get('/users/<int:user_id>/likes')
+@read_from_replica
 @login_required
 def show_user_likes(user_id):
     """Shows page of user likes"""
 
-    user = User.query.get_or_404(user_id)
+    user = (User
+                .query
+                .options(*LIKED_MESSAGES)
+                .filter_by(id=user_id)
+                .first_or_404())
 
-    blocked_by_ids = [user.id for user in g.user.blockers]
+    blocked_by_ids = g.user.blocker_ids()
 
     if user.id in blocked_by_ids:
         return (render_template('404.html'), 404)
 
-    return render_template('users/likes.html', user=user)
+    liked_message_ids = g.user.liked_message_ids()
+
+    return render_template('users/likes.html', user=user,
+                           liked_message_ids=liked_message_ids)
 
 
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@views.route('/messages/new', methods=["GET", "POST"])
+@rate_limited
 @login_required
 def add_message():
     """Add a message:
@@ -389,21 +717,36 @@ def add_message():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        record_event('created', msg)
         db.session.commit()
+        forget('profile-counts', g.user.id)
+        forget('feed', g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/create.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+@views.get('/messages/<int:message_id>')
+@read_from_replica
 @login_required
 def show_message(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
+    msg = (Message
+            .query
+            .options(*MESSAGE_DETAIL)
+            .filter_by(id=message_id)
+            .first())
 
-    blocked_by_ids = [user.id for user in g.user.blockers]
+    if msg is None:
+        msg = (ArchivedMessage
+                .query
+                .options(*ARCHIVED_MESSAGE_DETAIL)
+                .filter_by(id=message_id)
+                .first_or_404())
+
+    blocked_by_ids = g.user.blocker_ids()
 
     if msg.user_id in blocked_by_ids:
         return (render_template('404.html'), 404)
@@ -411,7 +754,7 @@ def show_message(message_id):
     return render_template('messages/show.html', message=msg)
 
 
-@app.post('/messages/<int:message_id>/delete')
+@views.post('/messages/<int:message_id>/delete')
 @login_required
 def delete_message(message_id):
     """Delete a message.
@@ -427,11 +770,15 @@ def delete_message(message_id):
         return redirect("/")
 
     db.session.delete(msg)
+    record_event('deleted', msg)
     db.session.commit()
+    forget('profile-counts', g.user.id)
+    forget('feed', g.user.id)
 
     return redirect(f"/users/{g.user.id}")
 
-@app.post('/messages/<int:message_id>/like')
+@views.post('/messages/<int:message_id>/like')
+@rate_limited
 @login_required
 def like_message(message_id):
     """Like or unlike a message depending if the user has already liked or not"""
@@ -444,13 +791,26 @@ def like_message(message_id):
 
     msg = Message.query.get_or_404(message_id)
 
-    if msg in g.user.likes:
-        g.user.likes.remove(msg)
+    like = Like(message_id=msg.id, user_id=g.user.id)
+    liked = db.session.get(Like, (msg.id, g.user.id)) is None
+
+    if liked:
+        db.session.add(like)
+        record_event('created', like)
+        db.session.commit()
+        forget('profile-counts', g.user.id)
 
     else:
-        g.user.likes.append(msg)
+        (Like
+            .query
+            .filter_by(message_id=like.message_id, user_id=like.user_id)
+            .delete())
+        record_event('deleted', like)
+        db.session.commit()
+        forget('profile-counts', g.user.id)
 
-    db.session.commit()
+    if wants_json():
+        return jsonify(message_id=like.message_id, liked=liked)
 
     return redirect(f'{current_url}')
 
@@ -459,7 +819,9 @@ def like_message(message_id):
 # Homepage and error pages
 
 
-@app.get('/')
+@views.get('/')
+@read_from_replica
+@public_when_anonymous
 def homepage():
     """Show homepage:
 
@@ -468,24 +830,168 @@ def homepage():
     """
 
     if g.user:
-        following_ids = [user.id for user in g.user.following] + [g.user.id]
+        following_ids = [*g.user.following_ids(), g.user.id]
+        liked_message_ids = g.user.liked_message_ids()
+        shards = get_shards()
+
+        # Shards get writes from the outbox worker a little later, so a user
+        # who just wrote reads the primary, as with replicas.
+        if shards and not wrote_recently():
+            messages = shards.recent_messages(following_ids, 100)
+            return render_template('home.html', messages=messages,
+                                   liked_message_ids=liked_message_ids)
+
+        # With partitioned messages, a lower bound lets Postgres skip old
+        # partitions entirely.
+        max_age_days = current_app.config['FEED_MAX_AGE_DAYS']
+        oldest = (datetime.utcnow() - timedelta(days=max_age_days)
+                  if max_age_days else None)
+
+        def feed_message_ids():
+            query = select(Message.id).filter(Message.user_id.in_(following_ids))
+            if oldest:
+                query = query.filter(Message.timestamp >= oldest)
+
+            return list(db.session.scalars(
+                query.order_by(Message.timestamp.desc()).limit(100)))
+
+        message_ids = shared_cache('feed', g.user.id, feed_message_ids)
+
         messages = (Message
                     .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+                    .options(*FEED)
+                    .filter(Message.id.in_(message_ids)))
 
-        return render_template('home.html', messages=messages)
+        if oldest:
+            messages = messages.filter(Message.timestamp >= oldest)
+
+        messages = messages.order_by(Message.timestamp.desc()).all()
+
+        return render_template('home.html', messages=messages,
+                               liked_message_ids=liked_message_ids)
 
     else:
         return render_template('home-anon.html')
 
 
-@app.after_request
+@views.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Set caching headers for pages.
+
+    Static files set their own (see assets.py). Pages for logged-in users are
+    never stored. Views marked @public_when_anonymous may be kept briefly by
+    shared caches when served to a logged-out visitor, unless serving them
+    changed the session (a flashed message, say). Anything else can be
+    stored by the browser, but must be revalidated before it's reused.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if request.endpoint == 'static':
+        return response
+
+    view = current_app.view_functions.get(request.endpoint)
+
+    if g.get('user') or request.authorization:
+        response.cache_control.no_store = True
+    elif (getattr(view, 'public_when_anonymous', False)
+            and request.method == 'GET'
+            and response.status_code == 200
+            and not session.modified):
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['PUBLIC_PAGE_MAX_AGE']
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
     return response
+
+
+##############################################################################
+# Operational endpoints
+
+
+@views.get('/metrics')
+@metrics_token_required
+def show_metrics():
+    """Serve request, database, template and cache metrics to Prometheus."""
+
+    data, content_type = render_metrics()
+    return data, 200, {'Content-Type': content_type}
+
+
+@views.get('/metrics/pool')
+@metrics_token_required
+def show_pool_stats():
+    """Show connection pool usage for each database this worker talks to."""
+
+    return {
+        bind or 'primary': pool_stats(engine)
+        for bind, engine in db.engines.items()
+    }
+
+
+@views.get('/metrics/cache')
+@metrics_token_required
+def show_cache_stats():
+    """Show this worker's cache hits and misses, per namespace."""
+
+    stats = get_cache().stats()
+
+    fragments = get_fragment_cache()
+    if fragments:
+        lookups = fragments.hits + fragments.misses
+        stats['fragments'] = {
+            'hits': fragments.hits,
+            'misses': fragments.misses,
+            'hit_rate': round(fragments.hits / lookups, 4) if lookups else None,
+        }
+
+    return stats
+
+
+@views.get('/metrics/profiles')
+@metrics_token_required
+def show_profiles():
+    """Show how many stack samples each endpoint has."""
+
+    return {
+        endpoint: sum(stacks.values())
+        for endpoint, stacks in read_stacks(get_profiles().directory).items()
+    }
+
+
+@views.get('/metrics/profiles/<endpoint>')
+@metrics_token_required
+def show_profile(endpoint):
+    """Serve an endpoint's samples as collapsed stacks, for flame graphs."""
+
+    stacks = read_stacks(get_profiles().directory, endpoint).get(endpoint, {})
+    lines = "".join(f"{stack} {count}\n" for stack, count in stacks.items())
+
+    return lines, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
+@views.get('/metrics/profiles/<endpoint>/top')
+@metrics_token_required
+def show_profile_top(endpoint):
+    """Show the functions an endpoint spends most of its samples in."""
+
+    stacks = read_stacks(get_profiles().directory, endpoint).get(endpoint, {})
+
+    return jsonify(top_functions(stacks, request.args.get('limit', 20, type=int)))
+
+
+@views.get('/metrics/memory')
+@metrics_token_required
+def show_memory():
+    """Show what each endpoint allocated, with MEMORY_TRACE on."""
+
+    return get_allocations().report(request.args.get('limit', 10, type=int))
+
+
+@views.get('/metrics/jobs')
+@metrics_token_required
+def show_job_stats():
+    """Show background jobs per task and status, and their run times."""
+
+    return job_stats()
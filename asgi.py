@@ -0,0 +1,408 @@
+"""Serve Warbler over ASGI, with async handlers for read-heavy endpoints.
+
+    uvicorn --factory asgi:create_asgi_app --workers 4
+
+Every page is still served by the Flask app, unchanged, in a thread pool.
+The endpoints below are handled on the event loop instead, querying Postgres
+through an async SQLAlchemy engine (asyncpg), so one worker can hold many of
+them in flight while they wait on the database:
+
+    GET /api/feed           the logged-in user's home feed, as JSON
+    GET /api/users/<id>     a user's profile and recent warbles, as JSON
+    GET /api/feed/events    new warbles in the home feed as server-sent
+                            events, checked every FEED_EVENTS_POLL_SECONDS;
+                            a reconnecting client resumes after Last-Event-ID
+
+They read the Flask app's session cookie, and go to DATABASE_REPLICA_URL
+when one is set, the way pages marked @read_from_replica do.
+"""
+
+import asyncio
+import json
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from http.cookies import SimpleCookie
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from itsdangerous import BadSignature
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import NullPool
+
+from app import CURR_USER_KEY, create_app
+from loading import FEED
+from models import Block, Follow, Like, Message, User
+from pooling import engine_options
+from replicas import LAST_WRITE_KEY, REPLICA_BIND
+
+FEED_LIMIT = 100
+FEED_EVENTS_POLL_SECONDS = 2.0
+HEARTBEAT_SECONDS = 15.0
+
+
+def create_asgi_app(config=None):
+    """Build the Flask app with create_app(config) and serve it over ASGI."""
+
+    return AsyncWarbler(create_app(config))
+
+
+def async_database_url(url):
+    """`url` with Postgres's asyncio driver, asyncpg."""
+
+    url = make_url(url)
+
+    if url.get_backend_name() != 'postgresql':
+        raise RuntimeError("The async endpoints need Postgres.")
+
+    return url.set(drivername='postgresql+asyncpg')
+
+
+def async_engine_options(url, environ):
+    """The pool settings engine_options() gives `url`, for an async engine.
+
+    Async engines need an async-compatible pool, so the metered pool is left
+    for SQLAlchemy to replace with its own; PgBouncer's NullPool is kept.
+
+    Behind PgBouncer in transaction mode, a statement asyncpg prepared on
+    one server connection may run on another, so prepared statements aren't
+    cached and each gets a unique name.
+    """
+
+    options = engine_options(url, environ)
+
+    if options.get('poolclass') is not NullPool:
+        options.pop('poolclass', None)
+
+    elif environ.get('DB_PGBOUNCER') == '1':
+        options['connect_args'] = {
+            'prepared_statement_cache_size': 0,
+            'statement_cache_size': 0,
+            'prepared_statement_name_func': _prepared_statement_name,
+        }
+
+    return options
+
+
+def _prepared_statement_name():
+    return f"__asyncpg_{uuid4()}__"
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi that runs requests on the event loop's thread pool.
+
+    Plain WsgiToAsgi runs every request on one shared thread, so the Flask
+    app would serve one request at a time.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await _ThreadPoolWsgiInstance(self.wsgi_application)(scope, receive, send)
+
+
+class _ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+                                 thread_sensitive=False)
+
+
+class AsyncWarbler:
+    """ASGI app: the async endpoints, and `flask_app` for everything else."""
+
+    def __init__(self, flask_app):
+        flask_app.config.setdefault('FEED_EVENTS_POLL_SECONDS',
+                                    FEED_EVENTS_POLL_SECONDS)
+
+        self.flask_app = flask_app
+        self.wsgi = ThreadPoolWsgiToAsgi(flask_app)
+        self.engines = {}
+
+        self.routes = [
+            (re.compile(r'/api/feed'), self.feed),
+            (re.compile(r'/api/feed/events'), self.feed_events),
+            (re.compile(r'/api/users/(\d+)'), self.user),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            for pattern, handler in self.routes:
+                match = pattern.fullmatch(scope['path'])
+
+                if match:
+                    return await self.authenticated(
+                        handler, scope, receive, send, *map(int, match.groups()))
+
+        return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def aclose(self):
+        """Close the async engines' connections."""
+
+        engines, self.engines = self.engines, {}
+
+        for engine in engines.values():
+            await engine.dispose()
+
+    def engine(self, bind=None):
+        """The async engine for the primary database, or for `bind`.
+
+        Engines are made on first use, inside the worker's event loop.
+        """
+
+        if bind not in self.engines:
+            config = self.flask_app.config
+            url = (config['SQLALCHEMY_BINDS'][bind]['url'] if bind
+                   else config['SQLALCHEMY_DATABASE_URI'])
+            self.engines[bind] = create_async_engine(
+                async_database_url(url), **async_engine_options(url, os.environ))
+
+        return self.engines[bind]
+
+    def session(self, flask_session):
+        """An async session reading from the replica if there is one and this
+        user hasn't written recently."""
+
+        config = self.flask_app.config
+        last_write = flask_session.get(LAST_WRITE_KEY, 0)
+
+        if (REPLICA_BIND in config.get('SQLALCHEMY_BINDS', {})
+                and time.time() - last_write >= config['REPLICA_STICKY_SECONDS']):
+            return AsyncSession(self.engine(REPLICA_BIND))
+
+        return AsyncSession(self.engine())
+
+    def flask_session(self, scope):
+        """The Flask session stored in the request's cookie, or {}."""
+
+        cookies = SimpleCookie()
+
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookies.load(value.decode('latin-1'))
+
+        cookie = cookies.get(self.flask_app.config['SESSION_COOKIE_NAME'])
+
+        if cookie is None:
+            return {}
+
+        serializer = self.flask_app.session_interface.get_signing_serializer(
+            self.flask_app)
+        max_age = int(self.flask_app.permanent_session_lifetime.total_seconds())
+
+        try:
+            return serializer.loads(cookie.value, max_age=max_age)
+        except BadSignature:
+            return {}
+
+    async def authenticated(self, handler, scope, receive, send, *args):
+        """Call `handler` with a session and the logged-in user's id, or
+        answer 401."""
+
+        flask_session = self.flask_session(scope)
+        user_id = flask_session.get(CURR_USER_KEY)
+
+        if user_id is not None:
+            async with self.session(flask_session) as session:
+                if await session.get(User, user_id) is None:
+                    user_id = None
+
+        if user_id is None:
+            return await send_json(send, {'error': "Access unauthorized."}, 401)
+
+        await handler(scope, receive, send, flask_session, user_id, *args)
+
+    async def feed(self, scope, receive, send, flask_session, user_id):
+        async with self.session(flask_session) as session:
+            user_ids = await feed_user_ids(session, user_id)
+            messages = (await session.scalars(
+                self.feed_query(user_ids)
+                .order_by(Message.timestamp.desc())
+                .limit(FEED_LIMIT))).all()
+            liked = await liked_message_ids(session, user_id, messages)
+
+        await send_json(send, {
+            'messages': [message_json(msg, liked) for msg in messages],
+        })
+
+    async def user(self, scope, receive, send, flask_session, viewer_id, user_id):
+        async with self.session(flask_session) as session:
+            user = await session.get(User, user_id)
+
+            if user is None or await session.scalar(
+                    select(Block.user_blocking_id)
+                    .where(Block.user_blocking_id == user_id,
+                           Block.user_being_blocked_id == viewer_id)):
+                return await send_json(send, {'error': "Not found."}, 404)
+
+            messages = (await session.scalars(
+                select(Message)
+                .options(*FEED)
+                .where(Message.user_id == user_id)
+                .order_by(Message.timestamp.desc())
+                .limit(FEED_LIMIT))).all()
+            liked = await liked_message_ids(session, viewer_id, messages)
+
+        await send_json(send, {
+            'id': user.id,
+            'username': user.username,
+            'image_url': user.image_url,
+            'header_image_url': user.header_image_url,
+            'bio': user.bio,
+            'location': user.location,
+            'messages': [message_json(msg, liked) for msg in messages],
+        })
+
+    async def feed_events(self, scope, receive, send, flask_session, user_id):
+        poll_seconds = self.flask_app.config['FEED_EVENTS_POLL_SECONDS']
+        last_id = last_event_id(scope)
+
+        if last_id is None:
+            # Start from what's in the feed now.
+            async with self.session(flask_session) as session:
+                last_id = await session.scalar(
+                    select(func.max(Message.id))
+                    .where(Message.user_id.in_(
+                        await feed_user_ids(session, user_id)))) or 0
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-store'),
+                # Don't let nginx hold events back.
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+
+        disconnected = asyncio.Event()
+
+        async def watch_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.create_task(watch_for_disconnect())
+        idle_seconds = 0.0
+
+        try:
+            while not disconnected.is_set():
+                async with self.session(flask_session) as session:
+                    # Looked up each time so new follows show up.
+                    user_ids = await feed_user_ids(session, user_id)
+                    messages = (await session.scalars(
+                        self.feed_query(user_ids)
+                        .where(Message.id > last_id)
+                        .order_by(Message.id)
+                        .limit(FEED_LIMIT))).all()
+                    liked = await liked_message_ids(session, user_id, messages)
+
+                events = ''.join(
+                    f"id: {msg.id}\nevent: warble\n"
+                    f"data: {json.dumps(message_json(msg, liked))}\n\n"
+                    for msg in messages)
+
+                if messages:
+                    last_id = messages[-1].id
+                    idle_seconds = 0.0
+                elif idle_seconds >= HEARTBEAT_SECONDS:
+                    events = ": keep-alive\n\n"
+                    idle_seconds = 0.0
+
+                if events:
+                    await send({'type': 'http.response.body',
+                                'body': events.encode(), 'more_body': True})
+
+                try:
+                    await asyncio.wait_for(disconnected.wait(), poll_seconds)
+                except asyncio.TimeoutError:
+                    idle_seconds += poll_seconds
+        finally:
+            watcher.cancel()
+
+    def feed_query(self, user_ids):
+        """Messages in a feed of `user_ids`' warbles, as on the homepage."""
+
+        query = (select(Message)
+                 .options(*FEED)
+                 .where(Message.user_id.in_(user_ids)))
+
+        max_age_days = self.flask_app.config['FEED_MAX_AGE_DAYS']
+        if max_age_days:
+            oldest = datetime.utcnow() - timedelta(days=max_age_days)
+            query = query.where(Message.timestamp >= oldest)
+
+        return query
+
+
+async def feed_user_ids(session, user_id):
+    """Ids of the users whose warbles are in `user_id`'s feed."""
+
+    followed = await session.scalars(
+        select(Follow.user_being_followed_id)
+        .where(Follow.user_following_id == user_id))
+
+    return [*followed, user_id]
+
+
+async def liked_message_ids(session, user_id, messages):
+    """Ids of those of `messages` that `user_id` likes."""
+
+    return set(await session.scalars(
+        select(Like.message_id)
+        .where(Like.user_id == user_id,
+               Like.message_id.in_([msg.id for msg in messages]))))
+
+
+def message_json(msg, liked_message_ids):
+    return {
+        'id': msg.id,
+        'text': msg.text,
+        'timestamp': msg.timestamp.isoformat(),
+        'liked': msg.id in liked_message_ids,
+        'user': {
+            'id': msg.user.id,
+            'username': msg.user.username,
+            'image_url': msg.user.image_url,
+        },
+    }
+
+
+def last_event_id(scope):
+    """The Last-Event-ID a reconnecting event stream sent, or None."""
+
+    for name, value in scope['headers']:
+        if name == b'last-event-id' and value.isdigit():
+            return int(value)
+
+    return None
+
+
+async def send_json(send, body, status=200):
+    data = json.dumps(body).encode()
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(data)).encode()),
+            (b'cache-control', b'no-store'),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': data})
@@ -0,0 +1,148 @@
+"""Content-hashed URLs for static files.
+
+At startup every file under the static folder is hashed, and
+url_for('static', filename='stylesheets/style.css') then gives
+/static/stylesheets/style.<hash>.css. A hashed URL always names the same
+bytes, so it is served with a year-long immutable Cache-Control and browsers
+never ask for it again; a changed file gets a new URL. `/static/...` paths
+inside stylesheets are rewritten to hashed URLs too.
+
+Files of a compressible type are compressed once, here, at the highest
+settings, and served pre-compressed to clients that accept it.
+
+Plain, unhashed paths (old links, /static/favicon.ico requested by browsers
+on their own) still work, cached for STATIC_MAX_AGE seconds.
+
+Hashes are computed once, so with ASSET_HASHING on, edits to static files
+show up after a restart. It defaults to off in debug mode.
+"""
+
+import hashlib
+import mimetypes
+import os
+import re
+
+from flask import Response, current_app, request, send_from_directory
+
+from compression import COMPRESS_MIMETYPES, choose_encoding, compress, encodings
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+STATIC_MAX_AGE = 60 * 60
+
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+
+# url("/static/...") in a stylesheet.
+CSS_STATIC_URL = re.compile(r"""url\((["']?)/static/([^"')]+)\1\)""")
+
+
+class AssetManifest:
+    """Maps static filenames to hashed filenames and back."""
+
+    def __init__(self, static_folder, compress_mimetypes=COMPRESS_MIMETYPES):
+        self.static_folder = static_folder
+        self.compress_mimetypes = compress_mimetypes
+        self.hashed = {}
+        # hashed filename -> (filename, body or None to send from disk,
+        # {encoding: compressed body})
+        self.files = {}
+
+        filenames = sorted(
+            os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+            for root, _, names in os.walk(static_folder)
+            for name in names
+        )
+
+        # Stylesheets go last so they can refer to everything else's hash.
+        for filename in sorted(filenames, key=lambda name: name.endswith('.css')):
+            with open(os.path.join(static_folder, filename), 'rb') as static_file:
+                body = static_file.read()
+
+            if filename.endswith('.css'):
+                body = CSS_STATIC_URL.sub(self._rewrite_url, body.decode()).encode()
+
+            self._add(filename, body)
+
+    def _add(self, filename, body):
+        stem, ext = os.path.splitext(filename)
+        hashed = f"{stem}.{hashlib.sha256(body).hexdigest()[:12]}{ext}"
+
+        if mimetypes.guess_type(filename)[0] in self.compress_mimetypes:
+            compressed = {
+                encoding: compress(body, encoding, STATIC_GZIP_LEVEL,
+                                   STATIC_BROTLI_QUALITY)
+                for encoding in encodings()
+            }
+            self.files[hashed] = (filename, body, compressed)
+        elif filename.endswith('.css'):
+            self.files[hashed] = (filename, body, {})
+        else:
+            self.files[hashed] = (filename, None, {})
+
+        self.hashed[filename] = hashed
+
+    def _rewrite_url(self, match):
+        quote, filename = match.groups()
+        return f"url({quote}/static/{self.hashed.get(filename, filename)}{quote})"
+
+
+def init_assets(app):
+    """Serve `app`'s static files under content-hashed URLs."""
+
+    app.config.setdefault('ASSET_HASHING', not app.debug)
+    app.config.setdefault('STATIC_MAX_AGE', STATIC_MAX_AGE)
+
+    if not app.config['ASSET_HASHING'] or not app.has_static_folder:
+        return
+
+    app.extensions['assets'] = AssetManifest(
+        app.static_folder, app.config.get('COMPRESS_MIMETYPES', COMPRESS_MIMETYPES))
+    app.url_defaults(_hashed_static_url)
+    app.view_functions['static'] = _serve_static
+
+
+def _hashed_static_url(endpoint, values):
+    """Point url_for('static', ...) at the hashed filename."""
+
+    if endpoint == 'static' and 'filename' in values:
+        hashed = current_app.extensions['assets'].hashed
+        values['filename'] = hashed.get(values['filename'], values['filename'])
+
+
+def _serve_static(filename):
+    """Serve a static file, forever if it was requested by its hash."""
+
+    manifest = current_app.extensions['assets']
+    asset = manifest.files.get(filename)
+
+    if asset is None:
+        return send_from_directory(manifest.static_folder, filename,
+                                   max_age=current_app.config['STATIC_MAX_AGE'])
+
+    source, body, compressed = asset
+
+    if body is None:
+        response = send_from_directory(manifest.static_folder, source,
+                                       max_age=IMMUTABLE_MAX_AGE)
+    else:
+        encoding = choose_encoding(request.accept_encodings)
+
+        if encoding in compressed:
+            response = Response(compressed[encoding],
+                                mimetype=mimetypes.guess_type(source)[0])
+            response.headers['Content-Encoding'] = encoding
+            response.set_etag(f"{filename}-{encoding}")
+        else:
+            response = Response(body, mimetype=mimetypes.guess_type(source)[0])
+            response.set_etag(filename)
+
+        if compressed:
+            response.vary.add('Accept-Encoding')
+
+        response.make_conditional(request)
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+
+    return response
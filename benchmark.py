@@ -0,0 +1,355 @@
+"""Time Warbler's main routes against a seeded dataset.
+
+`run` seeds a dedicated database from a generator profile, then sends each
+route in ROUTES through the Flask test client as a logged-in user. It records
+wall time, SQL statements per request and peak Python memory per request,
+and writes them to a JSON file, along with how long a fresh process takes to
+import and build the app (see startup.py). `compare` diffs two such files
+and exits non-zero when a route or startup got slower, a route ran more
+queries or used more memory than the thresholds allow:
+
+    python benchmark.py run --out benchmark.json
+    python benchmark.py compare benchmark_baseline.json benchmark.json
+
+`run` drops and recreates every table in --database-url, so point it at a
+database used only for benchmarks.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from sqlalchemy import event, exists, func, select
+from sqlalchemy.engine import Engine
+
+from replay import percentile
+from startup import measure_startup
+
+DEFAULT_DATABASE_URL = 'postgresql:///warbler_bench'
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+ITERATIONS = 20
+WARMUP = 3
+
+# Allowed growth before compare reports a regression. Times and memory must
+# also grow by at least the MIN_* amounts, so noise on tiny numbers doesn't
+# count; any extra query does.
+TIME_THRESHOLD = 0.25
+MEMORY_THRESHOLD = 0.25
+MIN_MS = 1.0
+MIN_KIB = 64
+
+# Each route is (send the request, undo its effect or None). `ids` comes
+# from pick_ids(). Writes run last so reads see the seeded data.
+ROUTES = {
+    'home': (lambda client, ids: client.get('/'), None),
+    'profile': (lambda client, ids: client.get(f"/users/{ids['subject']}"), None),
+    'followers': (
+        lambda client, ids: client.get(f"/users/{ids['subject']}/followers"), None),
+    'likes': (lambda client, ids: client.get(f"/users/{ids['viewer']}/likes"), None),
+    'search': (
+        lambda client, ids: client.get('/users', query_string={'q': ids['search']}),
+        None),
+    # Alternately likes and unlikes the same message.
+    'like_toggle': (
+        lambda client, ids: client.post(f"/messages/{ids['message']}/like"), None),
+    'follow': (
+        lambda client, ids: client.post(f"/users/follow/{ids['follow_target']}"),
+        lambda client, ids: client.post(
+            f"/users/stop-following/{ids['follow_target']}")),
+    'post': (
+        lambda client, ids: client.post('/messages/new',
+                                        data={'text': 'Benchmark warble'}),
+        None),
+}
+
+
+def seed_dataset(profile, seed=0, report=print):
+    """Replace every table's rows with a generated `profile` dataset."""
+
+    from bulk_load import load_csvs
+    from models import db, User, Message, Follow, Like, Block
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        subprocess.run([sys.executable, GENERATOR, '--profile', profile,
+                        '--seed', str(seed), '--out-dir', out_dir], check=True)
+
+        db.drop_all()
+        db.create_all()
+
+        load_csvs(db.engine, [
+            (table, os.path.join(out_dir, f"{table.name}.csv"))
+            for table in [User.__table__, Message.__table__, Follow.__table__,
+                          Like.__table__, Block.__table__]
+        ], report=report)
+
+
+def pick_ids():
+    """Ids for the routes to use.
+
+    The subject is the most followed user; the viewer is the follower of
+    theirs who follows the most people and isn't blocked by them.
+    """
+
+    from models import db, User, Message, Follow, Block
+
+    followers = func.count(Follow.user_following_id)
+    subject = db.session.execute(
+        select(Follow.user_being_followed_id)
+        .group_by(Follow.user_being_followed_id)
+        .order_by(followers.desc(), Follow.user_being_followed_id)
+        .limit(1)
+    ).scalar_one()
+
+    def blocks(blocker, blocked):
+        return exists().where(Block.user_blocking_id == blocker,
+                              Block.user_being_blocked_id == blocked)
+
+    def follows(follower, followed):
+        return exists().where(Follow.user_following_id == follower,
+                              Follow.user_being_followed_id == followed)
+
+    following = (select(func.count())
+                 .where(Follow.user_following_id == User.id)
+                 .scalar_subquery())
+    viewer = db.session.execute(
+        select(User.id)
+        .where(follows(User.id, subject), ~blocks(subject, User.id))
+        .order_by(following.desc(), User.id)
+        .limit(1)
+    ).scalar_one()
+
+    follow_target = db.session.execute(
+        select(User.id)
+        .where(User.id != viewer, ~follows(viewer, User.id),
+               ~blocks(User.id, viewer))
+        .order_by(User.id)
+        .limit(1)
+    ).scalar_one()
+
+    message = db.session.execute(
+        select(Message.id)
+        .where(Message.user_id == subject)
+        .order_by(Message.timestamp.desc())
+        .limit(1)
+    ).scalar_one()
+
+    username = db.session.get(User, subject).username
+
+    return dict(viewer=viewer, subject=subject, follow_target=follow_target,
+                message=message, search=username[:3])
+
+
+@contextmanager
+def counting_queries():
+    """Count SQL statements sent by any engine inside the block."""
+
+    counter = {'queries': 0}
+
+    def count(*args):
+        counter['queries'] += 1
+
+    event.listen(Engine, 'before_cursor_execute', count)
+    try:
+        yield counter
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count)
+
+
+def measure(client, ids, send, undo=None, iterations=ITERATIONS, warmup=WARMUP):
+    """Time `iterations` calls of send(client, ids).
+
+    Returns p50, p95 and mean milliseconds, the most queries any one request
+    made, and the peak KiB of Python memory allocated during one request.
+    """
+
+    from models import db
+
+    def call():
+        # Requests reuse the app context the caller pushed, and so its
+        # session; start each request from an empty identity map.
+        db.session.remove()
+        response = send(client, ids)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{response.request.path} returned {response.status_code}")
+
+    def reset():
+        if undo:
+            undo(client, ids)
+
+    for _ in range(warmup):
+        call()
+        reset()
+
+    timings = []
+    queries = 0
+
+    for _ in range(iterations):
+        with counting_queries() as counter:
+            start = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - start) * 1000)
+        reset()
+        queries = max(queries, counter['queries'])
+
+    # tracemalloc slows everything down, so memory gets its own pass.
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        call()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    reset()
+
+    timings.sort()
+
+    return {
+        'p50_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'queries': queries,
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def benchmark_app(database_url):
+    """The app to benchmark: CSRF checks and rate limits are off, so every
+    iteration of a write route gets through."""
+
+    from app import create_app
+
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'WTF_CSRF_ENABLED': False,
+        'RATE_LIMITS': {},
+    })
+
+
+def run_benchmarks(app, ids, routes=ROUTES, iterations=ITERATIONS, warmup=WARMUP):
+    """Measure each of `routes` as the user ids['viewer']."""
+
+    from app import CURR_USER_KEY
+
+    results = {}
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = ids['viewer']
+
+        for name, (send, undo) in routes.items():
+            results[name] = measure(client, ids, send, undo, iterations, warmup)
+
+    return results
+
+
+def compare(baseline, current, time_threshold=TIME_THRESHOLD,
+            memory_threshold=MEMORY_THRESHOLD):
+    """List the regressions in `current` against `baseline`, as
+    (route, metric, baseline value, current value) tuples."""
+
+    regressions = []
+
+    for route, new in current['routes'].items():
+        old = baseline['routes'].get(route)
+
+        if old is None:
+            continue
+
+        if (new['p50_ms'] > old['p50_ms'] * (1 + time_threshold)
+                and new['p50_ms'] - old['p50_ms'] >= MIN_MS):
+            regressions.append((route, 'p50_ms', old['p50_ms'], new['p50_ms']))
+
+        if new['queries'] > old['queries']:
+            regressions.append((route, 'queries', old['queries'], new['queries']))
+
+        if (new['peak_kib'] > old['peak_kib'] * (1 + memory_threshold)
+                and new['peak_kib'] - old['peak_kib'] >= MIN_KIB):
+            regressions.append((route, 'peak_kib', old['peak_kib'], new['peak_kib']))
+
+    # Files from before startup was measured have nothing to compare.
+    old, new = baseline.get('startup'), current.get('startup')
+
+    for metric in ['import_ms', 'create_app_ms'] if old and new else []:
+        if (new[metric] > old[metric] * (1 + time_threshold)
+                and new[metric] - old[metric] >= MIN_MS):
+            regressions.append(('startup', metric, old[metric], new[metric]))
+
+    return regressions
+
+
+def report(results, out=print):
+    """Print a table of measured routes."""
+
+    out(f"{'route':<12}  {'p50 ms':>8}  {'p95 ms':>8}  {'queries':>7}  {'peak KiB':>9}")
+
+    for name, stats in results['routes'].items():
+        out(f"{name:<12}  {stats['p50_ms']:>8.2f}  {stats['p95_ms']:>8.2f}  "
+            f"{stats['queries']:>7}  {stats['peak_kib']:>9.1f}")
+
+    startup = results.get('startup')
+    if startup:
+        out(f"\nstartup: import {startup['import_ms']:.1f} ms, "
+            f"create_app {startup['create_app_ms']:.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run')
+    run.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    run.add_argument('--profile', default='small')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--skip-seed', action='store_true')
+    run.add_argument('--iterations', type=int, default=ITERATIONS)
+    run.add_argument('--startup-runs', type=int, default=5)
+    run.add_argument('--out', default='benchmark.json')
+
+    diff = commands.add_parser('compare')
+    diff.add_argument('baseline')
+    diff.add_argument('current')
+    diff.add_argument('--time-threshold', type=float, default=TIME_THRESHOLD)
+    diff.add_argument('--memory-threshold', type=float, default=MEMORY_THRESHOLD)
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        app = benchmark_app(args.database_url)
+
+        with app.app_context():
+            if not args.skip_seed:
+                seed_dataset(args.profile, args.seed)
+
+            results = {
+                'profile': args.profile,
+                'iterations': args.iterations,
+                'routes': run_benchmarks(app, pick_ids(), iterations=args.iterations),
+                'startup': measure_startup(args.startup_runs),
+            }
+
+        with open(args.out, 'w') as out:
+            json.dump(results, out, indent=2)
+
+        report(results)
+
+    else:
+        with open(args.baseline) as baseline, open(args.current) as current:
+            regressions = compare(json.load(baseline), json.load(current),
+                                  args.time_threshold, args.memory_threshold)
+
+        for route, metric, old, new in regressions:
+            print(f"{route}: {metric} {old} -> {new}")
+
+        if regressions:
+            raise SystemExit(f"{len(regressions)} regression(s)")
+
+        print("No regressions.")
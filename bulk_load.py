@@ -0,0 +1,136 @@
+"""Stream CSV files straight into Warbler's tables.
+
+On Postgres each file goes through `COPY ... FROM STDIN`, so rows never pass
+through Python one at a time. Other databases get `executemany` over chunks
+of raw CSV rows inside one transaction per table. Either way the table's
+secondary indexes are dropped first and rebuilt once the rows are in, and
+id sequences are moved past any ids the file supplied.
+
+The CSV header names the columns to fill; columns left out get their
+database defaults.
+"""
+
+import csv
+import time
+
+from sqlalchemy import Integer, String, Text, func, select, text
+
+CHUNK_SIZE = 10_000
+
+
+def load_csv(conn, table, path, chunk_size=CHUNK_SIZE):
+    """Load the CSV file at `path` into `table` over `conn`.
+
+    Returns the number of rows loaded.
+    """
+
+    indexes = list(table.indexes)
+
+    for index in indexes:
+        index.drop(conn, checkfirst=True)
+
+    with open(path, newline='') as csv_file:
+        columns = next(csv.reader([csv_file.readline()]))
+
+        if conn.dialect.name == 'postgresql':
+            rows = _copy(conn, table, columns, csv_file)
+        else:
+            rows = _executemany(conn, table, columns, csv_file, chunk_size)
+
+    for index in indexes:
+        index.create(conn)
+
+    if conn.dialect.name == 'postgresql':
+        _reset_sequence(conn, table)
+
+    return rows
+
+
+def load_csvs(engine, files, report=print, chunk_size=CHUNK_SIZE):
+    """Load each (table, path) pair in `files`, in order.
+
+    Each table loads in its own transaction. Its rows per second are passed
+    to `report`.
+    """
+
+    for table, path in files:
+        start = time.perf_counter()
+
+        with engine.begin() as conn:
+            rows = load_csv(conn, table, path, chunk_size)
+
+        elapsed = time.perf_counter() - start
+        report(f"{table.name}: {rows} rows in {elapsed:.2f}s "
+               f"({rows / elapsed if elapsed else 0:,.0f} rows/s)")
+
+
+def _copy(conn, table, columns, csv_file):
+    """COPY the rest of `csv_file` into `columns` of `table`."""
+
+    # Unquoted empty fields would otherwise load as NULL.
+    text_columns = [
+        name for name in columns
+        if isinstance(table.c[name].type, (String, Text))
+    ]
+    force_not_null = (
+        f", FORCE_NOT_NULL ({', '.join(text_columns)})" if text_columns else "")
+
+    sql = (f"COPY {table.name} ({', '.join(columns)}) "
+           f"FROM STDIN WITH (FORMAT csv{force_not_null})")
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(sql, csv_file)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def _executemany(conn, table, columns, csv_file, chunk_size):
+    """Insert the rest of `csv_file` into `table`, `chunk_size` rows at a
+    time."""
+
+    placeholders = ', '.join(_placeholder(conn.dialect.paramstyle, i)
+                             for i in range(len(columns)))
+    sql = (f"INSERT INTO {table.name} ({', '.join(columns)}) "
+           f"VALUES ({placeholders})")
+
+    reader = csv.reader(csv_file)
+    rows = 0
+
+    while True:
+        chunk = [tuple(row) for _, row in zip(range(chunk_size), reader)]
+
+        if not chunk:
+            return rows
+
+        conn.exec_driver_sql(sql, chunk)
+        rows += len(chunk)
+
+
+def _placeholder(paramstyle, position):
+    if paramstyle == 'qmark':
+        return '?'
+    if paramstyle == 'numeric':
+        return f':{position + 1}'
+    return '%s'
+
+
+def _reset_sequence(conn, table):
+    """Point `table`'s id sequence past the largest id now in the table."""
+
+    key = list(table.primary_key.columns)
+
+    if len(key) != 1 or not isinstance(key[0].type, Integer):
+        return
+
+    sequence = conn.execute(select(func.pg_get_serial_sequence(
+        table.name, key[0].name))).scalar()
+
+    if sequence:
+        conn.execute(
+            text("SELECT setval(:sequence, "
+                 f"(SELECT COALESCE(MAX({key[0].name}), 0) + 1 FROM {table.name}), "
+                 "false)"),
+            {'sequence': sequence},
+        )
@@ -0,0 +1,366 @@
+"""A small cache layer for hot reads.
+
+Values live in a backend chosen by CACHE_URL:
+
+    memory://               this process only: an LRU of CACHE_SIZE entries
+                            that also honours each entry's TTL (the default)
+    redis://host:6379/0     shared by every worker and server, through Redis
+                            (needs the `redis` package)
+
+Keys are grouped into namespaces, each with its own TTL (NAMESPACES) and
+hit/miss counters. Every namespace has a version stored in the backend and
+built into its keys, so `invalidate()` drops everything in a namespace at
+once by bumping it; old entries then expire on their own. With memory:// the
+version, like the entries, is this worker's own: invalidating or deleting
+there leaves other workers' copies in place until they expire.
+
+`get_or_set` computes a missing value only once at a time: other threads in
+the worker wait for it, and other workers wait (up to LOCK_SECONDS) for the
+one holding the namespace's lock on that key, instead of all hitting the
+database together when a popular entry expires.
+
+Values are pickled for the shared backend, so cache plain data (ids, dicts
+of column values, counts), never ORM instances or anything from users.
+"""
+
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+from metrics import CACHE_LOOKUPS
+from models import db
+
+CACHE_URL = 'memory://'
+CACHE_SIZE = 10_000
+
+# Namespaces Warbler caches, and how many seconds entries live in each.
+NAMESPACES = {
+    # Column values of the logged-in user, for add_user_to_g. Only used with
+    # a shared backend: a worker's own copy would miss other workers' edits.
+    'users': 300,
+    # Message, following, follower and like counts on profile pages. Shared
+    # backend only, like 'users'.
+    'profile-counts': 60,
+    # Ids of the users whose username matches a search.
+    'user-search': 60,
+    # Ids of the messages in a user's home feed. Shared backend only.
+    'feed': 5,
+}
+
+# How long a get_or_set computation may hold its key before another worker
+# gives up waiting and computes the value itself.
+LOCK_SECONDS = 5
+LOCK_POLL_SECONDS = 0.05
+
+
+class MemoryBackend:
+    """A thread-safe LRU of at most `max_entries`, whose entries expire.
+
+    Counters are kept apart and never evicted.
+    """
+
+    # Other workers can't see this one's entries, or drop them.
+    shared = False
+
+    def __init__(self, max_entries=CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Set `key` only if it isn't set. Returns whether it was."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                return False
+
+            self._set(key, value, ttl)
+            return True
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def get_counter(self, key):
+        return self.counters.get(key, 0)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def _set(self, key, value, ttl):
+        expires_at = time.monotonic() + ttl if ttl else None
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class RedisBackend:
+    """Entries in Redis, shared by every process using the same server."""
+
+    shared = True
+
+    def __init__(self, url):
+        # Imported only when used: it takes longer to import than most of
+        # the app.
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(
+                "Install the redis package to use a redis:// CACHE_URL.") from None
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        data = self.client.get(key)
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, pickle.dumps(value), px=_ms(ttl))
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(key, pickle.dumps(value), px=_ms(ttl), nx=True))
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+    def get_counter(self, key):
+        return int(self.client.get(key) or 0)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+def _ms(seconds):
+    return int(seconds * 1000) if seconds else None
+
+
+def backend_from_url(url, max_entries=CACHE_SIZE):
+    """The backend CACHE_URL `url` names."""
+
+    scheme = urlsplit(url).scheme
+
+    if scheme == 'memory':
+        return MemoryBackend(max_entries)
+
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisBackend(url)
+
+    raise ValueError(f"Unknown cache backend {url!r}.")
+
+
+class Cache:
+    """Namespaced access to a backend."""
+
+    def __init__(self, backend, namespaces=NAMESPACES, prefix='warbler'):
+        self.backend = backend
+        self.prefix = prefix
+        self.namespaces = {
+            name: Namespace(self, name, ttl) for name, ttl in namespaces.items()
+        }
+
+    def __getitem__(self, name):
+        return self.namespaces[name]
+
+    def invalidate_all(self):
+        for namespace in self.namespaces.values():
+            namespace.invalidate()
+
+    def stats(self):
+        """Hits, misses and hit rate for each namespace in this process."""
+
+        return {name: namespace.stats() for name, namespace in self.namespaces.items()}
+
+
+class Namespace:
+    """Keys sharing a TTL, a version and hit/miss counters."""
+
+    def __init__(self, cache, name, ttl):
+        self.cache = cache
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+        self._key_locks = {}
+
+    @property
+    def _version_key(self):
+        return f"{self.cache.prefix}:{self.name}:version"
+
+    def _key(self, key):
+        version = self.cache.backend.get_counter(self._version_key)
+        return f"{self.cache.prefix}:{self.name}:{version}:{key}"
+
+    def _count(self, hit):
+        CACHE_LOOKUPS.labels(self.name, 'hit' if hit else 'miss').inc()
+
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _lookup(self, full_key):
+        # Values are stored in a 1-tuple so None can be cached too.
+        return self.cache.backend.get(full_key)
+
+    def get(self, key, default=None):
+        entry = self._lookup(self._key(key))
+        self._count(entry is not None)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value):
+        self.cache.backend.set(self._key(key), (value,), self.ttl)
+
+    def delete(self, key):
+        self.cache.backend.delete(self._key(key))
+
+    def invalidate(self):
+        """Drop every entry in this namespace, in every process."""
+
+        self.cache.backend.incr(self._version_key)
+
+    def get_or_set(self, key, compute):
+        """The cached value for `key`, or compute(), cached, computing it in
+        only one place at a time."""
+
+        full_key = self._key(key)
+        entry = self._lookup(full_key)
+
+        if entry is not None:
+            self._count(True)
+            return entry[0]
+
+        self._count(False)
+
+        with self._key_lock(full_key):
+            # Another thread may have filled it while we waited.
+            entry = self._lookup(full_key)
+            if entry is not None:
+                return entry[0]
+
+            return self._compute_once(full_key, compute)
+
+    def _key_lock(self, full_key):
+        with self._counter_lock:
+            key_lock = self._key_locks.get(full_key)
+
+            if key_lock is None:
+                key_lock = self._key_locks[full_key] = _KeyLock(self, full_key)
+
+            key_lock.users += 1
+            return key_lock
+
+    def _compute_once(self, full_key, compute):
+        backend = self.cache.backend
+        lock_key = f"{full_key}:lock"
+        token = uuid.uuid4().hex
+
+        if not backend.add(lock_key, token, LOCK_SECONDS):
+            # Another worker is computing it; wait for its result.
+            deadline = time.monotonic() + LOCK_SECONDS
+
+            while time.monotonic() < deadline:
+                time.sleep(LOCK_POLL_SECONDS)
+                entry = self._lookup(full_key)
+                if entry is not None:
+                    return entry[0]
+
+        try:
+            value = compute()
+            backend.set(full_key, (value,), self.ttl)
+            return value
+        finally:
+            if backend.get(lock_key) == token:
+                backend.delete(lock_key)
+
+    def stats(self):
+        with self._counter_lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class _KeyLock:
+    """A lock for one key, forgotten once nobody holds or waits for it.
+
+    Namespace._key_lock counts each user in; leaving counts them out.
+    """
+
+    def __init__(self, namespace, full_key):
+        self.namespace = namespace
+        self.full_key = full_key
+        self.lock = threading.Lock()
+        self.users = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+        with self.namespace._counter_lock:
+            self.users -= 1
+            if not self.users:
+                self.namespace._key_locks.pop(self.full_key, None)
+
+
+def init_cache(app):
+    """Give `app` a Cache using the backend CACHE_URL names."""
+
+    app.config.setdefault('CACHE_URL', CACHE_URL)
+    app.config.setdefault('CACHE_SIZE', CACHE_SIZE)
+
+    app.extensions['cache'] = Cache(
+        backend_from_url(app.config['CACHE_URL'], app.config['CACHE_SIZE']))
+
+    if not event.contains(db.metadata, 'after_drop', _invalidate_after_drop):
+        event.listen(db.metadata, 'after_drop', _invalidate_after_drop)
+
+
+def get_cache():
+    """The current app's Cache."""
+
+    return current_app.extensions['cache']
+
+
+def _invalidate_after_drop(*args, **kwargs):
+    # Recreated tables hand out the same ids again.
+    if has_app_context() and 'cache' in current_app.extensions:
+        get_cache().invalidate_all()
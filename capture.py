@@ -0,0 +1,91 @@
+"""Record the shape of live traffic so it can be replayed locally.
+
+With REQUEST_CAPTURE_PATH set, each request (or a REQUEST_CAPTURE_SAMPLE
+fraction of them) appends one JSON line to that file: when it arrived, its
+method, route and path, the logged-in user's id, its query params, the
+response status, how long it took and how much of that was compression.
+Bodies, headers and cookies are never recorded, and query params that look
+like secrets are masked.
+
+Replay a capture against a local server with replay.py.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+
+from flask import current_app, g, request
+
+from compression import COMPRESS_SECONDS
+
+REDACTED = '[redacted]'
+
+# Query params whose values are never written to a capture.
+SECRET_PARAMS = re.compile(r'pass|token|secret|key|csrf|auth', re.IGNORECASE)
+
+_STARTED = 'warbler.capture_started'
+
+_write_lock = threading.Lock()
+
+
+def init_capture(app):
+    """Append a trace line for `app`'s requests to REQUEST_CAPTURE_PATH.
+
+    Call before registering other before_request hooks so the timing covers
+    them too.
+    """
+
+    app.config.setdefault('REQUEST_CAPTURE_PATH', None)
+    app.config.setdefault('REQUEST_CAPTURE_SAMPLE', 1.0)
+    app.before_request(_start_capture)
+    app.after_request(_write_capture)
+
+
+def sanitized_query(args):
+    """The query params in `args` as a dict of lists, with secrets masked."""
+
+    return {
+        name: [REDACTED] * len(values) if SECRET_PARAMS.search(name) else values
+        for name, values in args.to_dict(flat=False).items()
+    }
+
+
+def _start_capture():
+    """Note when a sampled request started."""
+
+    config = current_app.config
+
+    if (config['REQUEST_CAPTURE_PATH']
+            and random.random() < config['REQUEST_CAPTURE_SAMPLE']):
+        request.environ[_STARTED] = (time.time(), time.perf_counter())
+
+
+def _write_capture(response):
+    """Append the finished request to the capture file."""
+
+    started = request.environ.get(_STARTED)
+
+    if started is None:
+        return response
+
+    arrived_at, start = started
+    user = getattr(g, 'user', None)
+
+    line = json.dumps({
+        'ts': round(arrived_at, 6),
+        'method': request.method,
+        'route': request.url_rule.rule if request.url_rule else None,
+        'path': request.path,
+        'user_id': user.id if user else None,
+        'query': sanitized_query(request.args),
+        'status': response.status_code,
+        'ms': round((time.perf_counter() - start) * 1000, 3),
+        'compress_ms': round(request.environ.get(COMPRESS_SECONDS, 0) * 1000, 3),
+    })
+
+    with _write_lock, open(current_app.config['REQUEST_CAPTURE_PATH'], 'a') as out:
+        out.write(line + '\n')
+
+    return response
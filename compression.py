@@ -0,0 +1,116 @@
+"""Compress responses with brotli or gzip.
+
+Responses whose type is in COMPRESS_MIMETYPES and whose body is at least
+COMPRESS_MIN_SIZE bytes are compressed with the best encoding the client
+accepts: brotli when the `brotli` package is installed, otherwise gzip.
+COMPRESS_LEVEL sets the gzip level (1-9) and COMPRESS_BROTLI_QUALITY the
+brotli quality (0-11); lower is faster.
+
+Time spent compressing is sent back in a Server-Timing header and kept on
+the request for the request metrics. Static files are compressed once at
+startup instead (see assets.py), so this skips them.
+"""
+
+import gzip
+import time
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIMETYPES = [
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+]
+COMPRESS_MIN_SIZE = 500
+COMPRESS_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 4
+
+COMPRESS_SECONDS = 'warbler.compress_seconds'
+
+
+def encodings():
+    """Content-Encodings this server can produce, best first."""
+
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+
+def choose_encoding(accept_encodings):
+    """The best encoding in `accept_encodings` we can produce, or None."""
+
+    for encoding in encodings():
+        if accept_encodings[encoding]:
+            return encoding
+
+    return None
+
+
+def compress(data, encoding, gzip_level=COMPRESS_LEVEL,
+             brotli_quality=COMPRESS_BROTLI_QUALITY):
+    """`data` compressed with `encoding` ('br' or 'gzip')."""
+
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+
+    # mtime=0 keeps the output the same for the same input.
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+def init_compression(app):
+    """Compress `app`'s responses.
+
+    Call after init_capture so compression time is part of the captured
+    request.
+    """
+
+    app.config.setdefault('COMPRESS_MIMETYPES', COMPRESS_MIMETYPES)
+    app.config.setdefault('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+    app.config.setdefault('COMPRESS_LEVEL', COMPRESS_LEVEL)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', COMPRESS_BROTLI_QUALITY)
+    app.after_request(_compress_response)
+
+
+def _compress_response(response):
+    """Compress `response` if it's worth it and the client accepts it."""
+
+    config = current_app.config
+
+    response.vary.add('Accept-Encoding')
+
+    if (response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in config['COMPRESS_MIMETYPES']):
+        return response
+
+    encoding = choose_encoding(request.accept_encodings)
+    data = response.get_data()
+
+    if encoding is None or len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    start = time.perf_counter()
+    response.set_data(compress(data, encoding, config['COMPRESS_LEVEL'],
+                               config['COMPRESS_BROTLI_QUALITY']))
+    seconds = time.perf_counter() - start
+
+    response.headers['Content-Encoding'] = encoding
+    request.environ[COMPRESS_SECONDS] = seconds
+    response.headers.add('Server-Timing', f"compress;dur={seconds * 1000:.3f}")
+
+    # The compressed body is a different representation.
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+
+    return response
@@ -0,0 +1,129 @@
+"""Cache rendered pieces of templates.
+
+Wrap the parts of a template that look the same to every viewer in a cache
+block, keyed by whatever they show and its version:
+
+    {% cache 'message', msg.id, msg.user.id, msg.user.version %}
+      ...
+    {% endcache %}
+
+The first render stores the block's HTML; later renders with the same key
+reuse it. Users carry a version that profile edits bump, so an edited profile
+gets new keys and old fragments simply age out. Messages can't be edited,
+and deleted rows are never rendered again. Dropping the tables clears the
+cache, since ids start over. Anything that depends on the
+viewer or the request, such as like stars, follow buttons and CSRF tokens,
+must stay outside cache blocks.
+
+Fragments are kept in memory, per process, in a least-recently-used cache of
+FRAGMENT_CACHE_SIZE entries. Setting it to 0 turns caching off.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from jinja2 import nodes
+from jinja2.ext import Extension
+from sqlalchemy import event
+
+from metrics import CACHE_LOOKUPS
+from models import db
+
+FRAGMENT_CACHE_SIZE = 10_000
+
+
+class FragmentCache:
+    """A thread-safe LRU mapping of keys to rendered HTML."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            fragment = self.entries.get(key)
+
+            if fragment is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+
+        CACHE_LOOKUPS.labels('fragments', 'miss' if fragment is None else 'hit').inc()
+
+        return fragment
+
+    def set(self, key, fragment):
+        with self.lock:
+            self.entries[key] = fragment
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the {% cache key, ... %}...{% endcache %} tag."""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method('_render', [nodes.Tuple(key, 'load')]),
+            [], [], body,
+        ).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        cache = get_fragment_cache()
+
+        if cache is None:
+            return caller()
+
+        fragment = cache.get(key)
+
+        if fragment is None:
+            fragment = caller()
+            cache.set(key, fragment)
+
+        return fragment
+
+
+def init_fragment_cache(app):
+    """Enable {% cache %} blocks in `app`'s templates."""
+
+    size = app.config.setdefault('FRAGMENT_CACHE_SIZE', FRAGMENT_CACHE_SIZE)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+    if size:
+        app.extensions['fragments'] = FragmentCache(size)
+
+    if not event.contains(db.metadata, 'after_drop', _clear_after_drop):
+        event.listen(db.metadata, 'after_drop', _clear_after_drop)
+
+
+def get_fragment_cache():
+    """The current app's FragmentCache, or None when caching is off."""
+
+    return current_app.extensions.get('fragments')
+
+
+def _clear_after_drop(*args, **kwargs):
+    # Recreated tables hand out the same ids again.
+    if has_app_context() and get_fragment_cache() is not None:
+        get_fragment_cache().clear()
@@ -2,34 +2,62 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows:
+
+    python generator/create_csvs.py --profile large-celebrity --workers 8
+
+See profiles.py for the named profiles; --users, --messages and the other
+size and skew options override the profile's values.
+
+Follower counts, posting rates, likes and blocks follow power laws, and
+message times follow a daily cycle, so the data has the hot spots real
+traffic has.
+
+Rows are written as they are generated, a chunk per process, so memory use
+doesn't grow with the dataset. The same --seed always gives the same files,
+whatever the number of workers. Nothing is fetched from the network: header
+images come from generator/header_image_urls.txt.
 """
 
+import argparse
+import csv
 import os
-from dotenv import load_dotenv
+import shutil
+import tempfile
+from datetime import datetime
+from multiprocessing import Pool
 
-import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import (
+    chunk_ranges, chunk_rng, coprime_stride, get_diurnal_datetime, rank_to_id,
+    sample_popular, zipf_rank)
+from profiles import PROFILES
 
-load_dotenv()
-
-UNSPLASH_CID = os.environ['UNSPLASH_CID']
+GENERATOR_DIR = os.path.dirname(os.path.abspath(__file__))
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['message_id', 'user_id']
+BLOCKS_CSV_HEADERS = ['user_being_blocked_id', 'user_blocking_id']
+
+CHUNK_SIZE = 50_000
+
+# Messages are dated up to two years before this, so output doesn't depend on
+# when the generator runs.
+GENERATED_AT = datetime(2024, 1, 1)
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# Separate popularity orders for being followed, posting, being liked and
+# being blocked, so the most followed user isn't also the most blocked.
+FOLLOW_STRIDE = 1_000_003
+POST_STRIDE = 2_000_003
+LIKE_STRIDE = 3_000_017
+BLOCK_STRIDE = 4_000_037
 
-fake = Faker()
+# bcrypt hash of "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
 # Generate random profile image URLs to use for users
 
@@ -39,51 +67,172 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-# NOTE: You will need to create a dev account at unsplash.com, 
-# generate an access key and set that to an environment
-# variable to successfully ping the API. 
+with open(os.path.join(GENERATOR_DIR, 'header_image_urls.txt')) as urls:
+    header_image_urls = [url.strip() for url in urls if url.strip()]
 
-header_image_urls = [
-    requests.get(
-        "https://api.unsplash.com/topics/wallpapers/photos" \
-        f"?per_page=30&orientation=landscape&client_id={UNSPLASH_CID}"
-    ).json()[i]['urls']['regular'] for i in range(0,29)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+def fake_for(rng):
+    """A Faker drawing from `rng`, so its output is reproducible."""
+
+    fake = Faker()
+    fake.seed_instance(rng.random())
+    return fake
+
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+def write_users(writer, rng, start, stop, config):
+    fake = fake_for(rng)
+
+    for user_id in range(start + 1, stop + 1):
+        # The id suffix keeps usernames and emails unique at any size.
+        username = f"{fake.user_name()[:20]}{user_id}"
+
+        writer.writerow(dict(
+            id=user_id,
+            email=f"{username}@example.org",
+            username=username,
+            image_url=rng.choice(image_urls),
+            password=PASSWORD_HASH,
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
+            header_image_url=rng.choice(header_image_urls),
+            location=fake.city()[:30],
         ))
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
+def write_messages(writer, rng, start, stop, config):
+    fake = fake_for(rng)
+    num_users = config['users']
+    stride = coprime_stride(num_users, POST_STRIDE)
+
+    for message_id in range(start + 1, stop + 1):
+        author_rank = zipf_rank(rng, num_users, config['post_skew'])
+
+        writer.writerow(dict(
+            id=message_id,
             text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+            timestamp=get_diurnal_datetime(rng, GENERATED_AT),
+            user_id=rank_to_id(author_rank, num_users, stride),
         ))
 
-# Generate follows.csv from random pairings of users
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+def per_user_counts(total, num_users, start, stop):
+    """Yield (user_id, count) for users start+1..stop, spreading `total`
+    as evenly as possible over all users."""
+
+    per_user, extra = divmod(total, num_users)
+
+    for user_id in range(start + 1, stop + 1):
+        yield user_id, per_user + (user_id <= extra)
+
+
+def write_follows(writer, rng, start, stop, config):
+    """Write follows for followers start+1..stop.
+
+    Each follower follows a distinct set of other users, picked by
+    popularity, so pairs never repeat and the pair space is never built.
+    """
+
+    num_users = config['users']
+    stride = coprime_stride(num_users, FOLLOW_STRIDE)
+
+    for follower, count in per_user_counts(config['follows'], num_users, start, stop):
+        for followed in sample_popular(rng, count, num_users, config['follow_skew'],
+                                       stride, exclude=follower):
+            writer.writerow(dict(
+                user_being_followed_id=followed,
+                user_following_id=follower,
+            ))
+
+
+def write_likes(writer, rng, start, stop, config):
+    """Write likes by users start+1..stop, favouring popular messages."""
+
+    num_messages = config['messages']
+    stride = coprime_stride(num_messages, LIKE_STRIDE)
+
+    for liker, count in per_user_counts(config['likes'], config['users'], start, stop):
+        for message_id in sample_popular(rng, count, num_messages,
+                                         config['like_skew'], stride):
+            writer.writerow(dict(message_id=message_id, user_id=liker))
+
+
+def write_blocks(writer, rng, start, stop, config):
+    """Write blocks by users start+1..stop, favouring much-blocked users."""
+
+    num_users = config['users']
+    stride = coprime_stride(num_users, BLOCK_STRIDE)
+
+    for blocker, count in per_user_counts(config['blocks'], num_users, start, stop):
+        for blocked in sample_popular(rng, count, num_users, config['block_skew'],
+                                      stride, exclude=blocker):
+            writer.writerow(dict(
+                user_being_blocked_id=blocked,
+                user_blocking_id=blocker,
+            ))
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, write_users, 'users'),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages, 'messages'),
+    # Follows, likes and blocks are generated per user, so they chunk over
+    # users.
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows, 'users'),
+    'likes': (LIKES_CSV_HEADERS, write_likes, 'users'),
+    'blocks': (BLOCKS_CSV_HEADERS, write_blocks, 'users'),
+}
+
+
+def write_chunk(job):
+    """Write one chunk of one table to its own part file."""
+
+    table, chunk, start, stop, part_path, config = job
+    headers, write_rows, _ = TABLES[table]
+
+    with open(part_path, 'w', newline='') as part:
+        writer = csv.DictWriter(part, fieldnames=headers)
+        write_rows(writer, chunk_rng(config['seed'], table, chunk), start, stop, config)
+
+    return part_path
+
+
+def generate(config):
+    """Write a CSV per table in TABLES into config['out_dir']."""
+
+    with tempfile.TemporaryDirectory(dir=config['out_dir']) as parts_dir, \
+            Pool(config['workers']) as pool:
+        for table, (headers, _, sized_by) in TABLES.items():
+            jobs = [
+                (table, chunk, start, stop,
+                 os.path.join(parts_dir, f"{table}-{chunk}.csv"), config)
+                for chunk, (start, stop)
+                in enumerate(chunk_ranges(config[sized_by], config['chunk_size']))
+            ]
+
+            with open(os.path.join(config['out_dir'], f"{table}.csv"), 'w',
+                      newline='') as out:
+                csv.DictWriter(out, fieldnames=headers).writeheader()
+
+                # imap keeps chunk order, so parts are appended as they finish.
+                for part_path in pool.imap(write_chunk, jobs):
+                    with open(part_path) as part:
+                        shutil.copyfileobj(part, out)
+                    os.remove(part_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--profile', choices=PROFILES, default='small')
+
+    for option in PROFILES['small']:
+        parser.add_argument(f"--{option.replace('_', '-')}",
+                            type=float if option.endswith('skew') else int)
+
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--out-dir', default=GENERATOR_DIR)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
+    args = vars(parser.parse_args())
+    config = {**PROFILES[args.pop('profile')],
+              **{key: value for key, value in args.items() if value is not None}}
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+    generate(config)
@@ -1,14 +1,113 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from datetime import timedelta
+from math import gcd
+from random import Random
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(rng, now, year_gap=2):
+    """Get a random datetime within the `year_gap` years before `now`."""
 
-    now = datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    seconds = rng.uniform(0, (now - then).total_seconds())
 
-    return datetime.fromtimestamp(random_timestamp)
+    return then + timedelta(seconds=seconds)
+
+
+def chunk_rng(seed, table, chunk):
+    """A random generator for one chunk of one table.
+
+    Seeding per chunk keeps the output identical however the chunks are
+    spread across processes.
+    """
+
+    return Random(f"{seed}:{table}:{chunk}")
+
+
+def chunk_ranges(total, chunk_size):
+    """Split 0..total into (start, stop) ranges of at most `chunk_size`."""
+
+    return [
+        (start, min(start + chunk_size, total))
+        for start in range(0, total, chunk_size)
+    ]
+
+
+# Relative posting activity for each hour of the day (UTC): quiet overnight,
+# busy through the evening.
+HOURLY_ACTIVITY = [
+    3, 2, 1, 1, 1, 2, 4, 6, 7, 7, 6, 6,
+    7, 6, 6, 6, 7, 8, 9, 10, 10, 9, 7, 5,
+]
+
+
+def get_diurnal_datetime(rng, now, year_gap=2):
+    """Get a random datetime within the `year_gap` years before `now`, with
+    the time of day following HOURLY_ACTIVITY."""
+
+    day = get_random_datetime(rng, now, year_gap).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    hour = rng.choices(range(24), weights=HOURLY_ACTIVITY)[0]
+
+    return day + timedelta(hours=hour, seconds=rng.uniform(0, 3600))
+
+
+def zipf_rank(rng, n, exponent):
+    """Draw a rank from 1..n with P(rank k) roughly proportional to
+    k ** -exponent.
+
+    Uses the inverse CDF of the continuous power law, so nothing of size n
+    is built.
+    """
+
+    u = rng.random()
+
+    if exponent == 1:
+        rank = (n + 1) ** u
+    else:
+        a = 1 - exponent
+        rank = (((n + 1) ** a - 1) * u + 1) ** (1 / a)
+
+    return min(int(rank), n)
+
+
+def rank_to_id(rank, n, stride):
+    """Map popularity rank 1..n onto an id 1..n.
+
+    Multiplying by a stride coprime to n is a permutation, so the most
+    popular ids are spread out instead of being 1, 2, 3...
+    """
+
+    return (rank - 1) * stride % n + 1
+
+
+def coprime_stride(n, start):
+    """The first stride at or after `start` that is coprime to `n`."""
+
+    stride = start
+    while gcd(stride, n) != 1:
+        stride += 1
+    return stride
+
+
+def sample_popular(rng, count, n, exponent, stride, exclude=None):
+    """Pick `count` distinct ids from 1..n, never `exclude`, favouring ids
+    with a high popularity rank."""
+
+    count = min(count, n - (exclude is not None))
+    picked = {}
+    attempts = 0
+
+    while len(picked) < count and attempts < count * 20:
+        target = rank_to_id(zipf_rank(rng, n, exponent), n, stride)
+        if target != exclude:
+            picked[target] = True
+        attempts += 1
+
+    # Popular ids run out for very active users; top up uniformly.
+    while len(picked) < count:
+        target = rng.randint(1, n)
+        if target != exclude:
+            picked[target] = True
+
+    return list(picked)
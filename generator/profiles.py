@@ -0,0 +1,24 @@
+"""Named dataset sizes and shapes for create_csvs.py.
+
+Who gets followed, who posts, which messages get liked and who gets blocked
+are drawn from power laws: a skew of 0 is uniform, around 1 is a typical
+social graph, and the celebrity variants push it further so a handful of
+accounts hold most of the followers and write most of the messages.
+"""
+
+SIZES = {
+    'small': dict(users=300, messages=1000, follows=5000, likes=2000, blocks=50),
+    'medium': dict(users=100_000, messages=1_000_000, follows=10_000_000,
+                   likes=5_000_000, blocks=50_000),
+    'large': dict(users=1_000_000, messages=10_000_000, follows=100_000_000,
+                  likes=50_000_000, blocks=500_000),
+}
+
+TYPICAL = dict(follow_skew=0.9, post_skew=0.8, like_skew=0.9, block_skew=0.7)
+CELEBRITY_HEAVY = dict(follow_skew=1.3, post_skew=1.1, like_skew=1.2, block_skew=1.1)
+
+PROFILES = {
+    **{name: {**size, **TYPICAL} for name, size in SIZES.items()},
+    **{f"{name}-celebrity": {**size, **CELEBRITY_HEAVY}
+       for name, size in SIZES.items()},
+}
@@ -0,0 +1,69 @@
+"""gunicorn settings: build the app once, then fork workers from it.
+
+    gunicorn "app:create_app()"
+
+With preload_app the master process imports Warbler and builds the app
+(templates, hashed and pre-compressed static files, ...) before forking, so
+workers start without repeating that work and share those pages of memory
+copy-on-write. Each worker drops the database connections it inherited
+right after the fork (see pooling.dispose_engines_after_fork).
+
+Startup is logged: how long the master took to load the app, and how long
+each worker took from fork to ready.
+
+Workers write their Prometheus metrics to files in PROMETHEUS_MULTIPROC_DIR
+(a fresh temporary directory unless it's set), so /metrics can add up every
+worker's; see metrics.py. Files left there by an earlier run are removed.
+
+Rate limit buckets are shared the same way, in a SQLite database at
+RATE_LIMIT_PATH (a fresh temporary directory's unless it's set).
+
+Settings can still be overridden on the command line or with
+GUNICORN_CMD_ARGS.
+"""
+
+import gc
+import glob
+import os
+import tempfile
+import time
+
+_started = time.perf_counter()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = True
+
+# Before the app, and so prometheus_client, is imported.
+_metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', tempfile.mkdtemp(prefix='warbler-metrics-'))
+for _path in glob.glob(os.path.join(_metrics_dir, '*.db')):
+    os.remove(_path)
+
+# Token buckets every worker shares; see ratelimit.py.
+os.environ.setdefault('RATE_LIMIT_PATH', os.path.join(
+    tempfile.mkdtemp(prefix='warbler-ratelimits-'), 'buckets.sqlite3'))
+
+
+def when_ready(server):
+    server.log.info("App loaded in %.0f ms",
+                    (time.perf_counter() - _started) * 1000)
+
+    # Move everything loaded so far out of the garbage collector's reach, so
+    # collections in the workers don't write to (and copy) the shared pages.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    worker.log.info("Worker %s ready in %.0f ms after fork", worker.pid,
+                    (time.perf_counter() - worker.forked_at) * 1000)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
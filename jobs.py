@@ -0,0 +1,403 @@
+"""Run tasks outside the request cycle, queued in the database.
+
+A task is a function registered with @task. Enqueue a run of it with
+`enqueue(name, **kwargs)`, which adds a Job to the session: committing it
+with the change that called for it means the job exists exactly when the
+change does. Jobs can wait until `run_at`, and tasks registered with
+`every=<seconds>` are re-queued after each run.
+
+The worker claims due jobs, oldest first, running at most QUEUE_LIMITS[queue]
+of each queue at a time across every worker. A job that raises is retried
+after RETRY_BACKOFF_SECONDS, doubling each time, until it has been tried
+max_attempts times; then it's marked failed with its error. While a job
+runs its worker records a heartbeat every HEARTBEAT_SECONDS; a running job
+with no heartbeat for STALE_SECONDS is taken to have died with its worker
+and counts as a failed attempt. Long jobs are left running however long
+they take, so a retry never overlaps a run still going. Each finished job
+records how long it ran; /metrics/jobs summarizes them.
+
+Run one or more alongside the web workers:
+
+    python jobs.py
+    python jobs.py --threads 8 --limit maintenance=2
+"""
+
+import argparse
+import logging
+import threading
+import time
+import traceback
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func, select, text, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Job
+
+# Most jobs of each queue running at once, across all workers. Queues not
+# listed here run one job at a time.
+QUEUE_LIMITS = {
+    'default': 4,
+    'maintenance': 1,
+}
+
+THREADS = 4
+POLL_SECONDS = 1
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 3600
+HEARTBEAT_SECONDS = 10
+STALE_SECONDS = 60
+# How long finished jobs are kept, for /metrics/jobs.
+RETENTION_DAYS = 7
+
+# Task name -> Task
+TASKS = {}
+
+logger = logging.getLogger(__name__)
+
+
+class Task:
+    """A function the worker can run, and how to run it."""
+
+    def __init__(self, name, f, queue, max_attempts, every):
+        self.name = name
+        self.f = f
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self.every = every
+
+
+def task(name, queue='default', max_attempts=MAX_ATTEMPTS, every=None):
+    """Register the decorated function as task `name`.
+
+    With `every`, the worker keeps one run queued, `every` seconds after the
+    previous one started.
+    """
+
+    def register(f):
+        TASKS[name] = Task(name, f, queue, max_attempts, every)
+        return f
+    return register
+
+
+def enqueue(name, run_at=None, key=None, **kwargs):
+    """Add a job running task `name` with `kwargs` to the session.
+
+    It runs at `run_at` (a naive UTC datetime), or as soon as a worker is
+    free. With a `key`, nothing is added while a job with that key is still
+    queued or running. Returns the Job, or None. The caller commits.
+    """
+
+    task = TASKS[name]
+    job = Job(name=name, queue=task.queue, args=kwargs, key=key,
+              run_at=run_at or datetime.utcnow(),
+              max_attempts=task.max_attempts)
+
+    if key is None:
+        db.session.add(job)
+        return job
+
+    try:
+        with db.session.begin_nested():
+            db.session.add(job)
+    except IntegrityError:
+        return None
+
+    return job
+
+
+def backoff(attempts):
+    """Seconds to wait before another try, after `attempts` tries."""
+
+    return min(RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+
+
+def schedule_recurring(now=None):
+    """Queue a run of each recurring task that has none pending."""
+
+    pending = set(db.session.scalars(
+        select(Job.key).filter(Job.status.in_(['queued', 'running']),
+                               Job.key.like('recurring:%'))))
+
+    for task in TASKS.values():
+        key = f"recurring:{task.name}"
+
+        if task.every and key not in pending:
+            enqueue(task.name, run_at=now, key=key)
+
+    db.session.commit()
+
+
+def requeue_stale(now=None):
+    """Fail the attempts of running jobs whose worker has stopped beating."""
+
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(seconds=STALE_SECONDS)
+
+    stale = db.session.scalars(
+        select(Job)
+        .filter(Job.status == 'running',
+                func.coalesce(Job.heartbeat_at, Job.started_at) < cutoff)
+        .with_for_update(skip_locked=True)).all()
+
+    for job in stale:
+        _finish_failed(
+            job, f"No heartbeat from its worker for {STALE_SECONDS} seconds.", now)
+
+    db.session.commit()
+
+
+def _lock_queue(queue):
+    """Hold `queue` until commit, so only one worker at a time counts its
+    running jobs and claims one."""
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+                           {'key': f"jobs:{queue}"})
+
+
+def claim(limits=QUEUE_LIMITS, now=None):
+    """Mark the oldest due job of a queue with room as running, and return
+    it, or None."""
+
+    now = now or datetime.utcnow()
+
+    queues = db.session.scalars(
+        select(Job.queue)
+        .filter(Job.status == 'queued', Job.run_at <= now)
+        .distinct()).all()
+    db.session.commit()
+
+    for queue in queues:
+        _lock_queue(queue)
+
+        running = db.session.scalar(
+            select(func.count())
+            .select_from(Job)
+            .filter(Job.queue == queue, Job.status == 'running'))
+
+        if running < limits.get(queue, 1):
+            job = db.session.scalars(
+                select(Job)
+                .filter(Job.queue == queue, Job.status == 'queued',
+                        Job.run_at <= now)
+                .order_by(Job.run_at, Job.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)).first()
+
+            if job:
+                job.status = 'running'
+                job.started_at = job.heartbeat_at = now
+                job.attempts += 1
+                db.session.commit()
+                return job
+
+        db.session.commit()
+
+    return None
+
+
+def execute(job):
+    """Run a claimed job's task and record how it went."""
+
+    job_id = job.id
+    task = TASKS.get(job.name)
+    started = time.perf_counter()
+
+    done = threading.Event()
+    heartbeat = threading.Thread(
+        target=_beat, args=(current_app._get_current_object(), job_id, done),
+        name=f"job-{job_id}-heartbeat", daemon=True)
+    heartbeat.start()
+
+    try:
+        if task is None:
+            raise LookupError(f"No task named {job.name!r}.")
+
+        task.f(**job.args)
+        db.session.commit()
+
+    except Exception:
+        logger.exception("job #%s (%s) failed", job_id, job.name)
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        _finish_failed(job, traceback.format_exc())
+
+    else:
+        job.status = 'done'
+        job.finished_at = datetime.utcnow()
+        _schedule_next(job)
+
+    finally:
+        done.set()
+        heartbeat.join()
+
+    job.duration_ms = (time.perf_counter() - started) * 1000
+    db.session.commit()
+
+    logger.info("job #%s (%s) %s in %.0f ms",
+                job_id, job.name, job.status, job.duration_ms)
+
+
+def _beat(app, job_id, done):
+    """Record that `job_id` is still running every HEARTBEAT_SECONDS, on a
+    connection of its own, until `done` is set."""
+
+    with app.app_context():
+        while not done.wait(HEARTBEAT_SECONDS):
+            with db.engine.begin() as conn:
+                conn.execute(update(Job)
+                             .where(Job.id == job_id, Job.status == 'running')
+                             .values(heartbeat_at=datetime.utcnow()))
+
+
+def _finish_failed(job, error, now=None):
+    now = now or datetime.utcnow()
+    job.last_error = error
+
+    if job.attempts < job.max_attempts:
+        job.status = 'queued'
+        job.run_at = now + timedelta(seconds=backoff(job.attempts))
+    else:
+        job.status = 'failed'
+        job.finished_at = now
+        _schedule_next(job)
+
+
+def _schedule_next(job):
+    task = TASKS.get(job.name)
+
+    if task and task.every:
+        # The next run's key is only free once this job is no longer pending.
+        db.session.flush()
+        enqueue(task.name, run_at=job.started_at + timedelta(seconds=task.every),
+                key=f"recurring:{task.name}")
+
+
+def work(limits=QUEUE_LIMITS, poll_seconds=POLL_SECONDS, once=False,
+         stop=None):
+    """Run due jobs as they come, until none are due if `once` is set, or
+    until the `stop` Event is set."""
+
+    stop = stop or threading.Event()
+
+    while not stop.is_set():
+        job = claim(limits)
+
+        if job:
+            execute(job)
+        elif once:
+            return
+        else:
+            schedule_recurring()
+            requeue_stale()
+            stop.wait(poll_seconds)
+
+
+def job_stats():
+    """Jobs per task and status, and how long finished runs took."""
+
+    stats = defaultdict(lambda: {
+        'queued': 0, 'running': 0, 'done': 0, 'failed': 0,
+        'mean_ms': None, 'max_ms': None,
+    })
+
+    for name, status, count in db.session.execute(
+            select(Job.name, Job.status, func.count())
+            .group_by(Job.name, Job.status)):
+        stats[name][status] = count
+
+    for name, mean_ms, max_ms in db.session.execute(
+            select(Job.name, func.avg(Job.duration_ms), func.max(Job.duration_ms))
+            .filter(Job.duration_ms.is_not(None))
+            .group_by(Job.name)):
+        stats[name]['mean_ms'] = round(float(mean_ms), 1)
+        stats[name]['max_ms'] = round(max_ms, 1)
+
+    return dict(stats)
+
+
+##############################################################################
+# Tasks
+
+
+@task('prune-jobs', queue='maintenance', every=24 * 3600)
+def prune_jobs(retention_days=RETENTION_DAYS):
+    """Delete jobs that finished more than `retention_days` ago."""
+
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+
+    Job.query.filter(Job.status.in_(['done', 'failed']),
+                     Job.finished_at < cutoff).delete()
+
+
+@task('purge-accounts', queue='maintenance', every=60)
+def purge_accounts():
+    """Purge deleted accounts' rows (see purge.py)."""
+
+    import purge
+
+    purge.run(once=True)
+
+
+@task('maintain-partitions', queue='maintenance', every=24 * 3600)
+def maintain_partitions():
+    """Create next months' message partitions and archive old ones, once
+    partitions.py setup has been run."""
+
+    import partitions
+
+    conn = db.session.connection()
+
+    if conn.dialect.name == 'postgresql' and partitions.is_partitioned(conn):
+        for name in partitions.maintain(conn):
+            logger.info("archived %s", name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--threads', type=int, default=THREADS)
+    parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS)
+    parser.add_argument('--limit', action='append', default=[],
+                        metavar='QUEUE=N',
+                        help="run at most N jobs of QUEUE at once")
+    parser.add_argument('--once', action='store_true',
+                        help="exit once no jobs are due")
+    args = parser.parse_args()
+
+    limits = dict(QUEUE_LIMITS)
+    for limit in args.limit:
+        queue, _, count = limit.partition('=')
+        limits[queue] = int(count)
+
+    logging.basicConfig(level=logging.INFO)
+
+    from app import app
+
+    with app.app_context():
+        schedule_recurring()
+
+    stop = threading.Event()
+
+    def worker():
+        with app.app_context():
+            work(limits, args.poll_seconds, args.once, stop)
+
+    threads = [threading.Thread(target=worker, name=f"jobs-{i}")
+               for i in range(args.threads)]
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        # Let running jobs finish.
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,112 @@
+"""Relationship loading strategies for Warbler routes.
+
+Every relationship in models.py lazy loads by default, which is fine when a
+route touches a relationship once, but turns into one query per row when a
+template loops over rows and follows a relationship on each of them. Routes
+that render lists pass one of the option sets below to their query so the
+related rows come back in a fixed number of statements.
+
+With STRICT_LOADING turned on, a relationship that keeps lazy loading during
+a single request raises NPlusOneError, so a template change that
+reintroduces an N+1 fails the tests instead of slowing down production.
+"""
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import configure_mappers, joinedload, noload, selectinload
+
+from models import db, User, Message, ArchivedMessage
+
+# Backrefs like Message.user only exist once the mappers are configured.
+configure_mappers()
+
+# Home feed: authors come back in the same query as the messages; the
+# likers of each message are never shown.
+FEED = (
+    joinedload(Message.user),
+    noload(Message.liked_by),
+)
+
+# Single message page: the author is always rendered.
+MESSAGE_DETAIL = (
+    joinedload(Message.user),
+    noload(Message.liked_by),
+)
+
+ARCHIVED_MESSAGE_DETAIL = (
+    joinedload(ArchivedMessage.user),
+)
+
+# Likes page: every liked message shows its author.
+LIKED_MESSAGES = (
+    selectinload(User.likes).joinedload(Message.user),
+)
+
+# A user's collections. User pages load the one they list and none of the
+# rest; the logged-in user's ids come from User.following_ids() and friends.
+USER_COLLECTIONS = (
+    User.messages, User.likes, User.followers, User.following,
+    User.blockers, User.blocking,
+)
+
+
+def _user_page(listed, *options):
+    return (*options, *(noload(collection) for collection in USER_COLLECTIONS
+                        if collection is not listed))
+
+
+# Profile page: the user's messages in one more query, each shown with that
+# (already loaded) user and never with its likers.
+USER_PROFILE = _user_page(
+    User.messages,
+    selectinload(User.messages).noload(Message.liked_by),
+)
+
+# Following and followers pages: the listed users in one more query.
+USER_FOLLOWING = _user_page(User.following, selectinload(User.following))
+USER_FOLLOWERS = _user_page(User.followers, selectinload(User.followers))
+
+# Lazy loads allowed per relationship per request before strict mode raises:
+# one for the logged-in user and one for the user whose page is shown.
+LAZY_LOADS_ALLOWED = 2
+
+
+class NPlusOneError(Exception):
+    """A relationship lazy loaded repeatedly during one request."""
+
+
+def init_strict_loading(app):
+    """Watch lazy loads for `app` and raise on N+1 patterns in strict mode.
+
+    Strict mode is off unless STRICT_LOADING is set in the app config.
+    """
+
+    app.config.setdefault('STRICT_LOADING', False)
+
+    if not event.contains(db.session, 'do_orm_execute', _check_lazy_load):
+        event.listen(db.session, 'do_orm_execute', _check_lazy_load)
+
+
+def _check_lazy_load(orm_execute_state):
+    """Count lazy loads per relationship and raise past the allowance."""
+
+    if (not orm_execute_state.is_select
+            or orm_execute_state.lazy_loaded_from is None):
+        return
+
+    if not has_request_context() or not current_app.config['STRICT_LOADING']:
+        return
+
+    relationship = str(orm_execute_state.loader_strategy_path.prop)
+
+    # Kept on the request itself, not `g`: requests made inside an app
+    # context that's already pushed (as the tests do) share its `g`.
+    lazy_loads = request.environ.setdefault('warbler.lazy_loads', {})
+    count = lazy_loads.get(relationship, 0) + 1
+    lazy_loads[relationship] = count
+
+    if count > LAZY_LOADS_ALLOWED:
+        raise NPlusOneError(
+            f"{relationship} lazy loaded {count} times in one request; "
+            "add a loader option from loading.py to the route's query."
+        )
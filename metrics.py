@@ -0,0 +1,147 @@
+"""Prometheus metrics for Warbler's requests.
+
+For each endpoint, init_metrics records requests by method and status, a
+latency histogram, and how long the request spent in database queries and
+how many it ran. It also times template rendering (per template) and
+response compression. The caches count their hits and misses (cache.py,
+fragments.py), so hit ratios are e.g.
+
+    sum by (cache) (rate(warbler_cache_lookups_total{result="hit"}[5m]))
+      / sum by (cache) (rate(warbler_cache_lookups_total[5m]))
+
+/metrics serves them in Prometheus's text format to requests bearing
+METRICS_TOKEN. Under gunicorn, each worker writes its samples to files in
+PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py sets one up), and /metrics adds
+up every worker's, whichever worker answers.
+"""
+
+import os
+import time
+
+from flask import g, has_request_context, request, template_rendered
+from flask.signals import before_render_template
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+    generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import compression
+
+# Seconds; most pages take tens of milliseconds.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 10)
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+
+REQUESTS = Counter(
+    'warbler_requests_total', "Requests served.",
+    ['endpoint', 'method', 'status'])
+REQUEST_SECONDS = Histogram(
+    'warbler_request_duration_seconds', "Time to serve a request.",
+    ['endpoint'], buckets=LATENCY_BUCKETS)
+DB_SECONDS = Histogram(
+    'warbler_request_db_seconds', "Time a request spent in database queries.",
+    ['endpoint'], buckets=LATENCY_BUCKETS)
+DB_QUERIES = Counter(
+    'warbler_db_queries_total', "Database queries run by requests.",
+    ['endpoint'])
+TEMPLATE_SECONDS = Histogram(
+    'warbler_template_render_seconds', "Time to render a template.",
+    ['template'], buckets=FAST_BUCKETS)
+COMPRESS_SECONDS = Histogram(
+    'warbler_compress_seconds', "Time to compress a response.",
+    buckets=FAST_BUCKETS)
+CACHE_LOOKUPS = Counter(
+    'warbler_cache_lookups_total', "Cache lookups, by cache and hit or miss.",
+    ['cache', 'result'])
+
+_STARTED = 'warbler.metrics_started'
+_DB = 'warbler.metrics_db'
+
+
+def init_metrics(app):
+    """Record metrics for `app`'s requests.
+
+    Call before registering other request hooks so the timing covers them.
+    """
+
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+
+    before_render_template.connect(_start_template, app)
+    template_rendered.connect(_record_template, app)
+
+    if not event.contains(Engine, 'before_cursor_execute', _start_query):
+        event.listen(Engine, 'before_cursor_execute', _start_query)
+        event.listen(Engine, 'after_cursor_execute', _record_query)
+
+
+def render_metrics():
+    """Every metric in the text format, and its content type.
+
+    In multiprocess mode that's the sum over every process writing to
+    PROMETHEUS_MULTIPROC_DIR.
+    """
+
+    registry = REGISTRY
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def _endpoint():
+    # Unrouted requests share a label, so stray URLs can't add new series.
+    return request.endpoint or 'unmatched'
+
+
+def _start_request():
+    request.environ[_STARTED] = time.perf_counter()
+    request.environ[_DB] = [0.0, 0]
+
+
+def _record_request(response):
+    started = request.environ.get(_STARTED)
+
+    if started is None:
+        return response
+
+    endpoint = _endpoint()
+    db_seconds, queries = request.environ[_DB]
+
+    REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+    REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+    DB_SECONDS.labels(endpoint).observe(db_seconds)
+    DB_QUERIES.labels(endpoint).inc(queries)
+
+    if compression.COMPRESS_SECONDS in request.environ:
+        COMPRESS_SECONDS.observe(request.environ[compression.COMPRESS_SECONDS])
+
+    return response
+
+
+def _start_template(sender, template, context, **extra):
+    g.setdefault('metrics_templates', []).append(time.perf_counter())
+
+
+def _record_template(sender, template, context, **extra):
+    starts = g.get('metrics_templates')
+
+    if starts:
+        TEMPLATE_SECONDS.labels(template.name or 'string').observe(
+            time.perf_counter() - starts.pop())
+
+
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    # Queries on one connection don't overlap.
+    conn.info['metrics_started'] = time.perf_counter()
+
+
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        totals = request.environ.get(_DB)
+
+        if totals is not None:
+            totals[0] += time.perf_counter() - conn.info['metrics_started']
+            totals[1] += 1
@@ -1,12 +1,17 @@
 """SQLAlchemy models for Warbler."""
 
+import uuid
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session, make_transient_to_detached, with_loader_criteria
+
+from replicas import RoutingSession
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 DEFAULT_IMAGE_URL = (
     "https://icon-library.com/images/default-user-icon/" +
@@ -106,6 +111,29 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Set when the account is deleted; the rows are purged later by purge.py.
+    deleted_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    # Bumped by bump_version() whenever what profiles show changes, so cached
+    # fragments showing this user can be keyed on it (see fragments.py).
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default='1',
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_users_tombstoned',
+            'deleted_at',
+            postgresql_where=db.text('deleted_at IS NOT NULL'),
+            sqlite_where=db.text('deleted_at IS NOT NULL'),
+        ),
+    )
+
     messages = db.relationship('Message', backref="user")
 
     followers = db.relationship(
@@ -196,6 +224,106 @@ class User(db.Model):
             user for user in self.blocking if user == other_user]
         return len(found_user_list) == 1
 
+    def following_ids(self):
+        """Ids of the users this user follows, without loading them. Deleted
+        users are left out."""
+
+        follows = Follow.__table__
+
+        return set(db.session.scalars(
+            select(follows.c.user_being_followed_id).where(
+                follows.c.user_following_id == self.id,
+                follows.c.user_being_followed_id.not_in(_tombstoned_user_ids))))
+
+    def blocker_ids(self):
+        """Ids of the users blocking this user, without loading them. Deleted
+        users are left out."""
+
+        blocks = Block.__table__
+
+        return set(db.session.scalars(
+            select(blocks.c.user_blocking_id).where(
+                blocks.c.user_being_blocked_id == self.id,
+                blocks.c.user_blocking_id.not_in(_tombstoned_user_ids))))
+
+    def liked_message_ids(self):
+        """Ids of the messages this user likes, without loading them."""
+
+        return set(db.session.scalars(
+            select(Like.message_id).where(Like.user_id == self.id)))
+
+    def tombstone(self):
+        """Hide this user and their messages, and queue the rows for purging.
+
+        The username and email are replaced at once, so they can be signed
+        up with again before the purge. Adds the purge to the session; the
+        caller commits.
+        """
+
+        placeholder = f"deleted-{self.id}-{uuid.uuid4().hex[:8]}"
+
+        self.deleted_at = datetime.utcnow()
+        self.username = placeholder
+        self.email = f"{placeholder}@deleted.invalid"
+        self.bump_version()
+        db.session.add(AccountPurge(user_id=self.id))
+
+    def bump_version(self):
+        """Give this user's cached fragments new keys, when the row is next
+        flushed. Incremented in SQL, so concurrent edits each count."""
+
+        self.version = User.version + 1
+
+    def cached_values(self):
+        """This user's column values for a cache, without the password hash
+        or the version, which fragment keys read fresh."""
+
+        return {
+            attr.key: getattr(self, attr.key)
+            for attr in inspect(User).column_attrs
+            if attr.key not in ('password', 'version')
+        }
+
+    @classmethod
+    def from_cached_values(cls, values):
+        """A detached User built from cached_values(), for session.merge(...,
+        load=False). The password hash and version are loaded if something
+        reads them."""
+
+        user = cls(**values)
+        make_transient_to_detached(user)
+        return user
+
+    @classmethod
+    def profile_counts(cls, user_id):
+        """How many messages, followed users, followers and likes `user_id`
+        has, counted in one query. Deleted users and their messages aren't
+        counted."""
+
+        def count(table, *conditions):
+            return (select(func.count())
+                    .select_from(table)
+                    .where(*conditions)
+                    .scalar_subquery())
+
+        messages, follows, likes = (
+            Message.__table__, Follow.__table__, Like.__table__)
+
+        row = db.session.execute(select(
+            count(messages, messages.c.user_id == user_id).label('messages'),
+            count(follows, follows.c.user_following_id == user_id,
+                  follows.c.user_being_followed_id.not_in(_tombstoned_user_ids),
+                  ).label('following'),
+            count(follows, follows.c.user_being_followed_id == user_id,
+                  follows.c.user_following_id.not_in(_tombstoned_user_ids),
+                  ).label('followers'),
+            count(likes.join(messages), likes.c.user_id == user_id,
+                  messages.c.user_id.not_in(_tombstoned_user_ids),
+                  ).label('likes'),
+        )).one()
+
+        return dict(row._mapping)
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -227,6 +355,40 @@ class Message(db.Model):
 
     liked_by = db.relationship('User', secondary='likes', backref='likes')
 
+
+class ArchivedMessage(db.Model):
+    """A message moved out of the partitioned messages table by age.
+
+    See partitions.py. Archived messages are read-only and never appear in
+    feeds, but stay reachable by id.
+    """
+
+    __tablename__ = 'messages_archive'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    user = db.relationship('User')
+
+
 class Like(db.Model):
     """A relationship table for user likes."""
 
@@ -246,12 +408,269 @@ class Like(db.Model):
 
 
 
+class AccountPurge(db.Model):
+    """Progress of purging a deleted user's rows in the background."""
+
+    __tablename__ = 'account_purges'
+
+    # Not a foreign key: the user row is the last thing the purge deletes.
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    def __repr__(self):
+        return f"<AccountPurge user #{self.user_id}: {self.rows_deleted} rows>"
+
+
+class OutboxEvent(db.Model):
+    """A change for the outbox worker to pass on to consumers.
+
+    Written in the same transaction as the change itself (see outbox.py).
+    """
+
+    __tablename__ = 'outbox_events'
+
+    id = db.Column(
+        db.BigInteger().with_variant(db.Integer, 'sqlite'),
+        primary_key=True,
+    )
+
+    # "<table>.created" or "<table>.deleted"
+    kind = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    # The changed row's key and foreign key columns.
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # "pending", or "failed" once MAX_ATTEMPTS deliveries have failed
+    status = db.Column(
+        db.String(20),
+        nullable=False,
+        default='pending',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    last_error = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    # When a failed event is next tried; until then it holds up later ones.
+    next_attempt_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    def __repr__(self):
+        return f"<OutboxEvent #{self.id}: {self.kind} {self.payload}>"
+
+
+class Job(db.Model):
+    """A run of a background task, queued for the job worker (jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    __table_args__ = (
+        # At most one pending job per key, e.g. each recurring task's next run.
+        db.Index(
+            'ix_jobs_pending_key',
+            'key',
+            unique=True,
+            postgresql_where=db.text("status IN ('queued', 'running')"),
+            sqlite_where=db.text("status IN ('queued', 'running')"),
+        ),
+        db.Index('ix_jobs_due', 'status', 'queue', 'run_at'),
+    )
+
+    id = db.Column(
+        db.BigInteger().with_variant(db.Integer, 'sqlite'),
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.String(100),
+        nullable=False,
+    )
+
+    queue = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    # Keyword arguments for the task.
+    args = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    key = db.Column(
+        db.String(200),
+        nullable=True,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.String(20),
+        nullable=False,
+        default='queued',
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    last_error = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    # Bumped by the worker while the job runs; see jobs.requeue_stale.
+    heartbeat_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    duration_ms = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} {self.status}>"
+
+
+_tombstoned_user_ids = (
+    select(User.__table__.c.id)
+    .where(User.__table__.c.deleted_at.is_not(None))
+)
+
+
+_TOMBSTONED = 'warbler.tombstoned_user_ids'
+
+
+def _tombstoned_ids(session):
+    """Ids of deleted users not purged yet, read once per transaction. There
+    are rarely any: the purge removes them within a minute or so."""
+
+    ids = session.info.get(_TOMBSTONED)
+
+    if ids is None:
+        ids = session.info[_TOMBSTONED] = set(session.scalars(
+            _tombstoned_user_ids,
+            execution_options={'include_deleted': True}))
+
+    return ids
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_tombstoned(session, transaction):
+    session.info.pop(_TOMBSTONED, None)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_tombstoned(orm_execute_state):
+    """Leave deleted users and their messages out of every ORM query.
+
+    Pass execution_options(include_deleted=True) to see them anyway.
+    """
+
+    # Relationship loads too: objects that didn't come from a filtered
+    # query (merged from the cache, say) carry no criteria to pass on.
+    if (not orm_execute_state.is_select
+            or orm_execute_state.is_column_load
+            or orm_execute_state.execution_options.get('include_deleted')):
+        return
+
+    criteria = [
+        with_loader_criteria(
+            User, User.deleted_at.is_(None), include_aliases=True),
+    ]
+
+    # Messages are only filtered while there are deleted users to hide.
+    tombstoned = _tombstoned_ids(orm_execute_state.session)
+
+    if tombstoned:
+        criteria += [
+            with_loader_criteria(
+                Message, Message.user_id.not_in(tombstoned),
+                include_aliases=True),
+            with_loader_criteria(
+                ArchivedMessage, ArchivedMessage.user_id.not_in(tombstoned),
+                include_aliases=True),
+        ]
+
+    orm_execute_state.statement = orm_execute_state.statement.options(*criteria)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. Queries outside a request need
+    an app context: `with app.app_context(): ...`.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
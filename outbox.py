@@ -0,0 +1,194 @@
+"""Pass committed changes on to whatever needs to react to them.
+
+Routes record an OutboxEvent for each message, like, follow or block they
+add or remove, in the same transaction as the change, so an event exists
+exactly when its change was committed. This worker then hands events to the
+consumers registered for their kind, a batch at a time and in the order they
+were written, and deletes them once every consumer has succeeded.
+
+Delivery is at least once: an event whose consumer fails stays in the table,
+with the error, and is retried (along with everything after it) once the
+job worker's backoff for its number of attempts has passed. Each event's
+consumers run in a savepoint, rolled back if one fails, so a failed query
+doesn't spoil the batch's transaction. Consumers must be idempotent, and
+should read the current state of a row rather than trust that nothing
+happened since the event.
+
+An event failing MAX_ATTEMPTS times in a row, which with the backoff takes
+a few hours, is marked "failed" and skipped, so one bad event can't hold up
+the rest forever. Failed events stay in the table to be looked into; set
+one's status back to "pending" to retry it.
+
+Run one alongside the web workers:
+
+    python outbox.py
+"""
+
+import argparse
+import logging
+import time
+import traceback
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, select
+
+from jobs import backoff
+from models import db, OutboxEvent
+from shards import get_shards
+
+BATCH_SIZE = 100
+POLL_SECONDS = 1
+MAX_ATTEMPTS = 10
+
+# Tables whose changes are recorded. Users are copied to their shard by the
+# routes that change them, since a new user logs straight in.
+TABLES = ['messages', 'likes', 'follows', 'blocks']
+
+# Event kind -> functions to call with each event of that kind.
+CONSUMERS = defaultdict(list)
+
+logger = logging.getLogger(__name__)
+
+
+def record_event(action, obj):
+    """Add an event for `obj` being "created" or "deleted" to the session.
+
+    Call before committing the change. Only the row's key and foreign key
+    columns are recorded; the session is flushed first so new rows have ids.
+    """
+
+    db.session.flush()
+
+    db.session.add(OutboxEvent(
+        kind=f"{obj.__table__.name}.{action}",
+        payload={
+            column.name: getattr(obj, column.key)
+            for column in obj.__table__.columns
+            if column.primary_key or column.foreign_keys
+        },
+    ))
+
+
+def consumer(*kinds):
+    """Register the decorated function for events of `kinds`."""
+
+    def register(f):
+        for kind in kinds:
+            CONSUMERS[kind].append(f)
+        return f
+    return register
+
+
+def drain(batch_size=BATCH_SIZE, now=None):
+    """Deliver up to `batch_size` of the oldest events.
+
+    Stops at the first event that is waiting to be retried or that a
+    consumer fails on, unless that was its last attempt. Returns the number
+    of events delivered.
+    """
+
+    now = now or datetime.utcnow()
+
+    events = db.session.scalars(
+        select(OutboxEvent)
+        .where(OutboxEvent.status == 'pending')
+        .order_by(OutboxEvent.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)).all()
+
+    delivered = 0
+
+    for event in events:
+        if event.next_attempt_at and event.next_attempt_at > now:
+            break
+
+        savepoint = db.session.begin_nested()
+        try:
+            for handle in CONSUMERS[event.kind]:
+                handle(event)
+            savepoint.commit()
+
+        except Exception:
+            savepoint.rollback()
+            logger.exception("outbox event #%s failed", event.id)
+            event.attempts += 1
+            event.last_error = traceback.format_exc()
+
+            if event.attempts < MAX_ATTEMPTS:
+                event.next_attempt_at = (
+                    now + timedelta(seconds=backoff(event.attempts)))
+                break
+
+            logger.error("outbox event #%s failed %s times; skipping it",
+                         event.id, event.attempts)
+            event.status = 'failed'
+            continue
+
+        db.session.delete(event)
+        delivered += 1
+
+    db.session.commit()
+
+    return delivered
+
+
+def run(batch_size=BATCH_SIZE, poll_seconds=POLL_SECONDS, once=False):
+    """Deliver events as they arrive, until none are left if `once` is set."""
+
+    while True:
+        delivered = drain(batch_size)
+
+        if delivered == batch_size:
+            continue
+
+        if once:
+            return
+
+        time.sleep(poll_seconds)
+
+
+##############################################################################
+# Consumers
+
+
+@consumer(*(f"{table}.{action}"
+            for table in TABLES for action in ('created', 'deleted')))
+def sync_shard(event):
+    """Copy the row to its owner's shard, or remove it from there."""
+
+    shards = get_shards()
+    if not shards:
+        return
+
+    table_name = event.kind.split('.')[0]
+    table = db.metadata.tables[table_name]
+
+    row = db.session.execute(
+        select(table).where(and_(*[
+            column == event.payload[column.name]
+            for column in table.primary_key.columns
+        ]))).mappings().first()
+
+    # Mirror the row as it is now: a later event may have removed it again,
+    # or re-created one this event removed.
+    if row is None:
+        shards.remove_row(table_name, event.payload)
+    else:
+        shards.copy_row(table_name, dict(row))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS)
+    parser.add_argument('--once', action='store_true',
+                        help="exit once no events are pending")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    from app import app
+
+    with app.app_context():
+        run(args.batch_size, args.poll_seconds, args.once)
@@ -0,0 +1,236 @@
+"""Monthly range partitions for the messages table (Postgres only).
+
+    python partitions.py setup
+
+turns an existing messages table into one partitioned by month on
+`timestamp` and copies its rows across. Run it once, after seed.py or during
+a maintenance window.
+
+    python partitions.py maintain
+
+creates partitions for the coming months and moves partitions older than
+ARCHIVE_AFTER_MONTHS into messages_archive, where show_message() still finds
+them by id. Run it daily; running it again changes nothing.
+
+Messages outside every monthly partition land in messages_default. Creating
+a partition moves the default's rows for its month into it; maintain warns
+about any rows the default still holds.
+
+Postgres can't point a foreign key at a partitioned table unless the key
+includes the partition column, so setup drops the likes -> messages foreign
+key. Deleting a message still deletes its likes through the ORM relationship,
+and purge.py deletes them explicitly.
+"""
+
+import argparse
+import logging
+from datetime import datetime
+
+from sqlalchemy import text
+
+MONTHS_AHEAD = 3
+ARCHIVE_AFTER_MONTHS = 12
+
+logger = logging.getLogger(__name__)
+
+
+def month_start(when):
+    """Return midnight on the first day of `when`'s month."""
+
+    return when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month, count):
+    """Return the first of the month `count` months after `month`."""
+
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month):
+    """Name of the partition holding messages from `month`."""
+
+    return f"messages_{month:%Y_%m}"
+
+
+def is_partitioned(conn):
+    """Has setup already partitioned the messages table?"""
+
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = 'messages'::regclass)"
+    )).scalar()
+
+
+def partitions(conn):
+    """Return {month: partition name} for the monthly partitions."""
+
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'messages'::regclass"
+    )).scalars()
+
+    return {
+        datetime.strptime(name, "messages_%Y_%m"): name
+        for name in names
+        if name != 'messages_default'
+    }
+
+
+def create_partition(conn, month):
+    """Create the partition for `month` unless it exists.
+
+    Postgres won't add a partition while the default partition holds rows
+    in its range, so any there are moved into the new partition.
+    """
+
+    name = partition_name(month)
+
+    if conn.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar():
+        return
+
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    in_range = "timestamp >= :start AND timestamp < :end"
+    create = text(
+        f"CREATE TABLE {name} PARTITION OF messages FOR VALUES "
+        f"FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')")
+
+    stray = _has_default(conn) and conn.execute(text(
+        f"SELECT count(*) FROM messages_default WHERE {in_range}"), bounds).scalar()
+
+    if not stray:
+        conn.execute(create)
+        return
+
+    logger.warning("moving %s messages from messages_default into %s",
+                   stray, name)
+
+    conn.execute(text("ALTER TABLE messages DETACH PARTITION messages_default"))
+    conn.execute(create)
+    conn.execute(text(
+        f"INSERT INTO {name} SELECT * FROM messages_default WHERE {in_range}"),
+        bounds)
+    conn.execute(text(f"DELETE FROM messages_default WHERE {in_range}"), bounds)
+    conn.execute(text(
+        "ALTER TABLE messages ATTACH PARTITION messages_default DEFAULT"))
+
+
+def setup(conn, now=None, months_ahead=MONTHS_AHEAD):
+    """Replace the messages table with a partitioned copy of it."""
+
+    _require_postgres(conn)
+
+    if is_partitioned(conn):
+        return
+
+    now = now or datetime.utcnow()
+    first = conn.execute(text("SELECT min(timestamp) FROM messages")).scalar()
+
+    conn.execute(text(
+        "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey"))
+    conn.execute(text("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+    conn.execute(text(
+        "ALTER TABLE messages_unpartitioned "
+        "RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey"))
+
+    conn.execute(text(
+        "CREATE TABLE messages (LIKE messages_unpartitioned INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (timestamp)"))
+    conn.execute(text("ALTER TABLE messages ADD PRIMARY KEY (id, timestamp)"))
+    conn.execute(text(
+        "ALTER TABLE messages ADD FOREIGN KEY (user_id) "
+        "REFERENCES users (id) ON DELETE CASCADE"))
+    conn.execute(text(
+        "CREATE INDEX ix_messages_user_id_timestamp "
+        "ON messages (user_id, timestamp DESC)"))
+    conn.execute(text("ALTER SEQUENCE messages_id_seq OWNED BY messages.id"))
+
+    # Catches anything outside the monthly partitions so inserts never fail.
+    conn.execute(text("CREATE TABLE messages_default PARTITION OF messages DEFAULT"))
+
+    month = month_start(first or now)
+    last = add_months(month_start(now), months_ahead)
+
+    while month <= last:
+        create_partition(conn, month)
+        month = add_months(month, 1)
+
+    conn.execute(text("INSERT INTO messages SELECT * FROM messages_unpartitioned"))
+    conn.execute(text("DROP TABLE messages_unpartitioned"))
+
+
+def archive_partition(conn, name):
+    """Copy partition `name` into messages_archive, then drop it."""
+
+    conn.execute(text(
+        f"INSERT INTO messages_archive (id, text, timestamp, user_id) "
+        f"SELECT id, text, timestamp, user_id FROM {name} "
+        f"ON CONFLICT (id) DO NOTHING"
+    ))
+    conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+    conn.execute(text(f"DROP TABLE {name}"))
+
+
+def maintain(conn, now=None, months_ahead=MONTHS_AHEAD,
+             archive_after_months=ARCHIVE_AFTER_MONTHS):
+    """Create upcoming partitions and archive old ones.
+
+    Returns the names of the partitions archived.
+    """
+
+    _require_postgres(conn)
+
+    if not is_partitioned(conn):
+        raise RuntimeError("messages isn't partitioned; run setup first.")
+
+    this_month = month_start(now or datetime.utcnow())
+
+    for ahead in range(months_ahead + 1):
+        create_partition(conn, add_months(this_month, ahead))
+
+    cutoff = add_months(this_month, -archive_after_months)
+    archived = []
+
+    for month, name in sorted(partitions(conn).items()):
+        if add_months(month, 1) <= cutoff:
+            archive_partition(conn, name)
+            archived.append(name)
+
+    if _has_default(conn):
+        stray = conn.execute(text("SELECT count(*) FROM messages_default")).scalar()
+
+        if stray:
+            logger.warning(
+                "messages_default holds %s messages outside every monthly "
+                "partition; they're never archived", stray)
+
+    return archived
+
+
+def _has_default(conn):
+    return conn.execute(text("SELECT to_regclass('messages_default')")).scalar()
+
+
+def _require_postgres(conn):
+    if conn.dialect.name != 'postgresql':
+        raise RuntimeError("Message partitioning needs Postgres.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('command', choices=['setup', 'maintain'])
+    parser.add_argument('--months-ahead', type=int, default=MONTHS_AHEAD)
+    parser.add_argument('--archive-after-months', type=int,
+                        default=ARCHIVE_AFTER_MONTHS)
+    args = parser.parse_args()
+
+    from app import app, db
+
+    with app.app_context(), db.engine.begin() as conn:
+        if args.command == 'setup':
+            setup(conn, months_ahead=args.months_ahead)
+        else:
+            for name in maintain(conn, months_ahead=args.months_ahead,
+                                 archive_after_months=args.archive_after_months):
+                print(f"archived {name}")
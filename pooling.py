@@ -0,0 +1,139 @@
+"""Connection pool settings and metrics for Warbler's database engines.
+
+Pool sizing comes from the environment so each deployment can match its
+gunicorn worker count to what the database can hold:
+
+    DB_POOL_SIZE        connections kept open per worker (default 5)
+    DB_MAX_OVERFLOW     extra connections allowed under load (default 10)
+    DB_POOL_TIMEOUT     seconds to wait for a free connection (default 30)
+    DB_POOL_RECYCLE     seconds before a connection is replaced (default off)
+    DB_POOL_PRE_PING    "1" to test connections before handing them out
+    DB_PGBOUNCER        "1" when connecting through PgBouncer in transaction
+                        pooling mode
+
+Behind PgBouncer, PgBouncer owns the pool: each worker opens a connection per
+transaction and closes it afterwards, so no session state (prepared
+statements, SET, advisory locks) is carried between transactions.
+"""
+
+import os
+import threading
+import time
+import weakref
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records how often and how long checkouts wait."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - start
+
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.checkout_timeouts += timed_out
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+def engine_options(url, environ):
+    """Build SQLAlchemy engine options for `url` from DB_* settings.
+
+    In-memory SQLite databases keep Flask-SQLAlchemy's default pool, since
+    every connection there would otherwise be a separate empty database.
+    """
+
+    url = make_url(url)
+
+    if (url.get_backend_name() == 'sqlite'
+            and url.database in (None, '', ':memory:')):
+        return {}
+
+    if environ.get('DB_PGBOUNCER') == '1':
+        return {'poolclass': NullPool}
+
+    return {
+        'poolclass': MeteredQueuePool,
+        'pool_size': int(environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', -1)),
+        'pool_pre_ping': environ.get('DB_POOL_PRE_PING') == '1',
+    }
+
+
+def pool_stats(engine):
+    """Return a dict describing the current state of `engine`'s pool."""
+
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+        )
+
+    if isinstance(pool, MeteredQueuePool):
+        with pool._metrics_lock:
+            stats.update(
+                checkouts=pool.checkouts,
+                checkout_timeouts=pool.checkout_timeouts,
+                wait_seconds_total=round(pool.wait_seconds_total, 6),
+                wait_seconds_max=round(pool.wait_seconds_max, 6),
+            )
+
+    return stats
+
+
+def dispose_engines_after_fork(app):
+    """Give each process forked from this one its own connections to `app`'s
+    databases.
+
+    With gunicorn --preload the app is built once in the master process and
+    workers are forked from it. A connection the master had opened would
+    otherwise be shared by every worker, each talking over the same socket.
+    Disposing with close=False drops the inherited pools without closing the
+    parent's connections, and workers connect afresh on first use.
+    """
+
+    app_ref = weakref.ref(app)
+
+    def dispose_in_child():
+        app = app_ref()
+        if app is None:
+            return
+
+        from models import db
+
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+        shards = app.extensions.get('shards')
+        if shards:
+            shards.reset_after_fork()
+
+    os.register_at_fork(after_in_child=dispose_in_child)
@@ -0,0 +1,216 @@
+"""Sample live requests' stacks to see where their time goes.
+
+With PROFILE_SAMPLE set, that fraction of requests is profiled; so is any
+request sending `X-Profile: <METRICS_TOKEN>`. While a request is profiled, a
+background thread records its Python stack every PROFILE_INTERVAL_MS. A
+sampler costs little beyond the samples it takes, and unlike a tracing
+profiler it doesn't slow down the ORM or Jinja code it's measuring.
+
+Each worker adds its samples up per endpoint and saves them in PROFILE_DIR
+as collapsed stacks, one "frame;frame;frame count" line per distinct stack,
+which flamegraph.pl, speedscope and most flame graph tools read:
+
+    /metrics/profiles                   samples per endpoint
+    /metrics/profiles/<endpoint>        its collapsed stacks, every worker's
+    /metrics/profiles/<endpoint>/top    the functions it spends most time in
+
+Delete the files in PROFILE_DIR to start over.
+"""
+
+import glob
+import hmac
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, request
+
+PROFILE_SAMPLE = 0.0
+PROFILE_INTERVAL_MS = 5
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'warbler-profiles')
+PROFILE_HEADER = 'X-Profile'
+
+_PROFILED = 'warbler.profiled'
+
+
+class StackSampler:
+    """Records the stacks of registered threads from a background thread."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        # Thread id -> Counter of collapsed stacks
+        self.profiled = {}
+        self.thread = None
+
+    def start(self, thread_id):
+        """Sample `thread_id` until stop(thread_id)."""
+
+        with self.lock:
+            self.profiled[thread_id] = Counter()
+
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._run, name='stack-sampler', daemon=True)
+                self.thread.start()
+
+    def stop(self, thread_id):
+        """Stop sampling `thread_id`; returns its stacks."""
+
+        with self.lock:
+            return self.profiled.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+
+            with self.lock:
+                if not self.profiled:
+                    # Exit when idle; start() starts another.
+                    self.thread = None
+                    return
+
+                frames = sys._current_frames()
+
+                for thread_id, stacks in self.profiled.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[collapse(frame)] += 1
+
+
+def collapse(frame):
+    """`frame`'s stack as "outermost;...;innermost" function names."""
+
+    names = []
+
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', '?')
+        names.append(f"{module}:{code.co_qualname}".replace(';', ':'))
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+class Profiles:
+    """This worker's samples per endpoint, saved under `directory`."""
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.sampler = StackSampler(interval)
+        self.lock = threading.Lock()
+        self.stacks = {}
+
+    def add(self, endpoint, stacks):
+        """Add a request's samples to `endpoint`'s and save them."""
+
+        if not stacks:
+            return
+
+        with self.lock:
+            totals = self.stacks.setdefault(endpoint, Counter())
+            totals.update(stacks)
+            lines = [f"{stack} {count}\n" for stack, count in totals.items()]
+
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{endpoint}.{os.getpid()}.folded")
+
+            # Written whole, then moved into place, so readers never see half.
+            with open(path + '.tmp', 'w') as out:
+                out.writelines(lines)
+            os.replace(path + '.tmp', path)
+
+
+def init_profiler(app):
+    """Profile a PROFILE_SAMPLE fraction of `app`'s requests, and requests
+    asking for it with METRICS_TOKEN."""
+
+    app.config.setdefault('PROFILE_SAMPLE', PROFILE_SAMPLE)
+    app.config.setdefault('PROFILE_INTERVAL_MS', PROFILE_INTERVAL_MS)
+    app.config.setdefault('PROFILE_DIR', PROFILE_DIR)
+
+    app.extensions['profiles'] = Profiles(
+        app.config['PROFILE_DIR'], app.config['PROFILE_INTERVAL_MS'] / 1000)
+
+    app.before_request(_start_profile)
+    app.teardown_request(_finish_profile)
+
+
+def get_profiles():
+    """The current app's Profiles."""
+
+    return current_app.extensions['profiles']
+
+
+def _wants_profile():
+    config = current_app.config
+    token = config['METRICS_TOKEN']
+
+    if token and hmac.compare_digest(
+            request.headers.get(PROFILE_HEADER, '').encode(), token.encode()):
+        return True
+
+    return random.random() < config['PROFILE_SAMPLE']
+
+
+def _start_profile():
+    if _wants_profile():
+        request.environ[_PROFILED] = threading.get_ident()
+        get_profiles().sampler.start(threading.get_ident())
+
+
+def _finish_profile(exc):
+    thread_id = request.environ.pop(_PROFILED, None)
+
+    if thread_id is not None:
+        profiles = get_profiles()
+        profiles.add(request.endpoint or 'unmatched',
+                     profiles.sampler.stop(thread_id))
+
+
+def read_stacks(directory, endpoint=None):
+    """Collapsed stacks saved by every worker, as {endpoint: Counter}, for
+    one `endpoint` or all of them."""
+
+    pattern = f"{glob.escape(endpoint)}.*.folded" if endpoint else "*.folded"
+    merged = {}
+
+    for path in glob.glob(os.path.join(glob.escape(directory), pattern)):
+        name = os.path.basename(path).rsplit('.', 2)[0]
+
+        if endpoint and name != endpoint:
+            continue
+
+        stacks = merged.setdefault(name, Counter())
+
+        with open(path) as lines:
+            for line in lines:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                stacks[stack] += int(count)
+
+    return merged
+
+
+def top_functions(stacks, limit=20):
+    """The functions `stacks` spend most samples in, as dicts of 'function',
+    'self' (samples with it innermost) and 'total' (samples with it
+    anywhere on the stack), most self first."""
+
+    own = Counter()
+    total = Counter()
+
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+
+        for function in set(frames):
+            total[function] += count
+
+    return [
+        {'function': function, 'self': count, 'total': total[function]}
+        for function, count in own.most_common(limit)
+    ]
@@ -0,0 +1,130 @@
+"""Purge deleted accounts in the background.
+
+Deleting an account only tombstones the user (see User.tombstone), which
+hides them straight away. This worker then removes their likes, messages,
+follows and blocks a batch at a time, so no single transaction holds locks on
+a prolific account's rows for long. Every batch commits together with the
+purge's progress, so a stopped worker picks up where it left off.
+
+Run one alongside the web workers:
+
+    python purge.py
+"""
+
+import argparse
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import delete, or_, select, tuple_
+
+from models import (
+    db, AccountPurge, ArchivedMessage, Block, Follow, Like, Message, User)
+from shards import get_shards
+
+BATCH_SIZE = 1000
+POLL_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+
+def purge_steps(user_id):
+    """List the (table, condition) pairs to empty for `user_id`, in order."""
+
+    likes = Like.__table__
+    messages = Message.__table__
+    archive = ArchivedMessage.__table__
+    follows = Follow.__table__
+    blocks = Block.__table__
+    users = User.__table__
+
+    users_messages = select(messages.c.id).where(messages.c.user_id == user_id)
+    users_archive = select(archive.c.id).where(archive.c.user_id == user_id)
+
+    return [
+        (likes, likes.c.message_id.in_(users_messages)),
+        (likes, likes.c.message_id.in_(users_archive)),
+        (likes, likes.c.user_id == user_id),
+        (messages, messages.c.user_id == user_id),
+        (archive, archive.c.user_id == user_id),
+        (follows, or_(follows.c.user_being_followed_id == user_id,
+                      follows.c.user_following_id == user_id)),
+        (blocks, or_(blocks.c.user_being_blocked_id == user_id,
+                     blocks.c.user_blocking_id == user_id)),
+        (users, users.c.id == user_id),
+    ]
+
+
+def delete_batch(table, condition, batch_size):
+    """Delete up to `batch_size` rows of `table` matching `condition`.
+
+    Returns the number of rows deleted.
+    """
+
+    key = tuple_(*table.primary_key.columns)
+    batch = select(*table.primary_key.columns).where(condition).limit(batch_size)
+
+    return db.session.execute(delete(table).where(key.in_(batch))).rowcount
+
+
+def purge_account(purge, batch_size=BATCH_SIZE):
+    """Delete every row belonging to `purge`'s user, committing per batch."""
+
+    for table, condition in purge_steps(purge.user_id):
+        while True:
+            deleted = delete_batch(table, condition, batch_size)
+            purge.rows_deleted += deleted
+            db.session.commit()
+
+            logger.info("purge user #%s: %s rows from %s, %s total",
+                        purge.user_id, deleted, table.name, purge.rows_deleted)
+
+            if deleted < batch_size:
+                break
+
+    shards = get_shards()
+    if shards:
+        shards.remove_user(purge.user_id)
+
+    purge.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def next_purge():
+    """Return the oldest unfinished purge, or None."""
+
+    return (AccountPurge
+                .query
+                .filter(AccountPurge.finished_at.is_(None))
+                .order_by(AccountPurge.requested_at)
+                .first())
+
+
+def run(batch_size=BATCH_SIZE, poll_seconds=POLL_SECONDS, once=False):
+    """Work through pending purges, waiting for more unless `once` is set."""
+
+    while True:
+        purge = next_purge()
+
+        if purge:
+            purge_account(purge, batch_size)
+        elif once:
+            return
+        else:
+            time.sleep(poll_seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS)
+    parser.add_argument('--once', action='store_true',
+                        help="exit once no purges are pending")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    from app import app
+
+    with app.app_context():
+        run(args.batch_size, args.poll_seconds, args.once)
@@ -0,0 +1,204 @@
+"""Throttle the login, signup and write endpoints with token buckets.
+
+Each limit is a bucket holding up to N tokens that refills at N per period;
+a POST to a limited endpoint takes a token from its client IP's bucket and,
+when logged in, from the user's, and is answered 429 with Retry-After when
+either is empty. So "10/minute" allows a burst of 10, then one every six
+seconds.
+
+RATE_LIMITS maps endpoints to {scope: "N/period"}, scope being 'ip' or
+'user'; the RATE_LIMITS environment variable sets entries, e.g.
+
+    RATE_LIMITS="warbler.login:ip=5/minute warbler.add_message:user=20/hour"
+
+Buckets are kept in a SQLite database at RATE_LIMIT_PATH, which every worker
+on the host opens, so they share them; gunicorn.conf.py sets one up. Taking a
+token is one short write transaction there. Without RATE_LIMIT_PATH the
+buckets are kept in memory, for this process only.
+
+Client IPs are request.remote_addr: behind a proxy, set that from
+X-Forwarded-For (werkzeug's ProxyFix) or every client shares the proxy's.
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import abort, current_app, g, request
+
+RATE_LIMITS = {
+    'warbler.login': {'ip': '10/minute'},
+    'warbler.signup': {'ip': '5/minute'},
+    'warbler.add_message': {'user': '10/minute', 'ip': '30/minute'},
+    'warbler.like_message': {'user': '60/minute', 'ip': '120/minute'},
+    'warbler.start_following': {'user': '30/minute', 'ip': '60/minute'},
+    'warbler.stop_following': {'user': '30/minute', 'ip': '60/minute'},
+    'warbler.start_block': {'user': '30/minute', 'ip': '60/minute'},
+    'warbler.stop_blocking': {'user': '30/minute', 'ip': '60/minute'},
+}
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Buckets untouched this long are full again, and are deleted.
+PRUNE_AFTER = PERIODS['day']
+PRUNE_EVERY = 1000
+
+
+def parse_limit(limit):
+    """Parse "N/period" into (N, seconds)."""
+
+    count, _, period = limit.partition('/')
+
+    try:
+        count, seconds = int(count), PERIODS[period.strip()]
+    except (ValueError, KeyError):
+        count = 0
+
+    if count < 1:
+        raise ValueError(f"Rate limit {limit!r} isn't N/{'|'.join(PERIODS)}.")
+
+    return count, seconds
+
+
+def parse_rate_limits(text, defaults=RATE_LIMITS):
+    """`defaults` with the limits in "endpoint:scope=N/period ..." set."""
+
+    limits = {endpoint: dict(scopes) for endpoint, scopes in defaults.items()}
+
+    for entry in text.split():
+        endpoint, _, limit = entry.partition(':')
+        scope, _, limit = limit.partition('=')
+
+        if scope not in ('ip', 'user'):
+            raise ValueError(f"Rate limit scope in {entry!r} isn't ip or user.")
+
+        parse_limit(limit)
+        limits.setdefault(endpoint, {})[scope] = limit
+
+    return limits
+
+
+class BucketStore:
+    """Token buckets in a SQLite database at `path`, or in memory."""
+
+    def __init__(self, path=None):
+        self.path = path or ':memory:'
+        # SQLite serializes the writes anyway; this keeps threads to one
+        # connection per process.
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        self.takes = 0
+
+    def _connection(self):
+        # Connections aren't carried across a fork.
+        if self.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None,
+                                   check_same_thread=False)
+            # Losing buckets in a crash only refills them.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+                "updated REAL NOT NULL)")
+            self.conn, self.pid = conn, os.getpid()
+
+        return self.conn
+
+    def take(self, key, count, period, now=None):
+        """Take a token from `key`'s bucket of `count` per `period` seconds.
+
+        Returns 0 if there was one, else the seconds until there will be.
+        """
+
+        now = time.time() if now is None else now
+
+        with self.lock:
+            return self._take(self._connection(), key, count / period, count, now)
+
+    def _take(self, conn, key, rate, count, now):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?",
+                (key,)).fetchone()
+
+            tokens = float(count)
+            if row is not None:
+                tokens = min(tokens, row[0] + max(now - row[1], 0) * rate)
+
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+
+            conn.execute(
+                "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE "
+                "SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        self.takes += 1
+        if self.takes % PRUNE_EVERY == 0:
+            conn.execute("DELETE FROM buckets WHERE updated < ?",
+                         (now - PRUNE_AFTER,))
+
+        return wait
+
+
+def init_rate_limits(app):
+    """Keep `app`'s token buckets in RATE_LIMIT_PATH, or in memory."""
+
+    app.config.setdefault('RATE_LIMITS', RATE_LIMITS)
+    app.config.setdefault('RATE_LIMIT_PATH', None)
+
+    app.extensions['rate_limits'] = BucketStore(app.config['RATE_LIMIT_PATH'])
+
+
+def get_buckets():
+    """The current app's BucketStore."""
+
+    return current_app.extensions['rate_limits']
+
+
+def rate_limited(f):
+    """Answer POSTs over this endpoint's RATE_LIMITS with 429."""
+
+    @wraps(f)
+    def rate_limit_decorator(*args, **kwargs):
+        limits = current_app.config['RATE_LIMITS'].get(request.endpoint)
+
+        if request.method == 'POST' and limits:
+            wait = _take(limits)
+            if wait:
+                abort(429, retry_after=math.ceil(wait))
+
+        return f(*args, **kwargs)
+    return rate_limit_decorator
+
+
+def _take(limits):
+    """Take a token from each of this request's buckets; the longest wait."""
+
+    clients = {'ip': request.remote_addr}
+    if g.get('user'):
+        clients['user'] = g.user.id
+
+    buckets = get_buckets()
+    wait = 0
+
+    for scope, limit in limits.items():
+        if clients.get(scope) is not None:
+            key = f"{request.endpoint}:{scope}:{clients[scope]}"
+            wait = max(wait, buckets.take(key, *parse_limit(limit)))
+
+    return wait
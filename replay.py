@@ -0,0 +1,212 @@
+"""Replay a request capture against a running Warbler server.
+
+Reads a JSONL capture written by capture.py and re-sends each request to
+--base-url, keeping the original gaps between requests divided by --speed
+(0 sends them as fast as possible), with at most --concurrency in flight.
+Requests made by a logged-in user are sent with a session cookie for the same
+user id, signed with this app's SECRET_KEY, so the server must share it and
+should be running against a seeded database:
+
+    python replay.py capture.jsonl --base-url http://localhost:5000 \\
+        --concurrency 16 --speed 2
+
+Captures don't hold request bodies, so only GETs are replayed unless
+--methods says otherwise. Prints throughput, latency percentiles and error
+rates per route. Redirects aren't followed, and 5xx responses and failed
+connections count as errors.
+"""
+
+import argparse
+import json
+import math
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+DEFAULT_BASE_URL = 'http://localhost:5000'
+TIMEOUT_SECONDS = 30
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects as responses instead of following them."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def load_capture(path, methods=('GET',)):
+    """The captured requests in `path` using one of `methods`, oldest
+    first."""
+
+    with open(path) as capture:
+        entries = [json.loads(line) for line in capture if line.strip()]
+
+    return sorted((entry for entry in entries if entry['method'] in methods),
+                  key=lambda entry: entry['ts'])
+
+
+def session_cookies(entries, cookie_for):
+    """Map each user id in `entries` to the Cookie header that logs them
+    in."""
+
+    return {
+        entry['user_id']: cookie_for(entry['user_id'])
+        for entry in entries
+        if entry['user_id'] is not None
+    }
+
+
+def app_cookie_signer():
+    """A function giving the Cookie header that logs a user id in to this
+    app."""
+
+    from app import app, CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    name = app.config['SESSION_COOKIE_NAME']
+
+    return lambda user_id: f"{name}={serializer.dumps({CURR_USER_KEY: user_id})}"
+
+
+def send(base_url, entry, cookie=None):
+    """Send one captured request. Returns (status, seconds); status is None
+    if no response came back."""
+
+    url = base_url.rstrip('/') + entry['path']
+    if entry['query']:
+        url += '?' + urlencode(entry['query'], doseq=True)
+
+    req = urllib.request.Request(url, method=entry['method'])
+    if cookie:
+        req.add_header('Cookie', cookie)
+
+    start = time.perf_counter()
+
+    try:
+        with _opener.open(req, timeout=TIMEOUT_SECONDS) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as error:
+        error.read()
+        status = error.code
+    except OSError:
+        status = None
+
+    return status, time.perf_counter() - start
+
+
+def replay(entries, base_url, concurrency=8, speed=1.0, cookies=None):
+    """Send `entries` to `base_url` on their captured schedule.
+
+    Returns (results, elapsed seconds), where results holds an
+    (entry, status, seconds) tuple per request.
+    """
+
+    cookies = cookies or {}
+    results = []
+    results_lock = threading.Lock()
+
+    def run(entry):
+        status, seconds = send(base_url, entry, cookies.get(entry['user_id']))
+        with results_lock:
+            results.append((entry, status, seconds))
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        first_ts = entries[0]['ts'] if entries else 0
+
+        for entry in entries:
+            if speed:
+                delay = (entry['ts'] - first_ts) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            executor.submit(run, entry)
+
+    return results, time.perf_counter() - start
+
+
+def percentile(sorted_values, fraction):
+    """The nearest-rank percentile of the already sorted `sorted_values`."""
+
+    if not sorted_values:
+        return None
+
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(results):
+    """Per-route request counts, error counts and latency percentiles.
+
+    Returns a dict keyed by "METHOD route", sorted by route.
+    """
+
+    by_route = defaultdict(list)
+
+    for entry, status, seconds in results:
+        by_route[f"{entry['method']} {entry['route'] or '<unmatched>'}"].append(
+            (status, seconds))
+
+    summary = {}
+
+    for route in sorted(by_route):
+        latencies = sorted(seconds for _, seconds in by_route[route])
+        errors = sum(1 for status, _ in by_route[route]
+                     if status is None or status >= 500)
+
+        summary[route] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'error_rate': errors / len(latencies),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+        }
+
+    return summary
+
+
+def report(results, elapsed, out=print):
+    """Print a per-route table and overall throughput for `results`."""
+
+    summary = summarize(results)
+    width = max([len(route) for route in summary] + [5])
+
+    out(f"{'route':<{width}}  {'count':>7}  {'errors':>6}  {'err%':>6}  "
+        f"{'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}")
+
+    for route, stats in summary.items():
+        out(f"{route:<{width}}  {stats['requests']:>7}  {stats['errors']:>6}  "
+            f"{stats['error_rate']:>6.1%}  {stats['p50'] * 1000:>8.1f}  "
+            f"{stats['p95'] * 1000:>8.1f}  {stats['p99'] * 1000:>8.1f}")
+
+    total = len(results)
+    errors = sum(stats['errors'] for stats in summary.values())
+
+    out(f"{total} requests in {elapsed:.1f}s "
+        f"({total / elapsed if elapsed else 0:.1f} req/s), "
+        f"{errors / total if total else 0:.1%} errors")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('capture')
+    parser.add_argument('--base-url', default=DEFAULT_BASE_URL)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--methods', default='GET')
+    args = parser.parse_args()
+
+    entries = load_capture(args.capture, args.methods.upper().split(','))
+    cookies = session_cookies(entries, app_cookie_signer())
+
+    report(*replay(entries, args.base_url, args.concurrency, args.speed, cookies))
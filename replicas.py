@@ -0,0 +1,98 @@
+"""Read-replica routing for Warbler.
+
+When a `replica` bind is configured, SELECTs made while serving a view marked
+with @read_from_replica go to the replica. Everything else, including every
+flush, goes to the primary.
+
+Replicas lag behind the primary, so a request that writes records the time
+in the user's session. For REPLICA_STICKY_SECONDS after that, the user's
+reads stay on the primary and they always see their own changes.
+"""
+
+import time
+
+from flask import current_app, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+REPLICA_BIND = 'replica'
+LAST_WRITE_KEY = 'last_write'
+
+_USE_REPLICA = 'warbler.use_replica'
+_WROTE = 'warbler.wrote'
+
+
+def read_from_replica(f):
+    """Mark a view as safe to serve from the read replica."""
+
+    f.reads_from_replica = True
+    return f
+
+
+class RoutingSession(Session):
+    """Session that sends reads from replica-safe views to the replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and _replica_requested():
+            engines = self._db.engines
+
+            if REPLICA_BIND in engines:
+                return engines[REPLICA_BIND]
+
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+def init_replicas(app):
+    """Route reads for `app` to its replica bind, if it has one.
+
+    Call before registering other before_request hooks so the current user
+    is loaded from the same database as the rest of the page.
+    """
+
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+    app.before_request(_choose_database)
+    app.after_request(_remember_write)
+
+
+def _replica_requested():
+    """Is the current request allowed to read from the replica?"""
+
+    return has_request_context() and request.environ.get(_USE_REPLICA, False)
+
+
+def _choose_database():
+    """Send this request's reads to the replica unless the user just wrote."""
+
+    view = current_app.view_functions.get(request.endpoint)
+
+    if not getattr(view, 'reads_from_replica', False):
+        return
+
+    if not wrote_recently():
+        request.environ[_USE_REPLICA] = True
+
+
+def wrote_recently():
+    """Did the user write within the last REPLICA_STICKY_SECONDS?"""
+
+    last_write = session.get(LAST_WRITE_KEY, 0)
+    sticky_seconds = current_app.config['REPLICA_STICKY_SECONDS']
+
+    return time.time() - last_write < sticky_seconds
+
+
+def _remember_write(response):
+    """Pin the user to the primary for a while after a write."""
+
+    if request.environ.get(_WROTE, False):
+        session[LAST_WRITE_KEY] = time.time()
+
+    return response
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _flag_write(db_session, flush_context):
+    """Note that the current request sent changes to the primary."""
+
+    if has_request_context():
+        request.environ[_WROTE] = True
@@ -1,19 +1,23 @@
 """Seed database with sample data from CSV Files."""
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follow
+import os
 
-db.drop_all()
-db.create_all()
+from app import app, db
+from bulk_load import load_csvs
+from models import User, Message, Follow, Like, Block
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+with app.app_context():
+    db.drop_all()
+    db.create_all()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follow, DictReader(follows))
-
-db.session.commit()
+    # Likes and blocks only exist in datasets from newer generator runs.
+    load_csvs(db.engine, [
+        (table, path) for table, path in [
+            (User.__table__, 'generator/users.csv'),
+            (Message.__table__, 'generator/messages.csv'),
+            (Follow.__table__, 'generator/follows.csv'),
+            (Like.__table__, 'generator/likes.csv'),
+            (Block.__table__, 'generator/blocks.csv'),
+        ]
+        if os.path.exists(path)
+    ])
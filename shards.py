@@ -0,0 +1,270 @@
+"""Spread users' rows across several databases by user id.
+
+Each user lives on shard `user_id % len(shards)`, together with their
+messages, the follows and blocks they made and the likes they gave. Shards
+hold the tables without foreign keys or unique constraints, since a follow or
+like can point at a user or message on another shard, and usernames stay
+unique through the primary.
+
+While sharding rolls out, the primary database stays the source of truth and
+allocates every id. Routes write to the primary as before, then copy the row
+to its owner's shard. The home feed is read from the shards with a
+scatter-gather query. To set up the shards and copy existing rows:
+
+    python shards.py create
+    python shards.py backfill
+"""
+
+import argparse
+import heapq
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import Column, Index, MetaData, Table, and_, create_engine, delete, insert, select, tuple_
+from sqlalchemy.orm import Session, joinedload
+
+from models import db, Message
+
+# The column holding the id of the user each row belongs to.
+OWNER_COLUMNS = {
+    'users': 'id',
+    'messages': 'user_id',
+    'follows': 'user_following_id',
+    'blocks': 'user_blocking_id',
+    'likes': 'user_id',
+}
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+class ShardRouter:
+    """Routes rows and queries to shards by the owning user's id."""
+
+    def __init__(self, urls, **engine_options):
+        self.engines = [create_engine(url, **engine_options) for url in urls]
+        self.metadata = shard_metadata()
+        self.executor = ThreadPoolExecutor(
+            max_workers=len(self.engines), thread_name_prefix='shard')
+
+    def shard_for(self, user_id):
+        """Index of the shard that owns `user_id`'s rows."""
+
+        return user_id % len(self.engines)
+
+    def engine_for(self, user_id):
+        """Engine for the shard that owns `user_id`'s rows."""
+
+        return self.engines[self.shard_for(user_id)]
+
+    def create_all(self):
+        """Create the sharded tables on every shard."""
+
+        for engine in self.engines:
+            self.metadata.create_all(engine)
+
+    def drop_all(self):
+        """Drop the sharded tables from every shard."""
+
+        for engine in self.engines:
+            self.metadata.drop_all(engine)
+
+    def reset_after_fork(self):
+        """Drop connections and query threads inherited from a parent
+        process, leaving the parent's connections open."""
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=len(self.engines), thread_name_prefix='shard')
+
+        for engine in self.engines:
+            engine.dispose(close=False)
+
+    def dispose(self):
+        """Close every shard's connections and stop the query threads."""
+
+        self.executor.shutdown()
+
+        for engine in self.engines:
+            engine.dispose()
+
+    def copy(self, obj):
+        """Copy the ORM object `obj` to its owner's shard, replacing any
+        earlier copy."""
+
+        self.copy_row(obj.__table__.name, row_values(obj))
+
+    def copy_row(self, table_name, values):
+        """Write a row of `table_name` to its owner's shard."""
+
+        table = self.metadata.tables[table_name]
+        owner = values[OWNER_COLUMNS[table_name]]
+
+        with self.engine_for(owner).begin() as conn:
+            conn.execute(delete(table).where(_key_matches(table, values)))
+            conn.execute(insert(table).values(values))
+
+    def remove(self, obj):
+        """Remove the ORM object `obj` from its owner's shard."""
+
+        self.remove_row(obj.__table__.name, row_values(obj))
+
+    def remove_row(self, table_name, values):
+        """Delete a row of `table_name` from its owner's shard."""
+
+        table = self.metadata.tables[table_name]
+        owner = values[OWNER_COLUMNS[table_name]]
+
+        with self.engine_for(owner).begin() as conn:
+            conn.execute(delete(table).where(_key_matches(table, values)))
+
+    def remove_user(self, user_id):
+        """Delete everything `user_id` owns from their shard."""
+
+        with self.engine_for(user_id).begin() as conn:
+            for table_name in reversed(OWNER_COLUMNS):
+                table = self.metadata.tables[table_name]
+                column = table.c[OWNER_COLUMNS[table_name]]
+                conn.execute(delete(table).where(column == user_id))
+
+    def scatter(self, user_ids, fetch):
+        """Call fetch(session, ids) on each shard owning some of `user_ids`.
+
+        Shards are queried in parallel. Returns a list of the results.
+        """
+
+        ids_by_shard = defaultdict(list)
+
+        for user_id in user_ids:
+            ids_by_shard[self.shard_for(user_id)].append(user_id)
+
+        def fetch_from(shard, ids):
+            with Session(self.engines[shard]) as session:
+                return fetch(session, ids)
+
+        return list(self.executor.map(
+            fetch_from, ids_by_shard.keys(), ids_by_shard.values()))
+
+    def recent_messages(self, user_ids, limit):
+        """Return the `limit` newest messages written by any of `user_ids`,
+        with their authors loaded."""
+
+        def fetch(session, ids):
+            return (session
+                        .scalars(select(Message)
+                                 .options(joinedload(Message.user))
+                                 .filter(Message.user_id.in_(ids))
+                                 .order_by(Message.timestamp.desc())
+                                 .limit(limit))
+                        .unique()
+                        .all())
+
+        newest = heapq.merge(*self.scatter(user_ids, fetch),
+                             key=lambda msg: msg.timestamp, reverse=True)
+
+        return list(islice(newest, limit))
+
+
+def shard_metadata():
+    """Copies of the sharded tables without foreign keys or unique
+    constraints."""
+
+    metadata = MetaData()
+
+    for table_name in OWNER_COLUMNS:
+        source = db.metadata.tables[table_name]
+        Table(table_name, metadata, *[
+            Column(column.name, column.type,
+                   primary_key=column.primary_key,
+                   nullable=column.nullable,
+                   autoincrement=False)
+            for column in source.columns
+        ])
+
+    messages = metadata.tables['messages']
+    Index('ix_messages_user_id_timestamp',
+          messages.c.user_id, messages.c.timestamp)
+
+    return metadata
+
+
+def row_values(obj):
+    """The column values of ORM object `obj`, keyed by column name."""
+
+    return {
+        column.name: getattr(obj, column.key)
+        for column in obj.__table__.columns
+    }
+
+
+def _key_matches(table, values):
+    return and_(*[column == values[column.name]
+                  for column in table.primary_key.columns])
+
+
+def init_shards(app):
+    """Set up the shard router for `app` if SHARD_URLS is configured."""
+
+    urls = app.config.setdefault('SHARD_URLS', [])
+
+    if urls:
+        app.extensions['shards'] = ShardRouter(urls)
+
+
+def get_shards():
+    """The current app's ShardRouter, or None when sharding is off."""
+
+    return current_app.extensions.get('shards')
+
+
+def backfill(router, batch_size=BACKFILL_BATCH_SIZE):
+    """Copy every sharded row from the primary onto its owner's shard."""
+
+    for table_name, owner_column in OWNER_COLUMNS.items():
+        source = db.metadata.tables[table_name]
+        target = router.metadata.tables[table_name]
+        key = source.primary_key.columns
+        last_key = None
+
+        while True:
+            # Seek past the last batch by key, rather than with an OFFSET
+            # that rescans every row before it.
+            query = select(source).order_by(*key).limit(batch_size)
+            if last_key is not None:
+                query = query.where(tuple_(*key) > tuple_(*last_key))
+
+            rows = db.session.execute(query).mappings().all()
+
+            if not rows:
+                break
+
+            rows_by_shard = defaultdict(list)
+            for row in rows:
+                rows_by_shard[router.shard_for(row[owner_column])].append(dict(row))
+
+            for shard, shard_rows in rows_by_shard.items():
+                with router.engines[shard].begin() as conn:
+                    for row in shard_rows:
+                        conn.execute(delete(target).where(_key_matches(target, row)))
+                    conn.execute(insert(target), shard_rows)
+
+            last_key = [rows[-1][column.name] for column in key]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('command', choices=['create', 'backfill'])
+    args = parser.parse_args()
+
+    from app import app
+
+    router = app.extensions.get('shards')
+
+    if router is None:
+        raise SystemExit("Set SHARD_URLS to the shard databases first.")
+
+    if args.command == 'create':
+        router.create_all()
+    else:
+        with app.app_context():
+            backfill(router)
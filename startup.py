@@ -0,0 +1,131 @@
+"""Measure how long a fresh process takes to import and build Warbler.
+
+Every gunicorn worker respawn without --preload, every script and every
+test run pays this before doing any work. `measure_startup` times fresh
+interpreters importing app.py and calling create_app(); `import_profile`
+runs one under `python -X importtime` and adds up the time spent importing
+each top-level package:
+
+    python startup.py
+    python startup.py --runs 10 --top 30
+
+Nothing connects to the database, so DATABASE_URL only has to name one
+whose driver is installed.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RUNS = 5
+
+# Run in the child interpreter. Prints seconds spent importing app.py and
+# building the app.
+CHILD = """\
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+print(imported - start, time.perf_counter() - imported)
+"""
+
+# "import time:       283 |      36966 |   dotenv"
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+def _child_env():
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'postgresql:///warbler')
+    env.setdefault('SECRET_KEY', 'startup')
+    return env
+
+
+def _run_child(*python_options):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, *python_options, '-c', CHILD],
+        cwd=PROJECT_DIR, env=_child_env(), capture_output=True, text=True,
+        check=True)
+    process_seconds = time.perf_counter() - started
+
+    import_seconds, create_seconds = map(float, result.stdout.split()[-2:])
+
+    return import_seconds, create_seconds, process_seconds, result.stderr
+
+
+def measure_startup(runs=RUNS):
+    """Median milliseconds, over `runs` fresh interpreters, to import app.py,
+    to run create_app() and for the whole process."""
+
+    timings = [_run_child()[:3] for _ in range(runs)]
+
+    return {
+        name: round(statistics.median(run[i] for run in timings) * 1000, 1)
+        for i, name in enumerate(['import_ms', 'create_app_ms', 'process_ms'])
+    }
+
+
+def parse_import_times(stderr):
+    """(module, self microseconds, depth) for each line of `-X importtime`
+    output in `stderr`."""
+
+    modules = []
+
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, _, indent, name = match.groups()
+            modules.append((name, int(self_us), len(indent) // 2))
+
+    return modules
+
+
+def package_costs(modules):
+    """Milliseconds spent importing each top-level package, costliest
+    first, as (package, ms) pairs."""
+
+    totals = defaultdict(int)
+
+    for name, self_us, _ in modules:
+        totals[name.split('.')[0]] += self_us
+
+    return sorted(((package, us / 1000) for package, us in totals.items()),
+                  key=lambda item: item[1], reverse=True)
+
+
+def import_profile():
+    """Per-package import cost of a fresh interpreter importing app.py."""
+
+    return package_costs(parse_import_times(_run_child('-X', 'importtime')[3]))
+
+
+def report(startup, costs, top=20, out=print):
+    """Print startup times and the `top` costliest packages."""
+
+    out(f"import app.py   {startup['import_ms']:>8.1f} ms")
+    out(f"create_app()    {startup['create_app_ms']:>8.1f} ms")
+    out(f"whole process   {startup['process_ms']:>8.1f} ms")
+    out("")
+
+    total = sum(ms for _, ms in costs) or 1
+
+    out(f"{'package':<24}  {'ms':>8}  {'share':>6}")
+    for package, ms in costs[:top]:
+        out(f"{package:<24}  {ms:>8.1f}  {ms / total:>6.1%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    report(measure_startup(args.runs), import_profile(), args.top)
@@ -0,0 +1,72 @@
+// Like, follow and block without reloading the page.
+//
+// These forms still work as plain posts; here they're sent with fetch,
+// asking for JSON, and only the button that was pressed is updated. If
+// anything goes wrong the form is submitted the ordinary way.
+
+const ACTIONS = [
+  {
+    pattern: /^\/messages\/(\d+)\/like$/,
+    update(form, data) {
+      const icon = form.querySelector('i');
+      icon.classList.toggle('bi-star-fill', data.liked);
+      icon.classList.toggle('bi-star', !data.liked);
+    },
+  },
+  {
+    pattern: /^\/users\/(?:follow|stop-following)\/(\d+)$/,
+    update(form, data) {
+      toggleButton(form, data.following,
+                   `/users/stop-following/${data.user_id}`, 'Unfollow',
+                   `/users/follow/${data.user_id}`, 'Follow');
+    },
+  },
+  {
+    pattern: /^\/users\/(?:block|stop-blocking)\/(\d+)$/,
+    update(form, data) {
+      toggleButton(form, data.blocking,
+                   `/users/stop-blocking/${data.user_id}`, 'Unblock',
+                   `/users/block/${data.user_id}`, 'Block');
+    },
+  },
+];
+
+function toggleButton(form, on, onAction, onText, offAction, offText) {
+  const button = form.querySelector('button');
+  form.setAttribute('action', on ? onAction : offAction);
+  button.textContent = on ? onText : offText;
+  button.classList.toggle('btn-primary', on);
+  button.classList.toggle('btn-outline-primary', !on);
+}
+
+document.addEventListener('submit', async (event) => {
+  const form = event.target;
+  const action = ACTIONS.find(
+    ({ pattern }) => pattern.test(form.getAttribute('action')));
+
+  if (!action || form.dataset.pending) return;
+
+  event.preventDefault();
+  form.dataset.pending = 'true';
+
+  try {
+    const response = await fetch(form.action, {
+      method: 'POST',
+      body: new FormData(form),
+      headers: { Accept: 'application/json' },
+      credentials: 'same-origin',
+      redirect: 'manual',
+    });
+
+    if (!response.ok
+        || !response.headers.get('Content-Type')?.startsWith('application/json')) {
+      throw new Error(`${response.status} from ${form.action}`);
+    }
+
+    action.update(form, await response.json());
+    delete form.dataset.pending;
+  } catch (error) {
+    // Fall back to the full-page post and redirect.
+    form.submit();
+  }
+});
@@ -0,0 +1,106 @@
+"""Per-endpoint memory allocation tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_allocations.py
+
+
+import os
+import tracemalloc
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from allocations import get_allocations
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class AllocationsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        db.session.add_all([
+            Message(text=f"message {n} " * 10, user_id=self.user_id)
+            for n in range(100)
+        ])
+        db.session.commit()
+
+        get_allocations().endpoints.clear()
+        app.config['MEMORY_TRACE'] = True
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['MEMORY_TRACE'] = False
+        app.config['MEMORY_ALARM_KB'] = 20480
+        app.config['METRICS_TOKEN'] = None
+        tracemalloc.stop()
+
+    def get_as(self, url, headers={}):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            return client.get(url, headers=headers)
+
+    def test_records_peak_and_sites(self):
+        """Test a traced request's peak and allocation sites are recorded"""
+
+        self.get_as(f"/users/{self.user_id}")
+        self.get_as(f"/users/{self.user_id}")
+
+        report = get_allocations().report()['endpoints']['warbler.show_user']
+
+        self.assertEqual(report['requests'], 2)
+        self.assertGreater(report['peak_max_kb'], 0)
+        self.assertGreaterEqual(report['peak_max_kb'], report['peak_avg_kb'])
+        self.assertTrue(report['top_sites'])
+        self.assertTrue(any(site['site'].startswith(('templates/', 'app.py:'))
+                            for site in report['top_sites']))
+
+    def test_off_by_default(self):
+        """Test nothing is traced without MEMORY_TRACE"""
+
+        app.config['MEMORY_TRACE'] = False
+        self.get_as(f"/users/{self.user_id}")
+
+        self.assertEqual(get_allocations().report()['endpoints'], {})
+
+    def test_alarm(self):
+        """Test a request peaking above MEMORY_ALARM_KB is logged"""
+
+        app.config['MEMORY_ALARM_KB'] = 0
+
+        with self.assertLogs('allocations', 'WARNING') as logs:
+            self.get_as(f"/users/{self.user_id}?token=hunter2")
+
+        self.assertIn("GET /users/<int:user_id> (warbler.show_user "
+                      f"{{'user_id': {self.user_id}}}", logs.output[0])
+        self.assertNotIn("hunter2", logs.output[0])
+
+    def test_endpoint(self):
+        """Test the report is served only with METRICS_TOKEN"""
+
+        app.config['METRICS_TOKEN'] = "secret"
+        self.get_as("/")
+
+        with app.test_client() as client:
+            self.assertEqual(client.get("/metrics/memory").status_code, 404)
+
+            resp = client.get("/metrics/memory",
+                              headers={'Authorization': "Bearer secret"})
+
+        self.assertEqual(resp.json['pid'], os.getpid())
+        self.assertIn('warbler.homepage', resp.json['endpoints'])
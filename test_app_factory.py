@@ -0,0 +1,90 @@
+"""Application factory tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_app_factory.py
+
+
+import os
+from unittest import TestCase, mock
+
+from sqlalchemy import text
+
+from models import db
+
+from app import create_app
+
+TEST_CONFIG = {
+    'SQLALCHEMY_DATABASE_URI': "postgresql:///warbler_test",
+    'SECRET_KEY': "test",
+}
+
+
+class CreateAppTestCase(TestCase):
+    def test_config_without_environment(self):
+        """Test an app can be built from config alone"""
+
+        with mock.patch.dict(os.environ, clear=True):
+            app = create_app({**TEST_CONFIG, 'PUBLIC_PAGE_MAX_AGE': 5})
+
+        self.assertEqual(app.config['PUBLIC_PAGE_MAX_AGE'], 5)
+        self.assertIn('warbler.homepage', app.view_functions)
+
+        with app.app_context():
+            self.assertEqual(db.session.scalar(text("SELECT 1")), 1)
+
+    def test_memory_trace_flag(self):
+        """Test MEMORY_TRACE is on only when set to 1"""
+
+        for value, expected in [('1', True), ('0', False), ('', False)]:
+            with mock.patch.dict(os.environ, {'MEMORY_TRACE': value}):
+                app = create_app(TEST_CONFIG)
+
+            self.assertIs(app.config['MEMORY_TRACE'], expected, value)
+
+    def test_database_required(self):
+        """Test a missing database URL is reported when the app is built"""
+
+        with mock.patch.dict(os.environ, {'SECRET_KEY': "test"}, clear=True):
+            with self.assertRaisesRegex(RuntimeError, "DATABASE_URL"):
+                create_app()
+
+    def test_no_app_context_left_pushed(self):
+        """Test building an app doesn't leave its context pushed"""
+
+        from flask import current_app, has_app_context
+
+        app = create_app(TEST_CONFIG)
+
+        self.assertFalse(has_app_context()
+                         and current_app._get_current_object() is app)
+
+    def test_fork_gets_fresh_connections(self):
+        """Test a forked child doesn't reuse the parent's pooled connections"""
+
+        app = create_app(TEST_CONFIG)
+
+        with app.app_context():
+            engine = db.engine
+
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+
+            self.assertEqual(engine.pool.checkedin(), 1)
+
+            read_end, write_end = os.pipe()
+            pid = os.fork()
+
+            if pid == 0:
+                os.close(read_end)
+                os.write(write_end, str(engine.pool.checkedin()).encode())
+                os._exit(0)
+
+            os.close(write_end)
+            os.waitpid(pid, 0)
+            with os.fdopen(read_end) as pipe:
+                self.assertEqual(pipe.read(), "0")
+
+            # The parent's connection survived the child.
+            with engine.connect() as conn:
+                self.assertEqual(conn.execute(text("SELECT 1")).scalar(), 1)
@@ -0,0 +1,239 @@
+"""ASGI serving and async endpoint tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_asgi.py
+
+
+import asyncio
+import json
+import os
+import time
+from unittest import TestCase
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from models import db, User, Message, Follow, Block, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from asgi import (
+    AsyncWarbler, ThreadPoolWsgiToAsgi, async_database_url, async_engine_options)
+from replay import app_cookie_signer
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+async def request(asgi_app, path, headers=()):
+    """Send a GET for `path` to `asgi_app`, disconnecting once some of the
+    body has arrived. Returns (status, headers dict, body)."""
+
+    sent = []
+    body_arrived = asyncio.Event()
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await body_arrived.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+        if message.get('body'):
+            body_arrived.set()
+
+    await asgi_app({
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [(name.encode(), value.encode()) for name, value in headers],
+        'client': ('127.0.0.1', 50000),
+        'server': ('localhost', 80),
+    }, receive, send)
+
+    start, bodies = sent[0], sent[1:]
+
+    return (start['status'],
+            {name.decode(): value.decode() for name, value in start['headers']},
+            b''.join(message.get('body', b'') for message in bodies))
+
+
+def call(asgi_app, path, headers=()):
+    """request() in a new event loop, closing the app's engines after."""
+
+    async def run():
+        try:
+            return await request(asgi_app, path, headers)
+        finally:
+            await asgi_app.aclose()
+
+    return asyncio.run(run())
+
+
+class AsyncEndpointTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        self.u1_id, self.u2_id, self.u3_id = u1.id, u2.id, u3.id
+
+        db.session.add(Follow(user_following_id=self.u1_id,
+                              user_being_followed_id=self.u2_id))
+        messages = [Message(text="from u2", user_id=self.u2_id),
+                    Message(text="from u3", user_id=self.u3_id),
+                    Message(text="from u1", user_id=self.u1_id)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.m2_id = messages[0].id
+
+        db.session.add(Like(user_id=self.u1_id, message_id=self.m2_id))
+        db.session.commit()
+
+        self.asgi_app = AsyncWarbler(app)
+        self.cookie = ('cookie', app_cookie_signer()(self.u1_id))
+
+    def tearDown(self):
+        app.config['FEED_EVENTS_POLL_SECONDS'] = 2.0
+        db.session.rollback()
+
+    def test_feed(self):
+        """Test the feed holds followed users' and own warbles"""
+
+        status, headers, body = call(self.asgi_app, "/api/feed", [self.cookie])
+        messages = json.loads(body)['messages']
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['cache-control'], 'no-store')
+        self.assertEqual({msg['text'] for msg in messages}, {"from u1", "from u2"})
+        self.assertEqual({msg['id'] for msg in messages if msg['liked']}, {self.m2_id})
+
+    def test_logged_out(self):
+        """Test the async endpoints need a logged-in user"""
+
+        for path in ["/api/feed", f"/api/users/{self.u2_id}", "/api/feed/events"]:
+            status, _, body = call(self.asgi_app, path)
+
+            self.assertEqual(status, 401, path)
+            self.assertIn("unauthorized", json.loads(body)['error'])
+
+    def test_user(self):
+        """Test a user's profile and warbles"""
+
+        status, _, body = call(self.asgi_app, f"/api/users/{self.u2_id}", [self.cookie])
+        user = json.loads(body)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(user['username'], "u2")
+        self.assertEqual([msg['text'] for msg in user['messages']], ["from u2"])
+
+    def test_user_blocking_viewer(self):
+        """Test users who block the viewer aren't shown"""
+
+        db.session.add(Block(user_blocking_id=self.u2_id,
+                             user_being_blocked_id=self.u1_id))
+        db.session.commit()
+
+        status, _, _ = call(self.asgi_app, f"/api/users/{self.u2_id}", [self.cookie])
+
+        self.assertEqual(status, 404)
+
+    def test_feed_events(self):
+        """Test warbles after Last-Event-ID are streamed as events"""
+
+        app.config['FEED_EVENTS_POLL_SECONDS'] = 0.05
+
+        status, headers, body = call(self.asgi_app, "/api/feed/events",
+                                     [self.cookie, ('last-event-id', '0')])
+        events = [event for event in body.decode().split("\n\n") if event]
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-type'], 'text/event-stream')
+        self.assertEqual(len(events), 2)
+        self.assertIn(f"id: {self.m2_id}\nevent: warble\ndata: ", events[0])
+        self.assertEqual(json.loads(events[0].split("data: ")[1])['text'], "from u2")
+
+    def test_pages_served_by_flask(self):
+        """Test everything else is passed to the Flask app"""
+
+        status, headers, body = call(self.asgi_app, "/login")
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"Welcome back.", body)
+
+
+class ThreadPoolWsgiToAsgiTestCase(TestCase):
+    def test_requests_run_concurrently(self):
+        """Test slow WSGI requests don't wait for each other"""
+
+        started = []
+
+        def slow_app(environ, start_response):
+            started.append(environ['PATH_INFO'])
+            time.sleep(0.2)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b"ok"]
+
+        asgi_app = ThreadPoolWsgiToAsgi(slow_app)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            await asyncio.gather(*[request(asgi_app, f"/{i}") for i in range(4)])
+            return loop.time() - start
+
+        self.assertLess(asyncio.run(run()), 0.6)
+        self.assertEqual(len(started), 4)
+
+
+class AsyncEngineOptionsTestCase(TestCase):
+    def test_pool_replaced(self):
+        """Test the metered pool is left for SQLAlchemy's async pool"""
+
+        options = async_engine_options("postgresql:///warbler_test", {})
+
+        self.assertNotIn('poolclass', options)
+        self.assertNotIn('connect_args', options)
+
+    def test_pgbouncer(self):
+        """Test PgBouncer mode turns off asyncpg's prepared statement caches"""
+
+        url = "postgresql:///warbler_test"
+        options = async_engine_options(url, {'DB_PGBOUNCER': '1'})
+        connect_args = options['connect_args']
+
+        self.assertIs(options['poolclass'], NullPool)
+        self.assertEqual(connect_args['prepared_statement_cache_size'], 0)
+        self.assertEqual(connect_args['statement_cache_size'], 0)
+        self.assertNotEqual(connect_args['prepared_statement_name_func'](),
+                            connect_args['prepared_statement_name_func']())
+
+        async def query_twice():
+            engine = create_async_engine(async_database_url(url), **options)
+            try:
+                async with engine.connect() as conn:
+                    return [(await conn.execute(text("SELECT 1"))).scalar()
+                            for _ in range(2)]
+            finally:
+                await engine.dispose()
+
+        self.assertEqual(asyncio.run(query_twice()), [1, 1])
@@ -0,0 +1,136 @@
+"""Static asset and page caching tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_assets.py
+
+
+import os
+from unittest import TestCase
+
+from flask import url_for
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from assets import IMMUTABLE_MAX_AGE
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class StaticAssetTestCase(TestCase):
+    def hashed_url(self, filename):
+        with app.test_request_context():
+            return url_for('static', filename=filename)
+
+    def test_hashed_urls_in_pages(self):
+        """Test pages link static files by their hashed URLs"""
+
+        with app.test_client() as client:
+            html = client.get("/").get_data(as_text=True)
+
+        self.assertIn(self.hashed_url('stylesheets/style.css'), html)
+        self.assertRegex(self.hashed_url('stylesheets/style.css'),
+                         r"^/static/stylesheets/style\.[0-9a-f]{12}\.css$")
+        self.assertNotIn('href="/static/stylesheets/style.css"', html)
+
+    def test_hashed_file_is_immutable(self):
+        """Test a hashed URL is served with long-lived caching"""
+
+        with app.test_client() as client:
+            response = client.get(self.hashed_url('images/warbler-logo.png'))
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.cache_control.max_age, IMMUTABLE_MAX_AGE)
+            self.assertTrue(response.cache_control.immutable)
+            self.assertTrue(response.cache_control.public)
+            self.assertFalse(response.cache_control.no_store)
+            response.close()
+
+    def test_stylesheet_urls_rewritten(self):
+        """Test /static/ URLs inside stylesheets point at hashed files"""
+
+        with app.test_client() as client:
+            response = client.get(self.hashed_url('stylesheets/style.css'))
+            css = response.get_data(as_text=True)
+
+            self.assertEqual(response.mimetype, 'text/css')
+            self.assertIn(self.hashed_url('images/nav-bg.png'), css)
+            self.assertNotIn('/static/images/nav-bg.png"', css)
+
+            etag = response.headers['ETag']
+            revalidated = client.get(self.hashed_url('stylesheets/style.css'),
+                                     headers={'If-None-Match': etag})
+
+            self.assertEqual(revalidated.status_code, 304)
+
+    def test_unhashed_path_still_served(self):
+        """Test plain static paths work with a short lifetime"""
+
+        with app.test_client() as client:
+            response = client.get("/static/favicon.ico")
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.cache_control.max_age,
+                             app.config['STATIC_MAX_AGE'])
+            self.assertFalse(response.cache_control.immutable)
+            response.close()
+
+
+class PageCachingTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_anonymous_home_is_public(self):
+        """Test the logged-out homepage may be cached by shared caches"""
+
+        with app.test_client() as client:
+            response = client.get("/")
+
+        self.assertTrue(response.cache_control.public)
+        self.assertEqual(response.cache_control.max_age,
+                         app.config['PUBLIC_PAGE_MAX_AGE'])
+
+    def test_logged_in_pages_not_stored(self):
+        """Test pages for a logged-in user are never stored"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for url in ["/", f"/users/{self.u1_id}"]:
+                self.assertTrue(client.get(url).cache_control.no_store, url)
+
+    def test_flashed_page_not_public(self):
+        """Test a logged-out page showing a flash isn't shared"""
+
+        with app.test_client() as client:
+            response = client.get(f"/users/{self.u1_id}", follow_redirects=True)
+
+        self.assertIn("Access unauthorized", response.get_data(as_text=True))
+        self.assertFalse(response.cache_control.public)
+        self.assertTrue(response.cache_control.no_cache)
+
+    def test_other_anonymous_pages_revalidate(self):
+        """Test logged-out pages that aren't marked public are private"""
+
+        with app.test_client() as client:
+            response = client.get("/login")
+
+        self.assertTrue(response.cache_control.private)
+        self.assertTrue(response.cache_control.no_cache)
+        self.assertFalse(response.cache_control.no_store)
@@ -0,0 +1,146 @@
+"""Route benchmark tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_benchmark.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follow
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from benchmark import ROUTES, benchmark_app, compare, pick_ids, run_benchmarks
+from ratelimit import RATE_LIMITS, parse_limit
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class BenchmarkRunTestCase(TestCase):
+    def setUp(self):
+        """u2 is the most followed user; u1 follows them and u3 does not."""
+
+        User.query.delete()
+
+        users = [User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+                 for i in range(1, 5)]
+        db.session.commit()
+        self.u1_id, self.u2_id, self.u3_id, self.u4_id = [u.id for u in users]
+
+        db.session.add_all([
+            Follow(user_following_id=self.u1_id, user_being_followed_id=self.u2_id),
+            Follow(user_following_id=self.u4_id, user_being_followed_id=self.u2_id),
+            Follow(user_following_id=self.u1_id, user_being_followed_id=self.u4_id),
+            Message(text="hello", user_id=self.u2_id),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_pick_ids(self):
+        """Test the most followed user and their busiest follower are picked"""
+
+        ids = pick_ids()
+
+        self.assertEqual(ids['subject'], self.u2_id)
+        self.assertEqual(ids['viewer'], self.u1_id)
+        self.assertEqual(ids['follow_target'], self.u3_id)
+        self.assertEqual(ids['search'], 'u2')
+
+    def test_run_benchmarks(self):
+        """Test every route is measured and leaves follows as they were"""
+
+        results = run_benchmarks(app, pick_ids(), iterations=2, warmup=0)
+
+        self.assertEqual(list(results), list(ROUTES))
+
+        for stats in results.values():
+            self.assertGreater(stats['p50_ms'], 0)
+            self.assertGreater(stats['queries'], 0)
+            self.assertGreater(stats['peak_kib'], 0)
+
+        self.assertEqual(
+            Follow.query.filter_by(user_following_id=self.u1_id).count(), 2)
+
+
+    def test_writes_not_rate_limited(self):
+        """Test write routes run more iterations than the rate limits allow"""
+
+        limit, _ = parse_limit(RATE_LIMITS['warbler.add_message']['user'])
+        bench_app = benchmark_app("postgresql:///warbler_test")
+
+        with bench_app.app_context():
+            results = run_benchmarks(bench_app, pick_ids(),
+                                     routes={'post': ROUTES['post']},
+                                     iterations=limit + 5, warmup=0)
+
+        self.assertIn('post', results)
+
+
+class CompareTestCase(TestCase):
+    baseline = {'routes': {
+        'home': {'p50_ms': 10.0, 'queries': 5, 'peak_kib': 400.0},
+        'search': {'p50_ms': 2.0, 'queries': 3, 'peak_kib': 50.0},
+    }}
+
+    def with_changes(self, route, **changes):
+        current = {'routes': {name: dict(stats)
+                              for name, stats in self.baseline['routes'].items()}}
+        current['routes'][route].update(changes)
+        return current
+
+    def test_no_change(self):
+        """Test identical results have no regressions"""
+
+        self.assertEqual(compare(self.baseline, self.baseline), [])
+
+    def test_slower(self):
+        """Test a route past the time threshold is a regression"""
+
+        self.assertEqual(compare(self.baseline, self.with_changes('home', p50_ms=13.0)),
+                         [('home', 'p50_ms', 10.0, 13.0)])
+        self.assertEqual(compare(self.baseline, self.with_changes('home', p50_ms=12.0)), [])
+
+    def test_small_absolute_changes_ignored(self):
+        """Test tiny times can double without counting as a regression"""
+
+        self.assertEqual(compare(self.baseline, self.with_changes('search', p50_ms=2.9)), [])
+
+    def test_extra_query(self):
+        """Test any extra query is a regression"""
+
+        self.assertEqual(compare(self.baseline, self.with_changes('search', queries=4)),
+                         [('search', 'queries', 3, 4)])
+
+    def test_more_memory(self):
+        """Test memory past the threshold is a regression"""
+
+        self.assertEqual(compare(self.baseline, self.with_changes('home', peak_kib=600.0)),
+                         [('home', 'peak_kib', 400.0, 600.0)])
+
+    def test_new_route(self):
+        """Test routes missing from the baseline are skipped"""
+
+        current = self.with_changes('home')
+        current['routes']['post'] = {'p50_ms': 5.0, 'queries': 4, 'peak_kib': 300.0}
+
+        self.assertEqual(compare(self.baseline, current), [])
+
+    def test_slower_startup(self):
+        """Test startup past the time threshold is a regression"""
+
+        baseline = dict(self.baseline, startup={'import_ms': 600.0, 'create_app_ms': 80.0})
+        current = dict(self.baseline, startup={'import_ms': 900.0, 'create_app_ms': 81.0})
+
+        self.assertEqual(compare(baseline, current),
+                         [('startup', 'import_ms', 600.0, 900.0)])
+        self.assertEqual(compare(self.baseline, current), [])
@@ -0,0 +1,106 @@
+"""Bulk CSV loader tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_bulk_load.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from models import db, User, Message, Follow
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from bulk_load import load_csvs
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+USERS_CSV = """email,username,image_url,password,bio,header_image_url,location
+a@example.org,alice,http://a.jpg,hash,,http://h.jpg,Paris
+b@example.org,bob,http://b.jpg,hash,"Likes, commas",http://h.jpg,
+"""
+
+MESSAGES_CSV = """id,text,timestamp,user_id
+10,first,2021-02-12 06:41:25.698388,1
+11,second,2022-11-07 11:30:08.462462,2
+"""
+
+FOLLOWS_CSV = """user_being_followed_id,user_following_id
+1,2
+"""
+
+
+class BulkLoadTestCase(TestCase):
+    def setUp(self):
+        """Write sample CSVs and start from empty tables."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = []
+
+        for table, contents in [(User.__table__, USERS_CSV),
+                                (Message.__table__, MESSAGES_CSV),
+                                (Follow.__table__, FOLLOWS_CSV)]:
+            path = os.path.join(self.tmp.name, f"{table.name}.csv")
+            with open(path, 'w') as csv_file:
+                csv_file.write(contents)
+            self.files.append((table, path))
+
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.tmp.cleanup()
+
+    def check_loaded(self, session):
+        users = session.query(User).order_by(User.id).all()
+
+        self.assertEqual([u.username for u in users], ["alice", "bob"])
+        self.assertEqual(users[0].bio, "")
+        self.assertEqual(users[1].bio, "Likes, commas")
+        self.assertEqual(users[1].location, "")
+        self.assertEqual(session.query(Message).count(), 2)
+        self.assertEqual(session.query(Follow).count(), 1)
+
+    def test_load_postgres(self):
+        """Test loading through COPY"""
+
+        reports = []
+        load_csvs(db.engine, self.files, report=reports.append)
+
+        self.check_loaded(db.session)
+        self.assertEqual(len(reports), 3)
+        self.assertTrue(reports[0].startswith("users: 2 rows"))
+
+        # The sequence moved past the ids in the file.
+        msg = Message(text="third", user_id=users_id(db.session, "alice"))
+        db.session.add(msg)
+        db.session.commit()
+        self.assertEqual(msg.id, 12)
+
+    def test_load_sqlite(self):
+        """Test loading through executemany in small chunks"""
+
+        engine = create_engine(f"sqlite:///{self.tmp.name}/load.db")
+        db.metadata.create_all(engine)
+
+        load_csvs(engine, self.files, report=lambda line: None, chunk_size=1)
+
+        with Session(engine) as session:
+            self.check_loaded(session)
+
+        engine.dispose()
+
+
+def users_id(session, username):
+    return session.query(User).filter_by(username=username).one().id
@@ -0,0 +1,475 @@
+"""Cache layer tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_cache.py
+
+
+import os
+import socketserver
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Follow
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, create_app, CURR_USER_KEY
+from cache import (
+    Cache, MemoryBackend, RedisBackend, _invalidate_after_drop, backend_from_url,
+    get_cache)
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class StandInRedis(socketserver.ThreadingTCPServer):
+    """A local server answering the Redis commands RedisBackend sends.
+
+    Speaks the Redis protocol (RESP3, which redis-py asks for) over a socket,
+    so the real client is tested.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInRedisHandler)
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"redis://127.0.0.1:{self.server_address[1]}/0"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def run(self, command, *args):
+        with self.lock:
+            for key, expires_at in list(self.expires.items()):
+                if expires_at <= time.monotonic():
+                    self.data.pop(key, None)
+                    del self.expires[key]
+
+            handle = getattr(self, f"do_{command.decode().lower()}", None)
+            if handle is None:
+                return b"-ERR unknown command\r\n"
+
+            return handle(*args)
+
+    def do_client(self, *args):
+        return b"+OK\r\n"
+
+    do_select = do_client
+
+    def do_hello(self, *args):
+        return b"%1\r\n$5\r\nproto\r\n:3\r\n"
+
+    def do_get(self, key):
+        return _bulk(self.data.get(key))
+
+    def do_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+
+        if b"NX" in options and key in self.data:
+            return _bulk(None)
+
+        self.data[key] = value
+        self.expires.pop(key, None)
+
+        if b"PX" in options:
+            ms = int(options[options.index(b"PX") + 1])
+            self.expires[key] = time.monotonic() + ms / 1000
+
+        return b"+OK\r\n"
+
+    def do_incrby(self, key, amount):
+        value = int(self.data.get(key, 0)) + int(amount)
+        self.data[key] = str(value).encode()
+        return f":{value}\r\n".encode()
+
+    def do_del(self, *keys):
+        deleted = sum(self.data.pop(key, None) is not None for key in keys)
+        return f":{deleted}\r\n".encode()
+
+
+class StandInRedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+
+            self.wfile.write(self.server.run(*args))
+
+
+def _bulk(value):
+    if value is None:
+        return b"_\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class SharedMemoryBackend(MemoryBackend):
+    """A MemoryBackend standing in for a cache every worker shares."""
+
+    shared = True
+
+
+class MemoryBackendTestCase(TestCase):
+    def test_lru_eviction(self):
+        """Test the least recently used entry is evicted first"""
+
+        backend = MemoryBackend(2)
+        backend.set('a', 'A')
+        backend.set('b', 'B')
+        backend.get('a')
+        backend.set('c', 'C')
+
+        self.assertEqual(backend.get('a'), 'A')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('c'), 'C')
+
+    def test_ttl(self):
+        """Test entries expire after their TTL"""
+
+        backend = MemoryBackend()
+        backend.set('a', 'A', ttl=0.05)
+        self.assertEqual(backend.get('a'), 'A')
+
+        time.sleep(0.06)
+        self.assertIsNone(backend.get('a'))
+
+    def test_add(self):
+        """Test add only sets missing or expired keys"""
+
+        backend = MemoryBackend()
+
+        self.assertTrue(backend.add('lock', 1, ttl=0.05))
+        self.assertFalse(backend.add('lock', 2, ttl=0.05))
+
+        time.sleep(0.06)
+        self.assertTrue(backend.add('lock', 3))
+        self.assertEqual(backend.get('lock'), 3)
+
+    def test_counters_are_not_evicted(self):
+        """Test namespace versions survive a full LRU"""
+
+        backend = MemoryBackend(1)
+        backend.incr('version')
+        backend.set('a', 'A')
+        backend.set('b', 'B')
+
+        self.assertEqual(backend.get_counter('version'), 1)
+
+    def test_backend_from_url(self):
+        """Test CACHE_URL picks the backend"""
+
+        self.assertIsInstance(backend_from_url('memory://', 5), MemoryBackend)
+        self.assertEqual(backend_from_url('memory://', 5).max_entries, 5)
+
+        with self.assertRaises(ValueError):
+            backend_from_url('memcached://localhost')
+
+
+class NamespaceTestCase(TestCase):
+    def setUp(self):
+        self.cache = Cache(MemoryBackend(), {'things': 60, 'others': 60})
+
+    def test_none_is_cached(self):
+        """Test a computed None is cached rather than computed again"""
+
+        calls = []
+        things = self.cache['things']
+
+        for _ in range(2):
+            self.assertIsNone(things.get_or_set(1, lambda: calls.append(1)))
+
+        self.assertEqual(calls, [1])
+
+    def test_invalidate(self):
+        """Test invalidate drops one namespace's entries only"""
+
+        self.cache['things'].set(1, 'thing')
+        self.cache['others'].set(1, 'other')
+
+        self.cache['things'].invalidate()
+
+        self.assertIsNone(self.cache['things'].get(1))
+        self.assertEqual(self.cache['others'].get(1), 'other')
+
+    def test_stats(self):
+        """Test hits and misses are counted per namespace"""
+
+        things = self.cache['things']
+        things.get_or_set(1, lambda: 'thing')
+        things.get_or_set(1, lambda: 'thing')
+        things.get(2)
+        things.get(1)
+
+        self.assertEqual(self.cache.stats(), {
+            'things': {'hits': 2, 'misses': 2, 'hit_rate': 0.5},
+            'others': {'hits': 0, 'misses': 0, 'hit_rate': None},
+        })
+
+    def test_computes_once_per_key(self):
+        """Test concurrent misses on one key compute it only once"""
+
+        things = self.cache['things']
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'thing'
+
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                things.get_or_set(1, compute)))
+            for _ in range(5)
+        ]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['thing'] * 5)
+        self.assertEqual(things._key_locks, {})
+
+    def test_waits_for_other_process(self):
+        """Test a key locked elsewhere is read once it's filled, not computed"""
+
+        things = self.cache['things']
+        full_key = things._key(1)
+        self.cache.backend.add(f"{full_key}:lock", 'elsewhere', 5)
+
+        threading.Timer(
+            0.1, lambda: self.cache.backend.set(full_key, ('thing',))).start()
+
+        self.assertEqual(things.get_or_set(1, lambda: 'computed'), 'thing')
+
+
+class RedisBackendTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInRedis()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.server.data.clear()
+        self.backend = RedisBackend(self.server.url)
+
+    def tearDown(self):
+        self.backend.client.close()
+
+    def test_round_trip(self):
+        """Test values are pickled in and out"""
+
+        self.backend.set('a', ({'id': 1},), ttl=60)
+        self.assertEqual(self.backend.get('a'), ({'id': 1},))
+
+        self.backend.delete('a')
+        self.assertIsNone(self.backend.get('a'))
+
+    def test_add_and_counters(self):
+        """Test add sets missing keys only, and counters count"""
+
+        self.assertTrue(self.backend.add('lock', 'a', ttl=5))
+        self.assertFalse(self.backend.add('lock', 'b', ttl=5))
+
+        self.assertEqual(self.backend.get_counter('version'), 0)
+        self.backend.incr('version')
+        self.assertEqual(self.backend.get_counter('version'), 1)
+
+    def test_ttl(self):
+        """Test entries are sent with their TTL"""
+
+        self.backend.set('a', 1, ttl=0.05)
+        time.sleep(0.1)
+        self.assertIsNone(self.backend.get('a'))
+
+    def test_namespace(self):
+        """Test a Cache works over Redis"""
+
+        cache = Cache(self.backend, {'things': 60})
+        self.assertEqual(cache['things'].get_or_set(1, lambda: [1, 2]), [1, 2])
+        self.assertEqual(cache['things'].get(1), [1, 2])
+
+        cache['things'].invalidate()
+        self.assertIsNone(cache['things'].get(1))
+
+
+class InitCacheTestCase(TestCase):
+    def test_one_drop_listener(self):
+        """Test building apps doesn't pile up drop listeners"""
+
+        before = len(db.metadata.dispatch.after_drop)
+        create_app({'SQLALCHEMY_DATABASE_URI': "postgresql:///warbler_test",
+                    'SECRET_KEY': "test"})
+
+        listeners = list(db.metadata.dispatch.after_drop)
+        self.assertEqual(len(listeners), before)
+        self.assertEqual(listeners.count(_invalidate_after_drop), 1)
+
+    def test_drop_invalidates(self):
+        """Test dropping the tables empties the current app's cache"""
+
+        get_cache()['feed'].set(1, [1, 2])
+
+        db.drop_all()
+        db.create_all()
+
+        self.assertIsNone(get_cache()['feed'].get(1))
+
+
+class CachedViewsTestCase(TestCase):
+    def setUp(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.cache = app.extensions['cache']
+        app.extensions['cache'] = Cache(SharedMemoryBackend())
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions['cache'] = self.cache
+
+    def client_as(self, user_id):
+        client = app.test_client()
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return client
+
+    def test_logged_in_user_is_cached(self):
+        """Test the logged-in user is loaded from the cache"""
+
+        self.client_as(self.u1_id).get("/")
+
+        self.assertEqual(get_cache()['users'].get(self.u1_id)['username'], "u1")
+        self.assertNotIn('password', get_cache()['users'].get(self.u1_id))
+
+    def test_user_not_cached_per_worker(self):
+        """Test users aren't cached where other workers' edits can't reach"""
+
+        app.extensions['cache'] = Cache(MemoryBackend())
+        self.client_as(self.u1_id).get("/")
+
+        self.assertIsNone(get_cache()['users'].get(self.u1_id))
+
+    def test_counts_and_feed_not_cached_per_worker(self):
+        """Test profile counts and feeds aren't cached per worker either"""
+
+        app.extensions['cache'] = Cache(MemoryBackend())
+        client = self.client_as(self.u1_id)
+        client.get("/")
+        client.get(f"/users/{self.u2_id}")
+
+        self.assertIsNone(get_cache()['feed'].get(self.u1_id))
+        self.assertIsNone(get_cache()['profile-counts'].get(self.u2_id))
+
+    def test_cached_user_changed_elsewhere(self):
+        """Test a cached user changed since can still be edited and deleted"""
+
+        client = self.client_as(self.u1_id)
+        client.get("/")
+
+        # Changed without dropping the cached copy, as a racing request may.
+        db.session.get(User, self.u1_id).bio = "changed elsewhere"
+        db.session.commit()
+        db.session.expunge_all()
+
+        resp = client.post("/users/profile", data={
+            'username': "renamed", 'email': "u1@email.com",
+            'password': "password"})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(db.session.get(User, self.u1_id).username, "renamed")
+
+        self.assertEqual(client.post("/users/delete").status_code, 302)
+        db.session.expunge_all()
+        self.assertIsNone(db.session.get(User, self.u1_id))
+
+    def test_profile_edit_refreshes_user(self):
+        """Test editing a profile drops the cached user"""
+
+        client = self.client_as(self.u1_id)
+        client.get("/")
+
+        client.post("/users/profile", data={
+            'username': "renamed", 'email': "u1@email.com",
+            'password': "password"})
+
+        self.assertIn("@renamed", client.get("/").get_data(as_text=True))
+
+    def test_follow_refreshes_counts_and_feed(self):
+        """Test following someone updates the counts and the home feed"""
+
+        db.session.add(Message(text="u2_msg", user_id=self.u2_id))
+        db.session.commit()
+
+        client = self.client_as(self.u1_id)
+        self.assertNotIn("u2_msg", client.get("/").get_data(as_text=True))
+        client.get(f"/users/{self.u2_id}")
+        self.assertEqual(get_cache()['profile-counts'].get(self.u2_id)['followers'], 0)
+
+        client.post(f"/users/follow/{self.u2_id}")
+
+        self.assertIn("u2_msg", client.get("/").get_data(as_text=True))
+        self.assertEqual(User.profile_counts(self.u2_id)['followers'], 1)
+        self.assertIsNone(get_cache()['profile-counts'].get(self.u2_id))
+
+    def test_profile_counts(self):
+        """Test the four profile counts come from one query"""
+
+        db.session.add(Message(text="msg", user_id=self.u1_id))
+        db.session.add(Follow(user_being_followed_id=self.u2_id,
+                              user_following_id=self.u1_id))
+        db.session.commit()
+
+        self.assertEqual(User.profile_counts(self.u1_id), {
+            'messages': 1, 'following': 1, 'followers': 0, 'likes': 0})
+
+    def test_cache_metrics(self):
+        """Test cache stats are served only with METRICS_TOKEN"""
+
+        app.config['METRICS_TOKEN'] = "secret"
+
+        try:
+            with app.test_client() as client:
+                self.assertEqual(client.get("/metrics/cache").status_code, 404)
+
+                resp = client.get("/metrics/cache",
+                                  headers={'Authorization': "Bearer secret"})
+        finally:
+            app.config['METRICS_TOKEN'] = None
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('users', resp.json)
+        self.assertIn('hit_rate', resp.json['feed'])
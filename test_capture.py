@@ -0,0 +1,168 @@
+"""Request capture and replay tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_capture.py
+
+
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from werkzeug.serving import make_server
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from capture import REDACTED
+from replay import app_cookie_signer, load_capture, percentile, replay, session_cookies, summarize
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class CaptureTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.capture_dir = tempfile.TemporaryDirectory()
+        self.capture_path = os.path.join(self.capture_dir.name, 'capture.jsonl')
+        app.config['REQUEST_CAPTURE_PATH'] = self.capture_path
+
+    def tearDown(self):
+        app.config['REQUEST_CAPTURE_PATH'] = None
+        app.config['REQUEST_CAPTURE_SAMPLE'] = 1.0
+        db.session.rollback()
+        self.capture_dir.cleanup()
+
+    def captured(self):
+        with open(self.capture_path) as capture:
+            return [json.loads(line) for line in capture]
+
+    def test_records_request_shape(self):
+        """Test a request is captured with its route, user and query"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.get("/users?q=u1&token=hunter2")
+
+        [entry] = self.captured()
+
+        self.assertEqual(entry['method'], 'GET')
+        self.assertEqual(entry['route'], '/users')
+        self.assertEqual(entry['path'], '/users')
+        self.assertEqual(entry['user_id'], self.u1_id)
+        self.assertEqual(entry['query'], {'q': ['u1'], 'token': [REDACTED]})
+        self.assertEqual(entry['status'], 200)
+        self.assertGreater(entry['ms'], 0)
+
+    def test_never_records_bodies(self):
+        """Test form fields aren't written to the capture"""
+
+        with app.test_client() as client:
+            client.post("/login", data={"username": "u1", "password": "password"})
+
+        [entry] = self.captured()
+
+        self.assertEqual(entry['route'], '/login')
+        self.assertIsNone(entry['user_id'])
+        self.assertNotIn('password', json.dumps(entry))
+
+    def test_sampling(self):
+        """Test nothing is captured at a sample rate of 0"""
+
+        app.config['REQUEST_CAPTURE_SAMPLE'] = 0
+
+        with app.test_client() as client:
+            client.get("/")
+
+        self.assertFalse(os.path.exists(self.capture_path))
+
+
+class ReplayTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.capture_dir = tempfile.TemporaryDirectory()
+        self.capture_path = os.path.join(self.capture_dir.name, 'capture.jsonl')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        db.session.rollback()
+        self.capture_dir.cleanup()
+
+    def write_capture(self, entries):
+        with open(self.capture_path, 'w') as capture:
+            for entry in entries:
+                capture.write(json.dumps(entry) + '\n')
+
+    def test_replay(self):
+        """Test replaying a capture as the captured user"""
+
+        entry = dict(method='GET', route='/users/<int:user_id>', query={},
+                     status=200, ms=1.0)
+        self.write_capture([
+            dict(entry, ts=2.0, path=f"/users/{self.u1_id}", user_id=self.u1_id),
+            dict(entry, ts=1.0, path=f"/users/{self.u1_id}", user_id=None),
+            dict(entry, ts=1.5, method='POST', route='/logout', path='/logout',
+                 user_id=self.u1_id),
+        ])
+
+        entries = load_capture(self.capture_path)
+        cookies = session_cookies(entries, app_cookie_signer())
+        results, elapsed = replay(entries, self.base_url, concurrency=2,
+                                  speed=0, cookies=cookies)
+
+        self.assertEqual([entry['ts'] for entry in entries], [1.0, 2.0])
+        self.assertEqual(sorted(status for _, status, _ in results), [200, 302])
+
+        summary = summarize(results)
+
+        self.assertEqual(list(summary), ['GET /users/<int:user_id>'])
+        self.assertEqual(summary['GET /users/<int:user_id>']['requests'], 2)
+        self.assertEqual(summary['GET /users/<int:user_id>']['errors'], 0)
+
+    def test_connection_failures_are_errors(self):
+        """Test requests that get no response count as errors"""
+
+        self.server.shutdown()
+        self.server.server_close()
+
+        results, _ = replay(
+            [dict(ts=0, method='GET', route='/', path='/', user_id=None, query={})],
+            self.base_url, speed=0)
+
+        self.assertEqual(summarize(results)['GET /']['error_rate'], 1.0)
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles"""
+
+        values = list(range(1, 101))
+
+        self.assertEqual(percentile(values, 0.50), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([7], 0.95), 7)
+        self.assertIsNone(percentile([], 0.5))
@@ -0,0 +1,111 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_compression.py
+
+
+import gzip
+import os
+from unittest import TestCase, skipUnless
+
+from flask import url_for
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from compression import brotli
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class CompressionTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        db.session.add_all([Message(text=f"message {i}", user_id=self.u1_id)
+                            for i in range(20)])
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['COMPRESS_MIN_SIZE'] = 500
+        db.session.rollback()
+
+    def get_home(self, accept_encoding):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            return client.get("/", headers={'Accept-Encoding': accept_encoding})
+
+    def test_gzip(self):
+        """Test HTML is gzipped for clients that accept it"""
+
+        plain = self.get_home('identity')
+        compressed = self.get_home('gzip, deflate')
+
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed.vary)
+        self.assertIn('compress;dur=', compressed.headers['Server-Timing'])
+        self.assertLess(len(compressed.get_data()), len(plain.get_data()))
+        self.assertIn(b"message 19", gzip.decompress(compressed.get_data()))
+
+    @skipUnless(brotli, "brotli isn't installed")
+    def test_brotli_preferred(self):
+        """Test brotli is used when the client accepts it"""
+
+        response = self.get_home('gzip, br')
+
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertIn(b"message 19", brotli.decompress(response.get_data()))
+
+    def test_refused_encoding(self):
+        """Test an encoding with q=0 isn't used"""
+
+        self.assertNotIn('Content-Encoding', self.get_home('gzip;q=0').headers)
+
+    def test_min_size(self):
+        """Test small responses are sent as they are"""
+
+        app.config['COMPRESS_MIN_SIZE'] = 10_000_000
+
+        self.assertNotIn('Content-Encoding', self.get_home('gzip').headers)
+
+    def test_static_precompressed(self):
+        """Test hashed stylesheets are served compressed from memory"""
+
+        with app.test_request_context():
+            url = url_for('static', filename='stylesheets/style.css')
+
+        with app.test_client() as client:
+            plain = client.get(url)
+            compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+            self.assertNotIn('Server-Timing', compressed.headers)
+            self.assertNotEqual(compressed.headers['ETag'], plain.headers['ETag'])
+            self.assertEqual(gzip.decompress(compressed.get_data()), plain.get_data())
+
+    def test_images_not_compressed(self):
+        """Test types outside the allowlist are left alone"""
+
+        with app.test_request_context():
+            url = url_for('static', filename='images/warbler-logo.png')
+
+        with app.test_client() as client:
+            response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+            self.assertNotIn('Content-Encoding', response.headers)
+            response.close()
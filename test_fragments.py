@@ -0,0 +1,175 @@
+"""Template fragment cache tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_fragments.py
+
+
+import os
+from unittest import TestCase
+
+from flask import render_template_string
+from sqlalchemy.orm import Session
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, create_app, CURR_USER_KEY
+from fragments import FragmentCache, _clear_after_drop, get_fragment_cache
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class FragmentCacheTestCase(TestCase):
+    def test_lru_eviction(self):
+        """Test the least recently used fragment is evicted first"""
+
+        cache = FragmentCache(2)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        cache.get('a')
+        cache.set('c', 'C')
+
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'C')
+
+    def test_cache_tag(self):
+        """Test a cache block renders once per key"""
+
+        template = "{% cache 'test', n %}{{ calls.append(n) or n }}{% endcache %}"
+        calls = []
+
+        with app.test_request_context():
+            self.assertEqual(render_template_string(template, n=1, calls=calls), '1')
+            self.assertEqual(render_template_string(template, n=1, calls=calls), '1')
+            self.assertEqual(render_template_string(template, n=2, calls=calls), '2')
+
+        self.assertEqual(calls, [1, 2])
+
+    def test_cached_html_stays_escaped(self):
+        """Test cached fragments are escaped once, not twice"""
+
+        template = "{% cache 'test-escape', 1 %}{{ text }}{% endcache %}"
+
+        with app.test_request_context():
+            for _ in range(2):
+                self.assertEqual(render_template_string(template, text='<b>'),
+                                 '&lt;b&gt;')
+
+    def test_one_drop_listener(self):
+        """Test building apps doesn't pile up drop listeners"""
+
+        create_app({'SQLALCHEMY_DATABASE_URI': "postgresql:///warbler_test",
+                    'SECRET_KEY': "test"})
+
+        listeners = list(db.metadata.dispatch.after_drop)
+        self.assertEqual(listeners.count(_clear_after_drop), 1)
+
+
+class FragmentViewsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        get_fragment_cache().clear()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        msg = Message(text="fragment_msg", user_id=self.u2_id)
+        db.session.add(msg)
+        u1.following.append(u2)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get_as(self, user_id, url):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            return client.get(url).get_data(as_text=True)
+
+    def test_edited_user_gets_fresh_fragments(self):
+        """Test renaming a user changes their cached messages and cards"""
+
+        self.assertIn("@u2", self.get_as(self.u1_id, "/"))
+        self.assertIn("@u2", self.get_as(self.u1_id, f"/users/{self.u1_id}/following"))
+
+        u2 = db.session.get(User, self.u2_id)
+        u2.username = "renamed"
+        u2.bump_version()
+        db.session.commit()
+
+        home = self.get_as(self.u1_id, "/")
+        following = self.get_as(self.u1_id, f"/users/{self.u1_id}/following")
+
+        self.assertIn("@renamed", home)
+        self.assertNotIn("@u2", home)
+        self.assertIn("@renamed", following)
+
+    def test_concurrent_edits_both_count(self):
+        """Test two sessions editing one user both succeed and bump its version"""
+
+        version = db.session.get(User, self.u2_id).version
+        db.session.expunge_all()
+
+        with Session(db.engine) as session:
+            stale = session.get(User, self.u2_id)
+
+            other = db.session.get(User, self.u2_id)
+            other.bio = "first"
+            other.bump_version()
+            db.session.commit()
+
+            stale.location = "second"
+            stale.bump_version()
+            session.commit()
+
+        db.session.expunge_all()
+        u2 = db.session.get(User, self.u2_id)
+        self.assertEqual((u2.bio, u2.location), ("first", "second"))
+        self.assertEqual(u2.version, version + 2)
+
+    def test_like_star_is_per_viewer(self):
+        """Test the like star isn't cached with the message"""
+
+        db.session.add(Like(message_id=self.msg_id, user_id=self.u1_id))
+        db.session.commit()
+
+        self.assertIn("bi-star-fill", self.get_as(self.u1_id, f"/users/{self.u2_id}"))
+
+        viewer = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        html = self.get_as(viewer.id, f"/users/{self.u2_id}")
+
+        self.assertIn("fragment_msg", html)
+        self.assertNotIn("bi-star-fill", html)
+
+    def test_follow_button_is_per_viewer(self):
+        """Test the follow button isn't cached with the user card"""
+
+        self.assertIn("Unfollow", self.get_as(self.u1_id, "/users?q=u2"))
+        self.assertNotIn("Unfollow", self.get_as(self.u2_id, "/users?q=u2"))
+
+    def test_drop_all_clears_cache(self):
+        """Test recreating the tables empties the cache"""
+
+        self.get_as(self.u1_id, "/")
+        self.assertTrue(get_fragment_cache().entries)
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        self.assertFalse(get_fragment_cache().entries)
@@ -0,0 +1,248 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_jobs.py
+
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+
+from models import db, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import jobs
+from jobs import (
+    backoff, claim, enqueue, execute, job_stats, requeue_stale,
+    schedule_recurring, task, work)
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+calls = []
+
+
+@task('test-record')
+def record_call(n):
+    calls.append(n)
+
+
+@task('test-fail', max_attempts=2)
+def always_fail():
+    raise RuntimeError("task broke")
+
+
+release = threading.Event()
+
+
+@task('test-wait')
+def wait_for_release():
+    release.wait(5)
+
+
+@task('test-every', queue='test-recurring', every=60)
+def every_minute():
+    calls.append('tick')
+
+
+class JobTestCase(TestCase):
+    def setUp(self):
+        Job.query.delete()
+        db.session.commit()
+        calls.clear()
+        release.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_runs_due_jobs_in_order(self):
+        """Test due jobs run oldest first and later ones wait"""
+
+        now = datetime.utcnow()
+        enqueue('test-record', n=2, run_at=now - timedelta(seconds=1))
+        enqueue('test-record', n=1, run_at=now - timedelta(seconds=2))
+        enqueue('test-record', n=3, run_at=now + timedelta(hours=1))
+        db.session.commit()
+
+        work(once=True)
+
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(Job.query.filter_by(status='done').count(), 2)
+        self.assertEqual(Job.query.filter_by(status='queued').count(), 1)
+
+    def test_records_duration(self):
+        """Test finished jobs record how long they ran"""
+
+        enqueue('test-record', n=1)
+        db.session.commit()
+        work(once=True)
+
+        job = Job.query.one()
+        self.assertIsNotNone(job.duration_ms)
+        self.assertEqual(job_stats()['test-record']['done'], 1)
+        self.assertEqual(job_stats()['test-record']['max_ms'],
+                         round(job.duration_ms, 1))
+
+    def test_retries_with_backoff(self):
+        """Test a failing job is retried later, then marked failed"""
+
+        job = enqueue('test-fail')
+        db.session.commit()
+
+        before = datetime.utcnow()
+        execute(claim())
+
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("task broke", job.last_error)
+        self.assertGreaterEqual(job.run_at, before + timedelta(seconds=backoff(1)))
+        self.assertIsNone(claim())
+
+        execute(claim(now=job.run_at))
+
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_backoff_doubles(self):
+        """Test the wait doubles with each attempt, up to a cap"""
+
+        self.assertEqual(backoff(2), 2 * backoff(1))
+        self.assertEqual(backoff(50), backoff(51))
+
+    def test_queue_limit(self):
+        """Test a queue at its limit has no job claimed"""
+
+        for n in range(3):
+            enqueue('test-record', n=n)
+        db.session.commit()
+
+        limits = {'default': 2}
+        self.assertIsNotNone(claim(limits))
+        self.assertIsNotNone(claim(limits))
+        self.assertIsNone(claim(limits))
+
+    def test_queue_limit_across_threads(self):
+        """Test concurrent workers never run more than the limit"""
+
+        for n in range(6):
+            enqueue('test-record', n=n)
+        db.session.commit()
+
+        claimed = []
+
+        def worker():
+            with app.app_context():
+                while (job := claim({'default': 2})) is not None:
+                    claimed.append(job.id)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(claimed), 2)
+
+    def test_key_dedupes_pending_jobs(self):
+        """Test only one job per key is pending at a time"""
+
+        self.assertIsNotNone(enqueue('test-record', key='only-one', n=1))
+        self.assertIsNone(enqueue('test-record', key='only-one', n=2))
+        db.session.commit()
+
+        work(once=True)
+        self.assertIsNotNone(enqueue('test-record', key='only-one', n=3))
+
+    def test_recurring(self):
+        """Test a recurring task is re-queued after each run"""
+
+        schedule_recurring()
+        schedule_recurring()
+
+        job = Job.query.filter_by(name='test-every').one()
+        # Leave the built-in maintenance tasks queued.
+        execute(claim({'maintenance': 0}))
+
+        self.assertEqual(calls, ['tick'])
+        next_run = Job.query.filter_by(name='test-every', status='queued').one()
+        self.assertEqual(next_run.run_at, job.started_at + timedelta(seconds=60))
+
+    def test_stale_jobs_requeued(self):
+        """Test a job whose worker stopped beating counts as a failed attempt"""
+
+        enqueue('test-record', n=1)
+        db.session.commit()
+        job = claim()
+
+        requeue_stale()
+        self.assertEqual(job.status, 'running')
+
+        requeue_stale(now=datetime.utcnow() + timedelta(
+            seconds=jobs.STALE_SECONDS + 1))
+        self.assertEqual(job.status, 'queued')
+        self.assertIn("No heartbeat", job.last_error)
+
+    def test_long_job_not_requeued(self):
+        """Test a job running past STALE_SECONDS isn't run again meanwhile"""
+
+        enqueue('test-wait')
+        db.session.commit()
+        job_id = claim().id
+
+        def worker():
+            with app.app_context():
+                execute(db.session.get(Job, job_id))
+
+        with mock.patch.multiple(jobs, HEARTBEAT_SECONDS=0.05, STALE_SECONDS=0.2):
+            thread = threading.Thread(target=worker)
+            thread.start()
+
+            time.sleep(0.5)
+            requeue_stale()
+            job = db.session.get(Job, job_id)
+            self.assertEqual(job.status, 'running')
+            self.assertGreater(job.heartbeat_at, job.started_at)
+
+            release.set()
+            thread.join()
+
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Job, job_id).status, 'done')
+        self.assertEqual(db.session.get(Job, job_id).attempts, 1)
+
+    def test_metrics(self):
+        """Test job stats are served only with METRICS_TOKEN"""
+
+        app.config['METRICS_TOKEN'] = "secret"
+
+        try:
+            with app.test_client() as client:
+                self.assertEqual(client.get("/metrics/jobs").status_code, 404)
+                enqueue('test-record', n=1)
+                db.session.commit()
+
+                resp = client.get("/metrics/jobs",
+                                  headers={'Authorization': "Bearer secret"})
+        finally:
+            app.config['METRICS_TOKEN'] = None
+
+        self.assertEqual(resp.json['test-record']['queued'], 1)
+
+    def test_builtin_tasks_run(self):
+        """Test the maintenance tasks run cleanly"""
+
+        schedule_recurring()
+        work(once=True)
+
+        for name in ['prune-jobs', 'purge-accounts', 'maintain-partitions']:
+            self.assertEqual(job_stats()[name]['done'], 1, name)
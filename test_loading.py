@@ -0,0 +1,147 @@
+"""Loading strategy tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_loading.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from loading import NPlusOneError
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['STRICT_LOADING'] = True
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class LoadingTestCase(TestCase):
+    def setUp(self):
+        """Add a user who follows one user and likes messages from three."""
+
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(1, 6)
+        ]
+        u1, u2 = users[:2]
+        u1.following.append(u2)
+        db.session.flush()
+
+        messages = [Message(text=f"{u.username}-text", user_id=u.id) for u in users]
+        db.session.add_all(messages)
+        u1.likes.extend(messages[2:])
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def test_repeated_lazy_load_raises(self):
+        """Test strict mode catches a relationship loaded per row"""
+
+        db.session.expunge_all()
+
+        with app.test_request_context():
+            messages = Message.query.all()
+
+            with self.assertRaises(NPlusOneError):
+                for msg in messages:
+                    msg.user
+
+    def test_single_lazy_load_allowed(self):
+        """Test strict mode allows a relationship to load once per user"""
+
+        db.session.expunge_all()
+
+        with app.test_request_context():
+            user = db.session.get(User, self.u1_id)
+            self.assertEqual(len(user.following), 1)
+
+    def test_lazy_loads_outside_request(self):
+        """Test strict mode only applies inside a request"""
+
+        db.session.expunge_all()
+
+        for msg in Message.query.all():
+            msg.user
+
+    def test_feed_has_no_n_plus_one(self):
+        """Test the home feed loads every author without tripping strict mode"""
+
+        db.session.expunge_all()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@u2", resp.get_data(as_text=True))
+
+    def test_likes_page_has_no_n_plus_one(self):
+        """Test the likes page loads every author without tripping strict mode"""
+
+        db.session.expunge_all()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u1_id}/likes")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@u5", resp.get_data(as_text=True))
+
+    def test_user_pages_have_no_n_plus_one(self):
+        """Test user pages load in a fixed number of queries"""
+
+        def queries(url):
+            statements = []
+            count = lambda *args: statements.append(args[2])
+
+            db.session.expunge_all()
+            event.listen(db.engine, 'before_cursor_execute', count)
+
+            try:
+                with app.test_client() as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = self.u1_id
+
+                    resp = c.get(url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+
+            self.assertEqual(resp.status_code, 200)
+            return len(statements)
+
+        urls = [f"/users/{self.u1_id}", f"/users/{self.u1_id}/following",
+                f"/users/{self.u1_id}/followers"]
+        before = [queries(url) for url in urls]
+
+        u1 = db.session.get(User, self.u1_id)
+        others = User.query.filter(User.id != self.u1_id).all()
+        u1.following.extend(user for user in others if user not in u1.following)
+        db.session.add_all([Message(text=f"more-{i}", user_id=self.u1_id)
+                            for i in range(3)])
+        for user in others:
+            user.following.append(u1)
+        db.session.commit()
+
+        self.assertEqual([queries(url) for url in urls], before)
@@ -28,6 +28,8 @@ from app import app
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
+app.app_context().push()
+
 db.drop_all()
 db.create_all()
 
@@ -31,6 +31,8 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
+app.app_context().push()
+
 db.drop_all()
 db.create_all()
 
@@ -38,6 +40,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail on N+1 lazy loads so a template change can't quietly reintroduce them
+
+app.config['STRICT_LOADING'] = True
+
 
 class MessageBaseViewTestCase(TestCase):
     def setUp(self):
@@ -0,0 +1,155 @@
+"""Prometheus metrics tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_metrics.py
+
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from prometheus_client import REGISTRY
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+# Serves two requests in a fresh process, in multiprocess mode.
+CHILD = """\
+from app import create_app
+app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql:///warbler_test',
+                  'SECRET_KEY': 'test'})
+with app.test_client() as client:
+    client.get('/login')
+    client.get('/login')
+"""
+
+# Prints what /metrics would serve from the multiprocess directory.
+SCRAPE = """\
+from metrics import render_metrics
+print(render_metrics()[0].decode())
+"""
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        db.session.add(Message(text="hello", user_id=self.user_id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['METRICS_TOKEN'] = None
+
+    def get_as(self, url):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            return client.get(url)
+
+    def test_request_metrics(self):
+        """Test requests are counted and timed per endpoint and status"""
+
+        labels = {'endpoint': 'warbler.show_user', 'method': 'GET', 'status': '200'}
+        count = sample('warbler_requests_total', **labels)
+        timed = sample('warbler_request_duration_seconds_count',
+                       endpoint='warbler.show_user')
+        queries = sample('warbler_db_queries_total', endpoint='warbler.show_user')
+
+        self.get_as(f"/users/{self.user_id}")
+
+        self.assertEqual(sample('warbler_requests_total', **labels), count + 1)
+        self.assertEqual(sample('warbler_request_duration_seconds_count',
+                                endpoint='warbler.show_user'), timed + 1)
+        self.assertGreater(sample('warbler_db_queries_total',
+                                  endpoint='warbler.show_user'), queries)
+        self.assertGreater(sample('warbler_request_db_seconds_sum',
+                                  endpoint='warbler.show_user'), 0)
+
+    def test_unmatched_urls_share_a_label(self):
+        """Test unknown URLs don't each add a series"""
+
+        def unmatched():
+            return sum(sample('warbler_requests_total', endpoint='unmatched',
+                              method='GET', status=status)
+                       for status in ['200', '404'])
+
+        before = unmatched()
+
+        self.get_as("/no-such-page")
+        self.get_as("/no-such-page-either")
+
+        self.assertEqual(unmatched(), before + 2)
+
+    def test_template_and_cache_metrics(self):
+        """Test template render times and cache lookups are recorded"""
+
+        rendered = sample('warbler_template_render_seconds_count',
+                          template='users/show.html')
+        lookups = sum(sample('warbler_cache_lookups_total', cache='user-search',
+                             result=result)
+                      for result in ['hit', 'miss'])
+
+        self.get_as(f"/users/{self.user_id}")
+        self.get_as("/users?q=test")
+
+        self.assertEqual(sample('warbler_template_render_seconds_count',
+                                template='users/show.html'), rendered + 1)
+        self.assertEqual(sum(sample('warbler_cache_lookups_total', cache='user-search',
+                                    result=result)
+                             for result in ['hit', 'miss']), lookups + 1)
+
+    def test_endpoint(self):
+        """Test metrics are served in text format only with METRICS_TOKEN"""
+
+        app.config['METRICS_TOKEN'] = "secret"
+
+        with app.test_client() as client:
+            self.assertEqual(client.get("/metrics").status_code, 404)
+
+            resp = client.get("/metrics", headers={'Authorization': "Bearer secret"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        self.assertIn("# TYPE warbler_request_duration_seconds histogram",
+                      resp.get_data(as_text=True))
+
+    def test_multiprocess(self):
+        """Test /metrics adds up every worker process's samples"""
+
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': metrics_dir}
+            project_dir = os.path.dirname(os.path.abspath(__file__))
+
+            for _ in range(2):
+                subprocess.run([sys.executable, '-c', CHILD], env=env,
+                               cwd=project_dir, check=True)
+
+            scrape = subprocess.run([sys.executable, '-c', SCRAPE], env=env,
+                                    cwd=project_dir, check=True,
+                                    capture_output=True, text=True).stdout
+
+        self.assertIn('warbler_requests_total{endpoint="warbler.login",'
+                      'method="GET",status="200"} 4.0', scrape)
@@ -0,0 +1,236 @@
+"""Transactional outbox tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_outbox.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from models import db, User, Message, Follow, OutboxEvent
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from outbox import CONSUMERS, MAX_ATTEMPTS, drain, record_event, run
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        OutboxEvent.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.delivered = []
+        CONSUMERS['test.created'].append(
+            lambda event: self.delivered.append(event.payload['n']))
+
+    def tearDown(self):
+        db.session.rollback()
+        del CONSUMERS['test.created']
+
+    def client_as(self, user_id):
+        client = app.test_client()
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return client
+
+    def retry_time(self):
+        """When the first pending event may next be tried."""
+
+        event = (OutboxEvent.query.filter_by(status='pending')
+                 .order_by(OutboxEvent.id).first())
+        return event.next_attempt_at or datetime.utcnow()
+
+    def kinds(self):
+        return [event.kind for event in
+                OutboxEvent.query.order_by(OutboxEvent.id)]
+
+    def test_event_commits_with_change(self):
+        """Test an event is written in the change's transaction"""
+
+        msg = Message(text="hello", user_id=self.u1_id)
+        db.session.add(msg)
+        record_event('created', msg)
+
+        event = OutboxEvent.query.one()
+        self.assertEqual(event.kind, "messages.created")
+        self.assertEqual(event.payload, {'id': msg.id, 'user_id': self.u1_id})
+
+        db.session.rollback()
+        self.assertEqual(OutboxEvent.query.count(), 0)
+
+    def test_routes_record_events(self):
+        """Test the write routes record their changes"""
+
+        client = self.client_as(self.u1_id)
+        client.post("/messages/new", data={"text": "hello"})
+        msg_id = Message.query.one().id
+        client.post(f"/users/follow/{self.u2_id}")
+        client.post(f"/messages/{msg_id}/like")
+        client.post(f"/messages/{msg_id}/like")
+
+        self.client_as(self.u2_id).post(f"/users/block/{self.u1_id}")
+
+        self.assertEqual(self.kinds(), [
+            "messages.created",
+            "follows.created",
+            "likes.created",
+            "likes.deleted",
+            "blocks.created",
+            # u1 can no longer follow u2.
+            "follows.deleted",
+        ])
+
+        client.post(f"/messages/{msg_id}/delete")
+        self.assertEqual(self.kinds()[-1], "messages.deleted")
+
+    def test_block_records_removed_follow(self):
+        """Test blocking a follower records the follow it removes"""
+
+        db.session.add(Follow(user_being_followed_id=self.u2_id,
+                              user_following_id=self.u1_id))
+        db.session.commit()
+
+        self.client_as(self.u2_id).post(f"/users/block/{self.u1_id}")
+
+        self.assertEqual(self.kinds(), ["blocks.created", "follows.deleted"])
+        self.assertEqual(OutboxEvent.query.all()[-1].payload, {
+            'user_being_followed_id': self.u2_id,
+            'user_following_id': self.u1_id,
+        })
+
+    def test_drain_delivers_in_order(self):
+        """Test drained events reach consumers in order and are deleted"""
+
+        db.session.add_all([
+            OutboxEvent(kind="test.created", payload={'n': n}) for n in range(3)
+        ])
+        db.session.commit()
+
+        self.assertEqual(drain(batch_size=2), 2)
+        self.assertEqual(self.delivered, [0, 1])
+
+        run(batch_size=2, once=True)
+        self.assertEqual(self.delivered, [0, 1, 2])
+        self.assertEqual(OutboxEvent.query.count(), 0)
+
+    def test_failed_event_is_retried(self):
+        """Test an event whose consumer fails stays, holding later events"""
+
+        def flaky(event):
+            if event.payload['n'] == 1 and not failures:
+                failures.append(event.id)
+                raise RuntimeError("consumer down")
+
+        failures = []
+        CONSUMERS['test.created'].append(flaky)
+
+        db.session.add_all([
+            OutboxEvent(kind="test.created", payload={'n': n}) for n in range(3)
+        ])
+        db.session.commit()
+
+        self.assertEqual(drain(), 1)
+
+        failed = db.session.get(OutboxEvent, failures[0])
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn("consumer down", failed.last_error)
+        self.assertEqual(OutboxEvent.query.count(), 2)
+
+        # It waits out its backoff, and holds up the event after it.
+        self.assertEqual(drain(), 0)
+        self.assertEqual(self.delivered, [0, 1])
+
+        self.assertEqual(drain(now=failed.next_attempt_at), 2)
+        # The failed event was delivered to every consumer again.
+        self.assertEqual(self.delivered, [0, 1, 1, 2])
+
+    def test_event_failing_every_attempt_is_skipped(self):
+        """Test an event failing MAX_ATTEMPTS times is marked failed and
+        no longer holds up later events"""
+
+        def broken(event):
+            if event.payload['n'] == 0:
+                raise RuntimeError("bad event")
+
+        CONSUMERS['test.created'].append(broken)
+
+        db.session.add_all([
+            OutboxEvent(kind="test.created", payload={'n': n}) for n in range(2)
+        ])
+        db.session.commit()
+
+        for _ in range(MAX_ATTEMPTS - 1):
+            self.assertEqual(drain(now=self.retry_time()), 0)
+
+        self.assertEqual(drain(now=self.retry_time()), 1)
+
+        failed = OutboxEvent.query.one()
+        self.assertEqual(failed.status, 'failed')
+        self.assertEqual(failed.attempts, MAX_ATTEMPTS)
+        self.assertEqual(self.delivered[-1], 1)
+
+        self.assertEqual(drain(now=datetime.utcnow() + timedelta(days=1)), 0)
+        self.assertEqual(failed.attempts, MAX_ATTEMPTS)
+
+    def test_backoff_grows(self):
+        """Test each failure puts off an event's next attempt for longer"""
+
+        def broken(event):
+            raise RuntimeError("bad event")
+
+        CONSUMERS['test.created'].append(broken)
+
+        db.session.add(OutboxEvent(kind="test.created", payload={'n': 0}))
+        db.session.commit()
+
+        now = datetime.utcnow()
+        waits = []
+        for _ in range(3):
+            drain(now=now)
+            event = OutboxEvent.query.one()
+            waits.append(event.next_attempt_at - now)
+            now = event.next_attempt_at
+
+        self.assertLess(waits[0], waits[1])
+        self.assertLess(waits[1], waits[2])
+        self.assertEqual(event.status, 'pending')
+
+    def test_failed_query_is_rolled_back(self):
+        """Test a consumer whose query fails doesn't spoil the transaction"""
+
+        def bad_query(event):
+            if event.payload['n'] == 1:
+                db.session.execute(text("SELECT * FROM no_such_table"))
+
+        CONSUMERS['test.created'].append(bad_query)
+
+        db.session.add_all([
+            OutboxEvent(kind="test.created", payload={'n': n}) for n in range(2)
+        ])
+        db.session.commit()
+
+        self.assertEqual(drain(), 1)
+
+        failed = OutboxEvent.query.one()
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn("no_such_table", failed.last_error)
@@ -0,0 +1,105 @@
+"""JSON responses for like, follow and block tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_partial_responses.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follow, Block, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+JSON = {'Accept': 'application/json'}
+
+
+class PartialResponseTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        m1 = Message(text="m1", user_id=u2.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def post(self, url, headers=JSON, **kwargs):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            return client.post(url, headers=headers, **kwargs)
+
+    def test_like_toggle(self):
+        """Test liking and unliking return the new state as JSON"""
+
+        url = f"/messages/{self.m1_id}/like"
+
+        response = self.post(url, data={'current_url': '/'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'message_id': self.m1_id, 'liked': True})
+        self.assertEqual(Like.query.filter_by(user_id=self.u1_id).count(), 1)
+
+        response = self.post(url, data={'current_url': '/'})
+        self.assertEqual(response.json, {'message_id': self.m1_id, 'liked': False})
+        self.assertEqual(Like.query.filter_by(user_id=self.u1_id).count(), 0)
+
+    def test_follow_and_unfollow(self):
+        """Test following and unfollowing return the new state as JSON"""
+
+        response = self.post(f"/users/follow/{self.u2_id}")
+        self.assertEqual(response.json, {'user_id': self.u2_id, 'following': True})
+        self.assertIsNotNone(db.session.get(Follow, (self.u2_id, self.u1_id)))
+
+        # Following twice is harmless.
+        response = self.post(f"/users/follow/{self.u2_id}")
+        self.assertEqual(response.status_code, 200)
+
+        response = self.post(f"/users/stop-following/{self.u2_id}")
+        self.assertEqual(response.json, {'user_id': self.u2_id, 'following': False})
+        self.assertIsNone(db.session.get(Follow, (self.u2_id, self.u1_id)))
+
+    def test_block_and_unblock(self):
+        """Test blocking drops their follow and returns JSON"""
+
+        db.session.add(Follow(user_being_followed_id=self.u1_id,
+                              user_following_id=self.u2_id))
+        db.session.commit()
+
+        response = self.post(f"/users/block/{self.u2_id}")
+        self.assertEqual(response.json, {'user_id': self.u2_id, 'blocking': True})
+        self.assertIsNotNone(db.session.get(Block, (self.u2_id, self.u1_id)))
+        self.assertIsNone(db.session.get(Follow, (self.u1_id, self.u2_id)))
+
+        response = self.post(f"/users/stop-blocking/{self.u2_id}")
+        self.assertEqual(response.json, {'user_id': self.u2_id, 'blocking': False})
+        self.assertIsNone(db.session.get(Block, (self.u2_id, self.u1_id)))
+
+    def test_form_post_still_redirects(self):
+        """Test a plain form post gets the full-page redirect"""
+
+        response = self.post(f"/users/follow/{self.u2_id}",
+                             headers={'Accept': 'text/html,*/*;q=0.8'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.location, f"/users/{self.u1_id}/following")
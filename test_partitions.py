@@ -0,0 +1,144 @@
+"""Message partitioning tests (Postgres only)."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_partitions.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from models import db, User, Message, ArchivedMessage
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from partitions import setup, maintain, partitions, is_partitioned
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+NOW = datetime(2024, 6, 15)
+
+
+class PartitionTestCase(TestCase):
+    def setUp(self):
+        """Add messages from two years ago, last year and this month."""
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+
+        old = Message(text="old", user_id=u1.id, timestamp=datetime(2022, 5, 1))
+        recent = Message(text="recent", user_id=u1.id, timestamp=datetime(2023, 9, 1))
+        new = Message(text="new", user_id=u1.id, timestamp=datetime(2024, 6, 1))
+        db.session.add_all([old, recent, new])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.old_id = old.id
+
+        db.session.close()
+
+        with db.engine.begin() as conn:
+            setup(conn, now=NOW, months_ahead=2)
+
+    def tearDown(self):
+        """Put back the plain messages table for the other tests."""
+
+        db.session.rollback()
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+
+    def test_setup(self):
+        """Test setup partitions by month and keeps every message"""
+
+        with db.engine.connect() as conn:
+            self.assertTrue(is_partitioned(conn))
+            months = sorted(partitions(conn))
+
+        self.assertEqual(months[0], datetime(2022, 5, 1))
+        self.assertEqual(months[-1], datetime(2024, 8, 1))
+        self.assertEqual(Message.query.count(), 3)
+
+        # New messages still get ids after the copied ones.
+        msg = Message(text="another", user_id=self.u1_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertEqual(Message.query.count(), 4)
+
+    def test_maintain_creates_and_archives(self):
+        """Test maintain adds future partitions and archives old ones"""
+
+        with db.engine.begin() as conn:
+            archived = maintain(conn, now=NOW, months_ahead=3,
+                                archive_after_months=12)
+            months = sorted(partitions(conn))
+
+        # Every month before June 2023, empty or not.
+        self.assertEqual(len(archived), 13)
+        self.assertEqual(archived[0], "messages_2022_05")
+        self.assertEqual(months[0], datetime(2023, 6, 1))
+        self.assertEqual(months[-1], datetime(2024, 9, 1))
+        self.assertEqual(Message.query.count(), 2)
+        self.assertEqual(ArchivedMessage.query.one().text, "old")
+
+    def test_maintain_moves_rows_from_default(self):
+        """Test a new partition takes its month's rows from the default one"""
+
+        future = Message(text="future", user_id=self.u1_id,
+                         timestamp=datetime(2024, 10, 5))
+        db.session.add(future)
+        db.session.commit()
+        db.session.close()
+
+        with self.assertLogs('partitions', 'WARNING'):
+            with db.engine.begin() as conn:
+                maintain(conn, now=NOW, months_ahead=4)
+
+        with db.engine.connect() as conn:
+            moved = conn.execute(text(
+                "SELECT text FROM messages_2024_10")).scalars().all()
+            left = conn.execute(text(
+                "SELECT count(*) FROM messages_default")).scalar()
+
+        self.assertEqual(moved, ["future"])
+        self.assertEqual(left, 0)
+
+    def test_maintain_warns_about_default_rows(self):
+        """Test maintain warns when messages are left in the default partition"""
+
+        db.session.add(Message(text="ancient", user_id=self.u1_id,
+                               timestamp=datetime(2001, 1, 1)))
+        db.session.commit()
+        db.session.close()
+
+        with self.assertLogs('partitions', 'WARNING') as logs:
+            with db.engine.begin() as conn:
+                maintain(conn, now=NOW, archive_after_months=36)
+
+        self.assertIn("holds 1 messages", logs.output[-1])
+
+    def test_archived_message_shown(self):
+        """Test an archived message is still reachable by id"""
+
+        with db.engine.begin() as conn:
+            maintain(conn, now=NOW, archive_after_months=12)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/messages/{self.old_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("old", resp.get_data(as_text=True))
@@ -0,0 +1,138 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_pooling.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from pooling import MeteredQueuePool, engine_options, pool_stats
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class EngineOptionsTestCase(TestCase):
+    def test_defaults(self):
+        """Test pool settings without any DB_* variables"""
+
+        options = engine_options("postgresql:///warbler", {})
+
+        self.assertIs(options['poolclass'], MeteredQueuePool)
+        self.assertEqual(options['pool_size'], 5)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertFalse(options['pool_pre_ping'])
+
+    def test_from_environment(self):
+        """Test pool settings come from DB_* variables"""
+
+        options = engine_options("postgresql:///warbler", {
+            'DB_POOL_SIZE': '2',
+            'DB_MAX_OVERFLOW': '0',
+            'DB_POOL_RECYCLE': '300',
+            'DB_POOL_PRE_PING': '1',
+        })
+
+        self.assertEqual(options['pool_size'], 2)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertEqual(options['pool_recycle'], 300)
+        self.assertTrue(options['pool_pre_ping'])
+
+    def test_pgbouncer(self):
+        """Test PgBouncer mode leaves pooling to PgBouncer"""
+
+        options = engine_options("postgresql:///warbler", {'DB_PGBOUNCER': '1'})
+
+        self.assertEqual(options, {'poolclass': NullPool})
+
+    def test_sqlite_memory(self):
+        """Test in-memory SQLite keeps the default pool"""
+
+        self.assertEqual(engine_options("sqlite://", {}), {})
+
+
+class PoolStatsTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{self.tmp.name}/pool.db",
+            poolclass=MeteredQueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=0.01,
+        )
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp.cleanup()
+
+    def test_checkout_timeout_counted(self):
+        """Test a checkout that times out shows up in the stats"""
+
+        with self.engine.connect():
+            self.assertEqual(pool_stats(self.engine)['checked_out'], 1)
+
+            with self.assertRaises(PoolTimeoutError):
+                self.engine.connect()
+
+        stats = pool_stats(self.engine)
+
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['checkout_timeouts'], 1)
+        self.assertGreaterEqual(stats['wait_seconds_max'], 0.01)
+
+
+class PoolEndpointTestCase(TestCase):
+    def tearDown(self):
+        app.config['METRICS_TOKEN'] = None
+
+    def test_hidden_without_token(self):
+        """Test pool stats aren't served without the metrics token"""
+
+        app.config['METRICS_TOKEN'] = "secret"
+
+        with app.test_client() as client:
+            response = client.get('/metrics/pool')
+
+            self.assertEqual(response.status_code, 404)
+
+    def test_pool_stats_wrong_token(self):
+        """Test pool stats aren't served for a wrong or non-ASCII token"""
+
+        app.config['METRICS_TOKEN'] = "secret"
+
+        with app.test_client() as client:
+            for header in ['Bearer secreT', 'Bearer sécret']:
+                response = client.get('/metrics/pool',
+                                      headers={'Authorization': header})
+
+                self.assertEqual(response.status_code, 404, header)
+
+    def test_pool_stats(self):
+        """Test pool stats are served with the metrics token"""
+
+        app.config['METRICS_TOKEN'] = "secret"
+
+        with app.test_client() as client:
+            response = client.get(
+                '/metrics/pool',
+                headers={'Authorization': 'Bearer secret'},
+            )
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['primary']['pool'], 'MeteredQueuePool')
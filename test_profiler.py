@@ -0,0 +1,115 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_profiler.py
+
+
+import os
+import sys
+import tempfile
+from collections import Counter
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from profiler import collapse, get_profiles, read_stacks, top_functions
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class ProfilerUnitTestCase(TestCase):
+    def test_collapse(self):
+        """Test a stack collapses outermost first"""
+
+        def inner():
+            return collapse(sys._getframe())
+
+        stack = inner().split(';')
+
+        self.assertEqual(stack[-1], f"{__name__}:ProfilerUnitTestCase.test_collapse.<locals>.inner")
+        self.assertEqual(stack[-2], f"{__name__}:ProfilerUnitTestCase.test_collapse")
+
+    def test_top_functions(self):
+        """Test functions are ranked by samples spent in them"""
+
+        stacks = Counter({'a;b;c': 3, 'a;b': 2, 'a;d': 4})
+
+        self.assertEqual(top_functions(stacks, limit=2), [
+            {'function': 'd', 'self': 4, 'total': 4},
+            {'function': 'c', 'self': 3, 'total': 3},
+        ])
+        self.assertEqual(top_functions(stacks)[2],
+                         {'function': 'b', 'self': 2, 'total': 5})
+
+
+class ProfiledRequestTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.profiles = get_profiles()
+        self.profiles.directory = self.dir.name
+        self.profiles.stacks.clear()
+
+        app.config['METRICS_TOKEN'] = "secret"
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['METRICS_TOKEN'] = None
+        self.dir.cleanup()
+
+    def login(self, headers={}):
+        with app.test_client() as client:
+            return client.post("/login", headers=headers, data={
+                'username': "u1", 'password': "password"})
+
+    def test_profiled_request(self):
+        """Test a request sending X-Profile has its stacks saved"""
+
+        self.login(headers={'X-Profile': "secret"})
+
+        stacks = read_stacks(self.dir.name)['warbler.login']
+        self.assertGreater(sum(stacks.values()), 0)
+        self.assertTrue(any('bcrypt' in stack for stack in stacks))
+
+    def test_unprofiled_request(self):
+        """Test requests aren't profiled by default"""
+
+        self.login()
+        self.login(headers={'X-Profile': "wrong"})
+
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_endpoints(self):
+        """Test profiles are served only with METRICS_TOKEN"""
+
+        self.login(headers={'X-Profile': "secret"})
+        auth = {'Authorization': "Bearer secret"}
+
+        with app.test_client() as client:
+            self.assertEqual(client.get("/metrics/profiles").status_code, 404)
+
+            summary = client.get("/metrics/profiles", headers=auth).json
+            folded = client.get("/metrics/profiles/warbler.login", headers=auth)
+            top = client.get("/metrics/profiles/warbler.login/top?limit=3",
+                             headers=auth).json
+
+        self.assertGreater(summary['warbler.login'], 0)
+        self.assertTrue(folded.content_type.startswith("text/plain"))
+        self.assertEqual(
+            sum(int(line.rsplit(' ', 1)[1])
+                for line in folded.get_data(as_text=True).splitlines()),
+            summary['warbler.login'])
+        self.assertLessEqual(len(top), 3)
+        self.assertEqual(set(top[0]), {'function', 'self', 'total'})
@@ -0,0 +1,163 @@
+"""Account deletion and purge tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_purge.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follow, Like, AccountPurge
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from purge import run
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class PurgeTestCase(TestCase):
+    def setUp(self):
+        """Add a user with messages, likes and follows, and one other user."""
+
+        AccountPurge.query.delete()
+        User.query.execution_options(include_deleted=True).delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        messages = [Message(text=f"m{i}", user_id=u1.id) for i in range(5)]
+        m2 = Message(text="u2-text", user_id=u2.id)
+        db.session.add_all(messages + [m2])
+        u1.following.append(u2)
+        u2.following.append(u1)
+        u2.likes.extend(messages)
+        u1.likes.append(m2)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def delete_u1(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+        db.session.expunge_all()
+
+    def test_delete_hides_user(self):
+        """Test a deleted user and their messages disappear right away"""
+
+        self.delete_u1()
+
+        self.assertIsNone(User.query.filter_by(username="u1").one_or_none())
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(len(db.session.get(User, self.u2_id).following), 0)
+        self.assertFalse(User.authenticate("u1", "password"))
+
+        tombstoned = (User
+                        .query
+                        .execution_options(include_deleted=True)
+                        .filter_by(id=self.u1_id)
+                        .one())
+        self.assertIsNotNone(tombstoned.deleted_at)
+
+    def test_deleted_username_and_email_reusable(self):
+        """Test a deleted account's username and email can sign up again"""
+
+        self.delete_u1()
+
+        User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        self.assertEqual(User.query.filter_by(username="u1").count(), 1)
+
+    def test_messages_unfiltered_without_deletions(self):
+        """Test message queries skip the deleted-author filter when no one
+        is deleted"""
+
+        statements = []
+        record = lambda *args: statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            db.session.commit()
+            Message.query.all()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        query = next(sql for sql in statements if "FROM messages" in sql)
+        self.assertNotIn("NOT IN", query)
+
+    def test_delete_hides_user_from_lists_and_counts(self):
+        """Test a deleted user leaves follow lists and profile counts"""
+
+        self.delete_u1()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            for page in ['following', 'followers']:
+                html = c.get(f"/users/{self.u2_id}/{page}").get_data(as_text=True)
+                self.assertNotIn("@u1", html, page)
+
+        self.assertEqual(User.profile_counts(self.u2_id), {
+            'messages': 1, 'following': 0, 'followers': 0, 'likes': 0})
+
+    def test_purge(self):
+        """Test the purge deletes every row in small batches"""
+
+        self.delete_u1()
+
+        run(batch_size=2, once=True)
+
+        purge = db.session.get(AccountPurge, self.u1_id)
+        self.assertIsNotNone(purge.finished_at)
+        # 5 likes of u1's messages, 1 like by u1, 5 messages, 2 follows, u1
+        self.assertEqual(purge.rows_deleted, 14)
+
+        self.assertEqual(
+            User.query.execution_options(include_deleted=True).count(), 1)
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Follow.query.count(), 0)
+
+    def test_purge_resumes(self):
+        """Test a purge interrupted partway finishes on the next run"""
+
+        self.delete_u1()
+
+        # Simulate a worker that stopped after clearing some messages.
+        Like.query.delete()
+        Message.query.execution_options(include_deleted=True).filter(
+            Message.id.in_([m.id for m in Message.query
+                            .execution_options(include_deleted=True)
+                            .filter_by(user_id=self.u1_id)
+                            .limit(3)])
+        ).delete()
+        db.session.commit()
+
+        run(batch_size=2, once=True)
+
+        self.assertIsNotNone(db.session.get(AccountPurge, self.u1_id).finished_at)
+        self.assertEqual(
+            Message.query.execution_options(include_deleted=True).count(), 1)
@@ -0,0 +1,140 @@
+"""Rate limit tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_ratelimit.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from ratelimit import BucketStore, parse_limit, parse_rate_limits
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class BucketStoreTestCase(TestCase):
+    def test_burst_then_refill(self):
+        """Test a bucket allows its burst, then refills at its rate"""
+
+        store = BucketStore()
+
+        for _ in range(3):
+            self.assertEqual(store.take('k', 3, 60, now=100), 0)
+
+        self.assertEqual(store.take('k', 3, 60, now=100), 20)
+        self.assertEqual(store.take('k', 3, 60, now=110), 10)
+        self.assertEqual(store.take('k', 3, 60, now=120), 0)
+
+    def test_keys_are_separate(self):
+        """Test each key has its own bucket"""
+
+        store = BucketStore()
+
+        self.assertEqual(store.take('a', 1, 60, now=100), 0)
+        self.assertEqual(store.take('b', 1, 60, now=100), 0)
+        self.assertGreater(store.take('a', 1, 60, now=100), 0)
+
+    def test_shared_through_file(self):
+        """Test stores opening one file share their buckets, as workers do"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'buckets.sqlite3')
+            worker1, worker2 = BucketStore(path), BucketStore(path)
+
+            self.assertEqual(worker1.take('k', 2, 60, now=100), 0)
+            self.assertEqual(worker2.take('k', 2, 60, now=100), 0)
+            self.assertEqual(worker1.take('k', 2, 60, now=100), 30)
+
+    def test_parse(self):
+        """Test limits parse and bad ones are refused"""
+
+        self.assertEqual(parse_limit("10/minute"), (10, 60))
+
+        limits = parse_rate_limits("warbler.login:ip=5/hour x:user=1/second",
+                                   {'warbler.login': {'ip': '10/minute'}})
+        self.assertEqual(limits, {'warbler.login': {'ip': '5/hour'},
+                                  'x': {'user': '1/second'}})
+
+        for text in ["warbler.login:ip=10/fortnight", "warbler.login:ip=0/minute",
+                     "warbler.login:host=1/minute"]:
+            with self.assertRaises(ValueError):
+                parse_rate_limits(text)
+
+
+class RateLimitedViewsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.limits = app.config['RATE_LIMITS']
+        self.buckets = app.extensions['rate_limits']
+        app.extensions['rate_limits'] = BucketStore()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['RATE_LIMITS'] = self.limits
+        app.extensions['rate_limits'] = self.buckets
+
+    def client_as(self, user_id):
+        client = app.test_client()
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return client
+
+    def test_login_limited_per_ip(self):
+        """Test logins past the limit get 429 with Retry-After"""
+
+        app.config['RATE_LIMITS'] = {'warbler.login': {'ip': '2/minute'}}
+        data = {'username': "u1", 'password': "wrong"}
+
+        with app.test_client() as client:
+            for _ in range(2):
+                self.assertEqual(client.post("/login", data=data).status_code, 200)
+
+            resp = client.post("/login", data=data)
+            self.assertEqual(client.get("/login").status_code, 200)
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], "30")
+
+    def test_messages_limited_per_user(self):
+        """Test one user's limit doesn't hold back another"""
+
+        app.config['RATE_LIMITS'] = {'warbler.add_message': {'user': '1/minute'}}
+
+        u1 = self.client_as(self.u1_id)
+        self.assertEqual(u1.post("/messages/new", data={'text': "one"}).status_code, 302)
+        self.assertEqual(u1.post("/messages/new", data={'text': "two"}).status_code, 429)
+
+        u2 = self.client_as(self.u2_id)
+        self.assertEqual(u2.post("/messages/new", data={'text': "three"}).status_code, 302)
+
+        self.assertEqual(
+            sorted(m.text for m in Message.query.all()), ["one", "three"])
+
+    def test_default_limits(self):
+        """Test the default limits cover login, signup and the write endpoints"""
+
+        for endpoint in ['login', 'signup', 'add_message', 'like_message',
+                         'start_following', 'stop_following', 'start_block',
+                         'stop_blocking']:
+            self.assertIn(f"warbler.{endpoint}", self.limits)
@@ -0,0 +1,132 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_replicas.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from sqlalchemy import create_engine, insert, select
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from replicas import REPLICA_BIND, LAST_WRITE_KEY
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class ReplicaRoutingTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """Stand up a SQLite file as the replica bind."""
+
+        cls.replica_dir = tempfile.TemporaryDirectory()
+        cls.replica = create_engine(
+            f"sqlite:///{cls.replica_dir.name}/replica.db")
+        db.metadata.create_all(cls.replica)
+        db.engines[REPLICA_BIND] = cls.replica
+
+    @classmethod
+    def tearDownClass(cls):
+        del db.engines[REPLICA_BIND]
+        cls.replica.dispose()
+        cls.replica_dir.cleanup()
+
+    def setUp(self):
+        """Copy two users to the replica and add a third only it has."""
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        users = db.session.execute(select(User.__table__)).mappings().all()
+
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.delete())
+            conn.execute(insert(User.__table__), [dict(u) for u in users])
+            conn.execute(insert(User.__table__), dict(
+                username="replica-only",
+                email="replica@email.com",
+                password="password",
+                image_url="", header_image_url="", bio="", location="",
+            ))
+
+        db.session.expunge_all()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+        db.session.expunge_all()
+
+    def test_get_route_reads_replica(self):
+        """Test a replica-safe page is served from the replica"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@replica-only", resp.get_data(as_text=True))
+
+    def test_unmarked_route_reads_primary(self):
+        """Test views not marked replica-safe stay on the primary"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/messages/new")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNone(
+                User.query.filter_by(username="replica-only").one_or_none())
+
+    def test_write_pins_user_to_primary(self):
+        """Test reads right after a write come from the primary"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post("/messages/new", data={"text": "Hello"})
+            self.assertEqual(resp.status_code, 302)
+
+            with c.session_transaction() as sess:
+                self.assertIn(LAST_WRITE_KEY, sess)
+
+            db.session.expunge_all()
+            resp = c.get("/users")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("@replica-only", resp.get_data(as_text=True))
+
+    def test_pin_expires(self):
+        """Test reads go back to the replica once the sticky window passes"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+                sess[LAST_WRITE_KEY] = (
+                    time.time() - app.config['REPLICA_STICKY_SECONDS'] - 1)
+
+            resp = c.get("/users")
+
+            self.assertIn("@replica-only", resp.get_data(as_text=True))
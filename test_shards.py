@@ -0,0 +1,182 @@
+"""Sharding tests, with SQLite files standing in for the shards."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_shards.py
+
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import func, select
+
+from models import db, User, Message, OutboxEvent
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from outbox import drain
+from shards import ShardRouter, backfill
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+NUM_SHARDS = 3
+
+
+class ShardTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.shard_dir = tempfile.TemporaryDirectory()
+        cls.router = ShardRouter([
+            f"sqlite:///{cls.shard_dir.name}/shard{i}.db"
+            for i in range(NUM_SHARDS)
+        ])
+        app.extensions['shards'] = cls.router
+
+    @classmethod
+    def tearDownClass(cls):
+        del app.extensions['shards']
+        cls.router.dispose()
+        cls.shard_dir.cleanup()
+
+    def setUp(self):
+        """Add three users, one per shard, each with a message."""
+
+        User.query.delete()
+        OutboxEvent.query.delete()
+        self.router.drop_all()
+        self.router.create_all()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(NUM_SHARDS)
+        ]
+        db.session.flush()
+
+        for i, user in enumerate(users):
+            db.session.add(Message(text=f"{user.username}-text",
+                                   user_id=user.id,
+                                   timestamp=datetime(2024, 1, i + 1)))
+
+        users[0].following.extend(users[1:])
+        db.session.commit()
+
+        backfill(self.router)
+
+        self.user_ids = [user.id for user in users]
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def count(self, user_id, table_name):
+        table = self.router.metadata.tables[table_name]
+
+        with self.router.engine_for(user_id).connect() as conn:
+            return conn.execute(select(func.count()).select_from(table)).scalar()
+
+    def test_backfill_places_rows_by_owner(self):
+        """Test every shard holds its own user, message and follows"""
+
+        shards = {self.router.shard_for(user_id) for user_id in self.user_ids}
+        self.assertEqual(len(shards), NUM_SHARDS)
+
+        for user_id in self.user_ids:
+            self.assertEqual(self.count(user_id, 'users'), 1)
+            self.assertEqual(self.count(user_id, 'messages'), 1)
+
+        self.assertEqual(self.count(self.user_ids[0], 'follows'), 2)
+        self.assertEqual(self.count(self.user_ids[1], 'follows'), 0)
+
+    def test_backfill_pages_by_key(self):
+        """Test backfilling in batches smaller than a table copies every row"""
+
+        self.router.drop_all()
+        self.router.create_all()
+
+        backfill(self.router, batch_size=1)
+
+        for user_id in self.user_ids:
+            self.assertEqual(self.count(user_id, 'users'), 1)
+            self.assertEqual(self.count(user_id, 'messages'), 1)
+
+        self.assertEqual(self.count(self.user_ids[0], 'follows'), 2)
+
+    def test_recent_messages_merges_shards(self):
+        """Test the feed gathers messages across shards newest first"""
+
+        messages = self.router.recent_messages(self.user_ids, 2)
+
+        self.assertEqual([msg.text for msg in messages], ["u2-text", "u1-text"])
+        self.assertEqual(messages[0].user.username, "u2")
+
+    def test_new_message_copied_to_shard(self):
+        """Test posting a message also writes it to the author's shard"""
+
+        author_id = self.user_ids[1]
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+        # Copied by the outbox worker, not the request.
+        self.assertEqual(self.count(author_id, 'messages'), 1)
+        drain()
+        self.assertEqual(self.count(author_id, 'messages'), 2)
+
+    def test_unfollow_removed_from_shard(self):
+        """Test a removed follow is removed from the follower's shard"""
+
+        follower_id = self.user_ids[0]
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            c.post(f"/users/stop-following/{self.user_ids[1]}")
+
+        drain()
+        self.assertEqual(self.count(follower_id, 'follows'), 1)
+
+    def test_home_feed_from_shards(self):
+        """Test the home feed is read from the shards"""
+
+        # Only on the shard, so the page must have come from there.
+        with self.router.engine_for(self.user_ids[2]).begin() as conn:
+            conn.execute(self.router.metadata.tables['messages'].insert(), dict(
+                id=999999, text="shard-only", user_id=self.user_ids[2],
+                timestamp=datetime(2024, 2, 1)))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_ids[0]
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("shard-only", html)
+            self.assertIn("u1-text", html)
+
+    def test_home_feed_from_primary_after_write(self):
+        """Test a user who just wrote reads the feed from the primary, before
+        the outbox worker has copied their write to the shards"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_ids[0]
+
+            c.post("/messages/new", data={"text": "just-posted"})
+            resp = c.get("/")
+
+            self.assertIn("just-posted", resp.get_data(as_text=True))
@@ -0,0 +1,57 @@
+"""Startup time report tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_startup.py
+
+
+from unittest import TestCase
+
+from startup import import_profile, measure_startup, package_costs, parse_import_times
+
+IMPORT_TIMES = """\
+import time: self [us] | cumulative | imported package
+import time:       150 |        150 |     sqlalchemy.util
+import time:      1000 |       1150 |   sqlalchemy
+import time:       400 |        400 |   sqlalchemy.orm
+some other stderr line
+import time:      2000 |       3550 | app
+"""
+
+
+class ImportTimeTestCase(TestCase):
+    def test_parse(self):
+        """Test -X importtime lines are read and other lines skipped"""
+
+        self.assertEqual(parse_import_times(IMPORT_TIMES), [
+            ('sqlalchemy.util', 150, 2),
+            ('sqlalchemy', 1000, 1),
+            ('sqlalchemy.orm', 400, 1),
+            ('app', 2000, 0),
+        ])
+
+    def test_package_costs(self):
+        """Test submodules count towards their top-level package"""
+
+        self.assertEqual(package_costs(parse_import_times(IMPORT_TIMES)),
+                         [('app', 2.0), ('sqlalchemy', 1.55)])
+
+    def test_import_profile(self):
+        """Test profiling a real startup finds the app and its dependencies"""
+
+        packages = dict(import_profile())
+
+        self.assertIn('app', packages)
+        self.assertIn('flask', packages)
+        self.assertNotIn('flask_debugtoolbar', packages)
+
+
+class MeasureStartupTestCase(TestCase):
+    def test_measure(self):
+        """Test startup times are measured in a fresh process"""
+
+        startup = measure_startup(runs=1)
+
+        self.assertEqual(set(startup), {'import_ms', 'create_app_ms', 'process_ms'})
+        self.assertGreater(startup['import_ms'], 0)
+        self.assertGreaterEqual(startup['process_ms'], startup['import_ms'])
@@ -9,7 +9,7 @@ import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 
-from models import db, User, Follow, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
+from models import db, User, Follow, Message, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -28,6 +28,8 @@ from app import app
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
+app.app_context().push()
+
 db.drop_all()
 db.create_all()
 
@@ -160,6 +162,23 @@ class UserModelTestCase(TestCase):
         self.assertTrue(u2.is_followed_by(u1))
 
 
+    def test_id_sets(self):
+        """Test the followed, blocking and liked ids are read as ids"""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        msg = Message(text="hello", user_id=self.u2_id)
+        u1.following.append(u2)
+        u1.blockers.append(u2)
+        u1.likes.append(msg)
+        db.session.commit()
+
+        self.assertEqual(u1.following_ids(), {self.u2_id})
+        self.assertEqual(u1.blocker_ids(), {self.u2_id})
+        self.assertEqual(u1.liked_message_ids(), {msg.id})
+        self.assertEqual(u2.following_ids(), set())
+
+
     def test_user_signup_success(self):
         """Test successful user signup."""
 
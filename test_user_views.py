@@ -23,6 +23,10 @@ from app import app, CURR_USER_KEY, g, DEFAULT_IMAGE_URL
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail on N+1 lazy loads so a template change can't quietly reintroduce them
+
+app.config['STRICT_LOADING'] = True
+
 # app.config["TESTING"] = True
 
 # Create our tables (we do this here, so we only create the tables
@@ -31,6 +35,8 @@ app.config['WTF_CSRF_ENABLED'] = False
 
 DEFAULT_HEADER_IMAGE_URL = 'https://images.unsplash.com/photo-1519751138087-5bf79df62d5b'
 
+app.app_context().push()
+
 db.drop_all()
 db.create_all()
 